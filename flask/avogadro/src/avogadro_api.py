@@ -3,28 +3,78 @@ from avogadro.io import FileFormatManager
 import json
 
 
-def calculate_mo(cjson, mo):
+# The number of grid points to aim for at each resolution, and the range
+# of the spacing (in Angstrom). The spacing follows from the size of the box
+# around the molecule, and is capped so that large molecules don't get very
+# coarse grids. The box of a small molecule needs far fewer points than the
+# budget, so the minimum spacing is what sets its grid: medium matches the
+# 0.3 that small molecules get without a resolution, coarse is coarser and
+# fine is finer.
+RESOLUTIONS = {
+    'coarse': (32 ** 3, 0.45, 0.8),
+    'medium': (64 ** 3, 0.3, 0.5),
+    'fine': (96 ** 3, 0.15, 0.33)
+}
+PADDING = 4
+
+
+def resolution_spacing(cjson, resolution):
+    """Get the spacing of the grid of a cube at resolution"""
+    points, min_spacing, max_spacing = RESOLUTIONS[resolution]
+
+    coords = cjson.get('atoms', {}).get('coords', {}).get('3d', [])
+    volume = 1.0
+    for axis in range(3):
+        values = coords[axis::3] or [0.0]
+        volume *= max(values) - min(values) + 2 * PADDING
+
+    spacing = (volume / points) ** (1 / 3)
+    return min(max_spacing, max(min_spacing, spacing))
+
+
+def _orbital_setup(cjson, spacing=None, resolution=None):
+    # Parse the cjson and set up the grid once, for any number of orbitals
     mol = Molecule()
     conv = FileFormatManager()
     conv.read_string(mol, json.dumps(cjson), 'cjson')
-    # Do some scaling of our spacing based on the size of the molecule.
-    atom_count = mol.atom_count()
-    spacing = 0.30
-    if atom_count > 50:
-        spacing = 0.5
-    elif atom_count > 30:
-        spacing = 0.4
-    elif atom_count > 10:
-        spacing = 0.33
+    if spacing is None and resolution is not None:
+        spacing = resolution_spacing(cjson, resolution)
+    elif spacing is None:
+        # Do some scaling of our spacing based on the size of the molecule.
+        atom_count = mol.atom_count()
+        spacing = 0.30
+        if atom_count > 50:
+            spacing = 0.5
+        elif atom_count > 30:
+            spacing = 0.4
+        elif atom_count > 10:
+            spacing = 0.33
     cube = mol.add_cube()
-    # Hard wiring spacing/padding for now, this could be exposed in future too.
-    cube.set_limits(mol, spacing, 4)
+    cube.set_limits(mol, spacing, PADDING)
     gaussian = GaussianSetTools(mol)
+
+    return mol, conv, cube, gaussian
+
+
+def calculate_mo(cjson, mo, spacing=None, resolution=None):
+    mol, conv, cube, gaussian = _orbital_setup(cjson, spacing, resolution)
     gaussian.calculate_molecular_orbital(cube, mo)
 
     return conv.write_string(mol, "cjson")
 
 
+def calculate_mos(cjson, mos, spacing=None, resolution=None):
+    """Generate (mo, cjson string) for each of mos.
+
+    The molecule, basis set and grid are only set up once, and the cube is
+    recalculated for each orbital.
+    """
+    mol, conv, cube, gaussian = _orbital_setup(cjson, spacing, resolution)
+    for mo in mos:
+        gaussian.calculate_molecular_orbital(cube, mo)
+        yield mo, conv.write_string(mol, "cjson")
+
+
 def convert_str(str_data, in_format, out_format):
     mol = Molecule()
     conv = FileFormatManager()
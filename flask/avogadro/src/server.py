@@ -1,12 +1,36 @@
 import json
 
-from flask import Flask, Response, request
+from flask import Flask, Response, jsonify, request
 
 import avogadro_api as avogadro
 
 app = Flask(__name__)
 
 
+def _grid(json_data):
+    # The spacing of the cube in Angstrom, or a resolution to pick it for.
+    # The spacing is scaled with the size of the molecule if neither is
+    # given. Returns (spacing, resolution, error response).
+    spacing = json_data.get('spacing')
+    resolution = json_data.get('resolution')
+    if resolution is not None and resolution not in avogadro.RESOLUTIONS:
+        return None, None, Response(
+            'resolution must be one of %s' %
+            ', '.join(sorted(avogadro.RESOLUTIONS)), status=400)
+
+    if spacing is None:
+        return None, resolution, None
+
+    try:
+        spacing = float(spacing)
+    except (TypeError, ValueError):
+        return None, None, Response('spacing must be a number', status=400)
+    if spacing <= 0:
+        return None, None, Response('spacing must be positive', status=400)
+
+    return spacing, resolution, None
+
+
 @app.route('/calculate-mo', methods=['POST'])
 def calculate():
     json_data = request.get_json()
@@ -26,7 +50,45 @@ def calculate():
         return Response(
             json_data['cjson'], status=400, mimetype='application/json')
 
-    return avogadro.calculate_mo(cjson, mo)
+    spacing, resolution, error = _grid(json_data)
+    if error is not None:
+        return error
+
+    return avogadro.calculate_mo(cjson, mo, spacing, resolution)
+
+
+@app.route('/calculate-mos', methods=['POST'])
+def calculate_many():
+    json_data = request.get_json()
+
+    # Make sure cjson and mos exist and are not empty
+    cjson = json_data.get('cjson')
+    mos = json_data.get('mos')
+    if not cjson or not isinstance(mos, list) or not mos:
+        return Response('cjson and a list of mos are required', status=400)
+
+    try:
+        mos = [int(mo) for mo in mos]
+    except (TypeError, ValueError):
+        return Response('mos must be integers', status=400)
+
+    # Prevent potential segfault by checking for electronic structure
+    if 'basisSet' not in cjson or 'orbitals' not in cjson:
+        return Response('cjson has no electronic structure', status=400)
+
+    spacing, resolution, error = _grid(json_data)
+    if error is not None:
+        return error
+
+    def stream():
+        # One JSON object per line, as each cube is calculated. Newlines
+        # can only be whitespace in JSON, so removing them is safe.
+        for mo, cube_cjson in avogadro.calculate_mos(cjson, mos, spacing,
+                                                       resolution):
+            yield '{"mo": %d, "cjson": %s}\n' % (
+                mo, cube_cjson.replace('\n', ''))
+
+    return Response(stream(), mimetype='application/x-ndjson')
 
 
 @app.route('/convert-str/<output>', methods=['POST'])
@@ -64,5 +126,20 @@ def get_properties(property_type):
         return str(avogadro.atom_count(data, input_format))
 
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Report the state of the workers of the service
+
+    When run by gunicorn with gunicorn.conf.py, this includes the number of
+    workers, how many are busy with a request, and the number of
+    connections queued for a free worker ("queued", null if unknown).
+
+    Curl example:
+    curl 'http://localhost:5001/healthz'
+    """
+    health = app.config.get('HEALTH')
+    return jsonify(health() if health else {'status': 'ok'})
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0')
@@ -0,0 +1,207 @@
+# Production configuration of gunicorn for the Flask services, for example:
+#
+#   cd flask/openbabel/src
+#   gunicorn -c ../../gunicorn.conf.py server:app -b 0.0.0.0:5000
+#
+# Open Babel and Avogadro don't release the python GIL while their C++ code
+# runs, and can crash on bad input, so requests are handled by a pool of
+# preforked sync worker processes:
+#
+# - The pool is sized to the number of cores.
+# - A worker that takes longer than TIMEOUT seconds on a request, or uses
+#   more than CPU_LIMIT seconds of CPU time on it, is killed and replaced,
+#   rather than being tied up for the length of the request.
+# - Workers are recycled after about MAX_REQUESTS requests, which bounds the
+#   memory that Open Babel and Avogadro can leak.
+# - Requests are in the interactive lane, or in the bulk lane if their
+#   X-Request-Lane header says so. Bulk requests (3D coordinate generation,
+#   orbital prefetching, ...) may only take BULK_WORKERS of the workers, so
+#   that the others are free for interactive requests. Bulk requests beyond
+#   that are answered with 503 and a Retry-After of BULK_RETRY_AFTER
+#   seconds, and retried by the client.
+# - /healthz reports the number of busy workers in each lane, and the number
+#   of connections queued for a free worker.
+#
+# All of these can be set with environment variables of the same name.
+
+import multiprocessing
+import os
+import resource
+
+workers = int(os.environ.get('WORKERS', multiprocessing.cpu_count()))
+worker_class = 'sync'
+
+# Wall clock time, enforced by the gunicorn master
+timeout = int(os.environ.get('TIMEOUT', 600))
+graceful_timeout = 30
+
+# CPU time per request, enforced by the kernel (SIGXCPU)
+cpu_limit = int(os.environ.get('CPU_LIMIT', 300))
+
+max_requests = int(os.environ.get('MAX_REQUESTS', 500))
+max_requests_jitter = max_requests // 10
+
+LANE_HEADER = 'X-REQUEST-LANE'
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+LANES = [INTERACTIVE, BULK]
+
+# By default a quarter of the workers are kept for interactive requests
+bulk_workers = int(os.environ.get('BULK_WORKERS',
+                                  max(1, workers - max(1, workers // 4))))
+bulk_retry_after = int(os.environ.get('BULK_RETRY_AFTER', 2))
+
+# The pids of the workers that are handling a request, and the index in
+# LANES of the lane of each request. Created before the workers are forked,
+# so that they all share them.
+MAX_WORKERS = 256
+_busy = multiprocessing.Array('i', MAX_WORKERS, lock=False)
+_lanes = multiprocessing.Array('i', MAX_WORKERS, lock=False)
+_rejected = multiprocessing.Array('i', len(LANES), lock=False)
+_lock = multiprocessing.Lock()
+
+
+def _busy_count(lane):
+    return sum(1 for i in range(MAX_WORKERS)
+               if _busy[i] != 0 and _lanes[i] == LANES.index(lane))
+
+
+def _admit(pid, lane):
+    # Mark the worker busy with a request in lane. Returns False, without
+    # marking it, if the lane has no room for it.
+    with _lock:
+        if lane == BULK and _busy_count(BULK) >= bulk_workers:
+            _rejected[LANES.index(lane)] += 1
+            return False
+
+        for i in range(MAX_WORKERS):
+            if _busy[i] == 0:
+                _busy[i] = pid
+                _lanes[i] = LANES.index(lane)
+                break
+
+    return True
+
+
+def _release(pid):
+    with _lock:
+        for i in range(MAX_WORKERS):
+            if _busy[i] == pid:
+                _busy[i] = 0
+
+
+def _lane(req):
+    for name, value in req.headers:
+        if name == LANE_HEADER and value.lower() in LANES:
+            return value.lower()
+
+    return INTERACTIVE
+
+
+def _listen_ports(cfg):
+    ports = set()
+    for address in cfg.bind:
+        port = address.rsplit(':', 1)[-1]
+        if port.isdigit():
+            ports.add(int(port))
+
+    return ports
+
+
+def _queued(ports):
+    # For listening sockets, the receive queue in /proc/net/tcp is the
+    # number of connections waiting to be accepted. Returns None if it
+    # isn't available (not on Linux).
+    queued = None
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+
+        for line in lines:
+            fields = line.split()
+            port = int(fields[1].rsplit(':', 1)[-1], 16)
+            # 0A is the LISTEN state
+            if fields[3] == '0A' and port in ports:
+                rx_queue = int(fields[4].split(':')[1], 16)
+                queued = (queued or 0) + rx_queue
+
+    return queued
+
+
+def post_worker_init(worker):
+    ports = _listen_ports(worker.cfg)
+
+    def health():
+        return {
+            'status': 'ok',
+            'workers': worker.cfg.workers,
+            'busy': sum(1 for pid in _busy[:] if pid != 0),
+            'queued': _queued(ports),
+            'lanes': {
+                lane: {
+                    'busy': _busy_count(lane),
+                    'rejected': _rejected[LANES.index(lane)]
+                }
+                for lane in LANES
+            },
+            'bulkWorkers': bulk_workers,
+            'worker': {
+                'pid': worker.pid,
+                'requests': worker.nr,
+                'maxRequests': worker.max_requests
+            }
+        }
+
+    # The services report this at /healthz
+    app = worker.wsgi
+    app.config['HEALTH'] = health
+
+    def admission(environ, start_response):
+        if worker.rejected:
+            headers = [
+                ('Content-Type', 'text/plain'),
+                ('Retry-After', str(bulk_retry_after))
+            ]
+            start_response('503 Service Unavailable', headers)
+            return [b'The bulk lane is full, retry later.\n']
+
+        return app(environ, start_response)
+
+    worker.rejected = False
+    worker.wsgi = admission
+
+
+def pre_request(worker, req):
+    worker.rejected = not _admit(worker.pid, _lane(req))
+    if worker.rejected:
+        return
+
+    # RLIMIT_CPU counts the CPU time of the whole process, so the limit
+    # for this request is on top of what the worker has used so far.
+    if cpu_limit > 0:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = int(usage.ru_utime + usage.ru_stime)
+        hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+        soft = used + cpu_limit
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def post_request(worker, req, environ, resp):
+    if worker.rejected:
+        return
+
+    if cpu_limit > 0:
+        hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+    _release(worker.pid)
+
+
+def child_exit(server, worker):
+    # A worker that was killed during a request is no longer busy
+    _release(worker.pid)
@@ -1,10 +1,28 @@
-from openbabel import OBMol, OBConversion, pybel
+from openbabel import OBMol, OBConversion, OBSmartsPattern, pybel
 
+import base64
 import re
+import struct
+import threading
 
 inchi_validator = re.compile('InChI=[0-9]S?\\/')
 
 
+_local = threading.local()
+
+
+# Each worker keeps a single OBConversion around and reuses it for every
+# conversion it performs. Options that are added to it must be removed
+# again once the conversion is done.
+def get_conversion():
+    conv = getattr(_local, 'conv', None)
+    if conv is None:
+        conv = OBConversion()
+        _local.conv = conv
+
+    return conv
+
+
 # This function only validates the first part. It does not guarantee
 # that the entire InChI is valid.
 def validate_start_of_inchi(inchi):
@@ -26,7 +44,7 @@ def convert_str(str_data, in_format, out_format, gen3d=False,
         out_options = {}
 
     obMol = OBMol()
-    conv = OBConversion()
+    conv = get_conversion()
     conv.SetInFormat(in_format)
     conv.SetOutFormat(out_format)
     conv.ReadString(obMol, str_data)
@@ -46,19 +64,26 @@ def convert_str(str_data, in_format, out_format, gen3d=False,
     for option, value in out_options.items():
         conv.AddOption(option, conv.OUTOPTIONS, value)
 
-    return (conv.WriteString(obMol), conv.GetOutFormat().GetMIMEType())
+    try:
+        return (conv.WriteString(obMol), conv.GetOutFormat().GetMIMEType())
+    finally:
+        for option in out_options:
+            conv.RemoveOption(option, conv.OUTOPTIONS)
 
 
 def to_inchi(str_data, in_format):
     mol = OBMol()
-    conv = OBConversion()
+    conv = get_conversion()
     conv.SetInFormat(in_format)
     conv.ReadString(mol, str_data)
 
     conv.SetOutFormat('inchi')
     inchi = conv.WriteString(mol).rstrip()
-    conv.SetOptions('K', conv.OUTOPTIONS)
-    inchikey = conv.WriteString(mol).rstrip()
+    conv.AddOption('K', conv.OUTOPTIONS)
+    try:
+        inchikey = conv.WriteString(mol).rstrip()
+    finally:
+        conv.RemoveOption('K', conv.OUTOPTIONS)
 
     return (inchi, inchikey)
 
@@ -75,7 +100,7 @@ def to_smiles(str_data, in_format):
 
 def atom_count(str_data, in_format):
     mol = OBMol()
-    conv = OBConversion()
+    conv = get_conversion()
     conv.SetInFormat(in_format)
     conv.ReadString(mol, str_data)
 
@@ -90,7 +115,7 @@ def get_formula(str_data, in_format):
     # Get the molecule using the "Hill Order" - i. e., C first, then H,
     # and then alphabetical.
     mol = OBMol()
-    conv = OBConversion()
+    conv = get_conversion()
     conv.SetInFormat(in_format)
     conv.ReadString(mol, str_data)
 
@@ -105,23 +130,122 @@ def properties(str_data, in_format, add_hydrogens=False):
         str_data = 'InChI=' + str_data
         validate_start_of_inchi(str_data)
     mol = OBMol()
-    conv = OBConversion()
+    conv = get_conversion()
     conv.SetInFormat(in_format)
     conv.ReadString(mol, str_data)
 
     if add_hydrogens:
         mol.AddHydrogens()
 
+    return _mol_properties(mol)
+
+
+def _mol_properties(mol, ones=False):
+    # ones includes the counts of 1 in the spaced formula, as in "C 1 H 4 O 1"
     props = {}
     props['atomCount'] = mol.NumAtoms()
     props['formula'] = mol.GetFormula()
     props['heavyAtomCount'] = mol.NumHvyAtoms()
     props['mass'] = mol.GetMolWt()
-    props['spacedFormula'] = mol.GetSpacedFormula()
+    props['spacedFormula'] = mol.GetSpacedFormula(1 if ones else 0)
 
     return props
 
 
+def ingest(str_data, in_format, add_hydrogens=True):
+    # Returns a dict with everything that is needed to create a new
+    # molecule: the inchi, inchikey, canonical smiles, properties and the
+    # FP2 fingerprint. The input is only parsed once. Every element of the
+    # spaced formula has a count, for the atom counts of the molecule.
+    if in_format.lower() == 'inchi':
+        validate_start_of_inchi(str_data)
+
+    mol = OBMol()
+    conv = get_conversion()
+    conv.SetInFormat(in_format)
+    conv.ReadString(mol, str_data)
+
+    conv.SetOutFormat('inchi')
+    inchi = conv.WriteString(mol).rstrip()
+    conv.AddOption('K', conv.OUTOPTIONS)
+    try:
+        inchikey = conv.WriteString(mol).rstrip()
+    finally:
+        conv.RemoveOption('K', conv.OUTOPTIONS)
+
+    # See to_smiles() for why we split the smiles
+    conv.SetOutFormat('can')
+    smiles = conv.WriteString(mol).strip()
+    smiles = smiles.split()[0] if smiles else smiles
+
+    # Compute this before adding hydrogens, so that it matches the
+    # fingerprint of the same molecule given as smiles.
+    fp = _mol_fingerprint(mol, 'FP2')
+
+    if add_hydrogens:
+        mol.AddHydrogens()
+
+    return {
+        'inchi': inchi,
+        'inchikey': inchikey,
+        'smiles': smiles,
+        'properties': _mol_properties(mol, ones=True),
+        'fingerprint': fp,
+        'fingerprintType': 'FP2'
+    }
+
+
+def _mol_fingerprint(mol, fp_type):
+    # Open Babel gives us the fingerprint as a list of 32 bit words. Pack
+    # them into little endian bytes, and base64 encode them for json.
+    fp = pybel.Molecule(mol).calcfp(fp_type).fp
+    packed = struct.pack('<%dI' % len(fp), *fp)
+    return base64.b64encode(packed).decode()
+
+
+def fingerprint(str_data, in_format, fp_type='FP2'):
+    # Returns a dict with the base64 encoded, bit packed fingerprint,
+    # along with its type and number of bits.
+    if in_format.lower() == 'inchi':
+        validate_start_of_inchi(str_data)
+
+    mol = OBMol()
+    conv = get_conversion()
+    conv.SetInFormat(in_format)
+    conv.ReadString(mol, str_data)
+
+    fp = _mol_fingerprint(mol, fp_type)
+    return {
+        'fingerprint': fp,
+        'fingerprintType': fp_type,
+        'fingerprintBits': len(base64.b64decode(fp)) * 8
+    }
+
+
+def substructure_match(pattern, targets, in_format='smi'):
+    # Returns a list with a bool for each of the targets, which is True if
+    # the target contains the pattern. The pattern is SMARTS, which most
+    # SMILES are also valid as. A target that can't be read doesn't match.
+    smarts = OBSmartsPattern()
+    if not smarts.Init(pattern):
+        raise Exception('Invalid pattern: "' + pattern + '"')
+
+    conv = get_conversion()
+    conv.SetInFormat(in_format)
+
+    matches = []
+    for target in targets:
+        mol = OBMol()
+        if not target or not conv.ReadString(mol, target):
+            matches.append(False)
+            continue
+
+        # Stop at the first match, we don't need all of them
+        matches.append(bool(smarts.Match(mol, True)))
+
+    return matches
+
+
 def to_svg(str_data, in_format):
     out_options = {
         'b': 'none',  # transparent background color
@@ -26,6 +26,10 @@ def convert(output_format):
             svg: returns the SVG
             smi: returns canonical smiles
             inchi: returns json containing "inchi" and "inchikey"
+            fingerprint: returns json containing "fingerprint" (base64
+                         encoded and bit packed), "fingerprintType" and
+                         "fingerprintBits". The type may be set with the
+                         "fingerprintType" option (default: FP2).
 
     Curl example:
     curl -X POST 'http://localhost:5000/convert/inchi' \
@@ -36,36 +40,98 @@ def convert(output_format):
     input_format = json_data['format']
     data = json_data['data']
 
+    result = _convert(data, input_format, output_format, json_data)
+    if isinstance(result, dict):
+        return jsonify(result)
+
+    data, mime = result
+    return Response(data, mimetype=mime)
+
+
+@app.route('/convert-batch/<output_format>', methods=['POST'])
+def convert_batch(output_format):
+    """Convert a list of molecules from one format to another
+
+    The output format is specified in the path, and applies to every
+    molecule in the batch. The body is json containing the key
+    "molecules", a list of records. Each record has the keys "format"
+    and "data", and may contain an "options" dict that accepts the
+    same options as /convert/<output_format>.
+
+    Returns json containing "results", a list in the same order as
+    "molecules". Each entry contains "data" and "mime", or the json
+    that /convert/<output_format> returns for the inchi and fingerprint
+    output formats. If a record could not be
+    converted, its entry contains "error" instead, and the remaining
+    records are still converted.
+
+    Curl example:
+    curl -X POST 'http://localhost:5000/convert-batch/inchi' \
+      -H "Content-Type: application/json" \
+      -d '{"molecules": [{"format": "smiles", "data": "CCO"},
+                         {"format": "smiles", "data": "CC"}]}'
+    """
+    json_data = request.get_json()
+    records = json_data.get('molecules')
+    if not isinstance(records, list):
+        return Response('"molecules" must be a list', status=400)
+
+    results = []
+    for record in records:
+        try:
+            options = record.get('options', {})
+            result = _convert(record['data'], record['format'],
+                              output_format, options)
+            if not isinstance(result, dict):
+                data, mime = result
+                result = {
+                    'data': data,
+                    'mime': mime
+                }
+        except Exception as e:
+            result = {
+                'error': str(e)
+            }
+
+        results.append(result)
+
+    return jsonify({'results': results})
+
+
+def _convert(data, input_format, output_format, options):
+    # Returns either a dict (for inchi) or a tuple of (data, mime)
+
     # Treat special cases with special functions
     out_lower = output_format.lower()
     if out_lower == 'svg':
-        data, mime = openbabel.to_svg(data, input_format)
+        return openbabel.to_svg(data, input_format)
     elif out_lower in ['smiles', 'smi']:
-        data, mime = openbabel.to_smiles(data, input_format)
+        return openbabel.to_smiles(data, input_format)
     elif out_lower == 'inchi':
         inchi, inchikey = openbabel.to_inchi(data, input_format)
-        d = {
+        return {
             'inchi': inchi,
             'inchikey': inchikey
         }
-        return jsonify(d)
-    else:
-        # Check for a few specific arguments
-        gen3d = json_data.get('gen3d', False)
-        add_hydrogens = json_data.get('addHydrogens', False)
-        perceive_bonds = json_data.get('perceiveBonds', False)
-        out_options = json_data.get('outOptions', {})
-        gen3d_forcefield = json_data.get('gen3dForcefield', 'mmff94')
-        gen3d_steps = json_data.get('gen3dSteps', 100)
-
-        data, mime = openbabel.convert_str(data, input_format, output_format,
-                                           gen3d=gen3d,
-                                           add_hydrogens=add_hydrogens,
-                                           perceive_bonds=perceive_bonds,
-                                           out_options=out_options,
-                                           gen3d_forcefield=gen3d_forcefield,
-                                           gen3d_steps=gen3d_steps)
-    return Response(data, mimetype=mime)
+    elif out_lower == 'fingerprint':
+        fp_type = options.get('fingerprintType', 'FP2')
+        return openbabel.fingerprint(data, input_format, fp_type)
+
+    # Check for a few specific arguments
+    gen3d = options.get('gen3d', False)
+    add_hydrogens = options.get('addHydrogens', False)
+    perceive_bonds = options.get('perceiveBonds', False)
+    out_options = options.get('outOptions', {})
+    gen3d_forcefield = options.get('gen3dForcefield', 'mmff94')
+    gen3d_steps = options.get('gen3dSteps', 100)
+
+    return openbabel.convert_str(data, input_format, output_format,
+                                 gen3d=gen3d,
+                                 add_hydrogens=add_hydrogens,
+                                 perceive_bonds=perceive_bonds,
+                                 out_options=out_options,
+                                 gen3d_forcefield=gen3d_forcefield,
+                                 gen3d_steps=gen3d_steps)
 
 
 @app.route('/properties', methods=['POST'])
@@ -96,5 +162,81 @@ def properties():
     props = openbabel.properties(data, input_format, add_hydrogens)
     return jsonify(props)
 
+
+@app.route('/ingest', methods=['POST'])
+def ingest():
+    """Get everything needed to create a molecule in a single call
+
+    The input format and the data are specified in the body (in json
+    format) as the keys "format" and "data", respectively. The input
+    is only parsed once.
+
+    There is additionally one option, listed below, that can be added
+    as a key to the json.
+
+        addHydrogens (bool): should we add hydrogens for the properties?
+                             (default: true)
+
+    Returns json containing "inchi", "inchikey", "smiles" (canonical),
+    "properties" (the same as returned by /properties, except that the
+    spaced formula includes counts of 1, as in "C 1 H 4 O 1"), and
+    "fingerprint" (the base64 encoded FP2 fingerprint, see
+    /convert/fingerprint).
+
+    Curl example:
+    curl -X POST 'http://localhost:5000/ingest' \
+      -H "Content-Type: application/json" \
+      -d '{"format": "smiles", "data": "CCO"}'
+    """
+    json_data = request.get_json()
+    input_format = json_data['format']
+    data = json_data['data']
+    add_hydrogens = json_data.get('addHydrogens', True)
+
+    return jsonify(openbabel.ingest(data, input_format, add_hydrogens))
+
+
+@app.route('/substructure', methods=['POST'])
+def substructure():
+    """Check which molecules contain a substructure
+
+    The body (in json format) contains the substructure as "pattern",
+    which is SMARTS (most SMILES are also valid SMARTS), and a list of
+    molecules to check as "molecules". The format of the molecules may
+    be set with "format" (default: smi).
+
+    Returns json containing "matches", a list in the same order as
+    "molecules", that is true for each molecule that contains the
+    substructure.
+
+    Curl example:
+    curl -X POST 'http://localhost:5000/substructure' \
+      -H "Content-Type: application/json" \
+      -d '{"pattern": "C(=O)O", "molecules": ["CC(=O)O", "CCO"]}'
+    """
+    json_data = request.get_json()
+    pattern = json_data['pattern']
+    molecules = json_data['molecules']
+    input_format = json_data.get('format', 'smi')
+
+    matches = openbabel.substructure_match(pattern, molecules, input_format)
+    return jsonify({'matches': matches})
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Report the state of the workers of the service
+
+    When run by gunicorn with gunicorn.conf.py, this includes the number of
+    workers, how many are busy with a request, and the number of
+    connections queued for a free worker ("queued", null if unknown).
+
+    Curl example:
+    curl 'http://localhost:5000/healthz'
+    """
+    health = app.config.get('HEALTH')
+    return jsonify(health() if health else {'status': 'ok'})
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0')
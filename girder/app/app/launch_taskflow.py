@@ -1,30 +1,67 @@
 import os
 import sys
 
+import cherrypy
+
 from girder.api import access
 from girder.api.describe import autoDescribeRoute, Description
-from girder.api.rest import getCurrentUser, getBodyJson, RestException
+from girder.api.rest import getApiUrl, getCurrentUser, getBodyJson, \
+    RestException
 from girder.constants import TokenScope
 
 from cumulus.taskflow import load_class
 from cumulus_plugin.models.cluster import Cluster as ClusterModel
+from molecules.models.calculation import Calculation as CalculationModel
 from queues.models.queue import Queue as QueueModel, QueueType
+from queues.models.queue import default_max_running
 from taskflow.models.taskflow import Taskflow as TaskflowModel
 
 
 @access.user(scope=TokenScope.DATA_WRITE)
 @autoDescribeRoute(
     Description('Launch a taskflow.')
+    .notes('If the taskflow input describes a calculation that was already '
+           'run, or is running, with the same image digest, parameters and '
+           'geometry, no taskflow is launched, and the response is a 303 '
+           'to that calculation. Pending calculations older than the '
+           'molecules.pending_calculation.timeout setting (hours) are not '
+           'reused. Set "reuse" to false in the body to always launch the '
+           'taskflow.')
     .param('body',
-           'Contains "taskFlowBody" and "taskFlowInput" for the taskflow and task',
+           'Contains "taskFlowBody" and "taskFlowInput" for the taskflow and task, '
+           'and optionally the "priority" of the taskflow in the queue',
            paramType='body')
 )
 def launch_taskflow_endpoint():
     user = getCurrentUser()
     body = getBodyJson()
+
+    if body.get('reuse', True):
+        calc = find_identical_calculation(user, body.get('taskFlowInput'))
+        if calc is not None:
+            cherrypy.response.status = 303
+            cherrypy.response.headers['Location'] \
+                = '%s/calculations/%s' % (getApiUrl(), calc['_id'])
+
+            return CalculationModel().filter(calc, user)
+
     return launch_taskflow(user, body)
 
 
+def find_identical_calculation(user, taskFlowInput):
+    # A calculation taskflow runs the input parameters on the geometry with
+    # the given hash, in a docker image. Returns the completed or pending
+    # calculation that was run with the same three, if there is one.
+    if not isinstance(taskFlowInput, dict):
+        return None
+
+    calc_input = taskFlowInput.get('input') or {}
+
+    return CalculationModel().find_identical(
+        taskFlowInput.get('image'), calc_input.get('parameters'),
+        calc_input.get('geometryHash'), user=user)
+
+
 def launch_taskflow(user, body):
     # Perform some validation
     taskFlowBody = body.get('taskFlowBody')
@@ -44,6 +81,10 @@ def launch_taskflow(user, body):
               (taskflow_class, ex)
         raise RestException(msg, 400)
 
+    priority = body.get('priority', 0)
+    if not isinstance(priority, int):
+        raise RestException('priority must be an integer', 400)
+
     # Set up the taskflow input
     taskFlowInput = body.get('taskFlowInput', {})
     if 'cluster' not in taskFlowInput:
@@ -60,7 +101,7 @@ def launch_taskflow(user, body):
     taskflow = TaskflowModel().create(user, taskFlowBody)
 
     # Add it to the queue and start it
-    QueueModel().add(queue, taskflow, taskFlowInput, user)
+    QueueModel().add(queue, taskflow, taskFlowInput, user, priority)
     QueueModel().pop(queue, limit=sys.maxsize, user=user)
 
     return taskflow['_id']
@@ -78,7 +119,9 @@ def fetch_or_create_queue(user):
         queue = queues[0]
     else:
         type = QueueType.FIFO
-        queue = QueueModel().create(name, type_=type, max_running=5, user=user)
+        queue = QueueModel().create(name, type_=type,
+                                    max_running=default_max_running(),
+                                    user=user)
 
     return queue
 
@@ -34,6 +34,12 @@ class Image(Resource):
         .param('clusterId', 'Cluster the image is on', required=False)
         .param('unique', 'Unique repository:tag combinations only',
                dataType='boolean', default=False, required=False)
+        .param('count', 'How to count the matches: exact (default), cached, '
+               'capped, estimated or none', required=False,
+               enum=['exact', 'cached', 'capped', 'estimated', 'none'])
+        .param('cursor', 'Continue after this cursor, which is the "next" of '
+               'the previous page, instead of using the offset',
+               required=False)
         .pagingParams(defaultSort='_id',
                       defaultSortDir=SortDir.DESCENDING,
                       defaultLimit=25)
@@ -6,6 +6,10 @@ from girder.exceptions import ValidationException
 from girder.models.model_base import AccessControlledModel
 
 from app.launch_taskflow import launch_taskflow
+from images.utils.pagination import count_matches
+from images.utils.pagination import keyset_query
+from images.utils.pagination import next_cursor
+from images.utils.pagination import parse_count_params
 from images.utils.pagination import parse_pagination_params
 from images.utils.pagination import search_results_dict
 
@@ -37,6 +41,9 @@ class Image(AccessControlledModel):
             params = {}
 
         limit, offset, sort = parse_pagination_params(params)
+        count, cursor = parse_count_params(params)
+        if cursor is not None:
+            offset = 0
 
         # This is for query fields that can just be copied over directly
         query_fields = ['repository', 'tag', 'digest', 'clusterId']
@@ -55,12 +62,15 @@ class Image(AccessControlledModel):
             return self._find_unique_images(query, fields, limit, offset,
                                             sort, user)
 
-        cursor = self.findWithPermissions(query, fields=fields, limit=limit,
+        images = self.findWithPermissions(keyset_query(query, cursor, sort),
+                                          fields=fields, limit=limit,
                                           offset=offset, sort=sort,
                                           user=user)
-        num_matches = cursor.collection.count_documents(query)
-        images = [x for x in cursor]
-        return search_results_dict(images, num_matches, limit, offset, sort)
+        images = [x for x in images]
+        num_matches, exact = count_matches(self.collection, query, count,
+                                           offset)
+        return search_results_dict(images, num_matches, limit, offset, sort,
+                                   exact, next_cursor(images, limit, sort))
 
     def _find_unique_images(self, query, fields, limit, offset, sort, user):
         # Get unique combinations of repositories and tags
@@ -3,6 +3,8 @@
 from .molecule import Molecule
 from .calculation import Calculation
 from .experiment import Experiment
+import cherrypy
+
 from girder import events
 from girder.models.model_base import ValidationException
 from girder.utility.model_importer import ModelImporter
@@ -10,10 +12,17 @@ from .constants import PluginSettings
 from girder.utility import setting_utilities
 
 from .models.calculation import Calculation as CalculationModel
+from .models.conversioncache import Conversioncache as ConversioncacheModel
 from .models.cubecache import Cubecache as CubecacheModel
+from .models import cubecache
 from .models.experimental import Experimental as ExperimentalModel
 from .models.geometry import Geometry as GeometryModel
 from .models.molecule import Molecule as MoleculeModel
+from .models.workqueue import Workqueue as WorkqueueModel
+
+from .utilities import conversion_cache
+from .utilities import similarity
+from .utilities import work_queue
 
 from girder.plugin import GirderPlugin
 
@@ -35,6 +44,60 @@ def validateSettings(event):
     pass
 
 
+@setting_utilities.validator({
+    PluginSettings.OPENBABEL_TIMEOUT,
+    PluginSettings.AVOGADRO_TIMEOUT,
+    PluginSettings.SERVICES_POOL_SIZE,
+    PluginSettings.SERVICES_MAX_WORKERS,
+    PluginSettings.SERVICES_RETRIES,
+    PluginSettings.SERVICES_BACKOFF_FACTOR,
+    PluginSettings.CONVERSION_CACHE_SIZE,
+    PluginSettings.CUBE_CACHE_MAX_SIZE,
+    PluginSettings.ORBITAL_PREFETCH_WINDOW,
+    PluginSettings.WORK_QUEUE_WORKERS,
+    PluginSettings.PENDING_CALCULATION_TIMEOUT
+})
+def validateNumericSettings(doc):
+    try:
+        value = float(doc['value'])
+    except (TypeError, ValueError):
+        raise ValidationException('%s must be a number' % doc['key'], 'value')
+
+    if value < 0:
+        raise ValidationException('%s must not be negative' % doc['key'],
+                                  'value')
+
+
+@setting_utilities.validator({
+    PluginSettings.CONVERSION_CACHE_MONGO,
+    PluginSettings.ORBITAL_PREFETCH
+})
+def validateBooleanSettings(doc):
+    if not isinstance(doc['value'], bool):
+        raise ValidationException('%s must be a boolean' % doc['key'], 'value')
+
+
+@setting_utilities.validator(PluginSettings.PACKED_ARRAYS)
+def validatePackedArraysSetting(doc):
+    if doc['value'] not in (None, '', 'float32', 'float64'):
+        raise ValidationException(
+            '%s must be float32 or float64' % doc['key'], 'value')
+
+
+@setting_utilities.validator(PluginSettings.CUBE_CACHE_EVICTION)
+def validateCubeCacheEvictionSetting(doc):
+    if doc['value'] not in (None, '', 'lru', 'lfu'):
+        raise ValidationException('%s must be lru or lfu' % doc['key'],
+                                  'value')
+
+
+@setting_utilities.validator(PluginSettings.CUBE_RESOLUTION)
+def validateCubeResolutionSetting(doc):
+    if doc['value'] not in (None, '', 'coarse', 'medium', 'fine'):
+        raise ValidationException(
+            '%s must be coarse, medium or fine' % doc['key'], 'value')
+
+
 class MoleculesPlugin(GirderPlugin):
     DISPLAY_NAME = 'Molecular Data'
 
@@ -43,14 +106,44 @@ class MoleculesPlugin(GirderPlugin):
         # Register models for ModelImporter
         ModelImporter.registerModel('calculation', CalculationModel,
                                     'molecules')
+        ModelImporter.registerModel('conversioncache', ConversioncacheModel,
+                                    'molecules')
         ModelImporter.registerModel('cubecache', CubecacheModel, 'molecules')
         ModelImporter.registerModel('experimental', ExperimentalModel,
                                     'molecules')
         ModelImporter.registerModel('geometry', GeometryModel, 'molecules')
         ModelImporter.registerModel('molecule', MoleculeModel, 'molecules')
+        ModelImporter.registerModel('workqueue', WorkqueueModel, 'molecules')
+
+        # Before the cube cache is first used, which builds its indices
+        cubecache.migrate()
 
         info['apiRoot'].molecules = Molecule()
         info['apiRoot'].calculations = Calculation()
         info['apiRoot'].experiments = Experiment()
         events.bind('model.setting.validate', 'molecules',
                     validateSettings)
+
+        # Drop cached conversions of cjson that has changed
+        for collection in ('molecules', 'geometry', 'calculations'):
+            events.bind('model.%s.save' % collection,
+                        'molecules.conversion_cache',
+                        conversion_cache.on_cjson_saving)
+            for event in ('save.after', 'remove'):
+                events.bind('model.%s.%s' % (collection, event),
+                            'molecules.conversion_cache',
+                            conversion_cache.on_cjson_changed)
+
+        # Keep the similarity search index up to date
+        events.bind('model.molecules.save.after', 'molecules.similarity',
+                    similarity.on_molecule_saved)
+        events.bind('model.molecules.remove', 'molecules.similarity',
+                    similarity.on_molecule_removed)
+
+        # Pending calculations created before identical submissions were
+        # coalesced
+        CalculationModel().migrate_in_flight()
+
+        # Run the background jobs of the work queue while the server is up
+        cherrypy.engine.subscribe('start', work_queue.start)
+        cherrypy.engine.subscribe('stop', work_queue.stop)
@@ -1,5 +1,4 @@
 import json
-import requests
 
 from avogadro.core import Molecule
 from avogadro.io import FileFormatManager
@@ -9,6 +8,8 @@ from girder.models.setting import Setting
 from jsonpath_rw import parse
 
 from molecules.constants import PluginSettings
+from molecules.utilities import sessions
+from molecules.utilities.sessions import Lanes, Services
 
 
 def avogadro_base_url():
@@ -19,7 +20,7 @@ def avogadro_base_url():
     return base_url
 
 
-def convert_str(str_data, in_format, out_format):
+def convert_str(str_data, in_format, out_format, lane=Lanes.INTERACTIVE):
     base_url = avogadro_base_url()
     path = 'convert-str'
     url = '/'.join([base_url, path, out_format])
@@ -29,7 +30,7 @@ def convert_str(str_data, in_format, out_format):
         'data': str_data,
     }
 
-    r = requests.post(url, json=data)
+    r = sessions.post(Services.AVOGADRO, url, lane=lane, json=data)
     r.raise_for_status()
 
     return r.text
@@ -45,7 +46,8 @@ def atom_count(str_data, in_format):
         'data': str_data,
     }
 
-    r = requests.post(url, json=data)
+    r = sessions.post(Services.AVOGADRO, url, lane=Lanes.INTERACTIVE,
+                      json=data)
     r.raise_for_status()
 
     return int(r.text)
@@ -61,7 +63,8 @@ def molecule_properties(str_data, in_format):
         'data': str_data,
     }
 
-    r = requests.post(url, json=data)
+    r = sessions.post(Services.AVOGADRO, url, lane=Lanes.INTERACTIVE,
+                      json=data)
     r.raise_for_status()
 
     return r.json()
@@ -139,7 +142,7 @@ def calculation_properties(json_data):
     return properties
 
 
-def calculate_mo(cjson, mo):
+def calculate_mo(cjson, mo, resolution=None, lane=Lanes.INTERACTIVE):
     base_url = avogadro_base_url()
     path = 'calculate-mo'
     url = '/'.join([base_url, path])
@@ -148,8 +151,41 @@ def calculate_mo(cjson, mo):
         'cjson': cjson,
         'mo': mo,
     }
+    if resolution:
+        data['resolution'] = resolution
 
-    r = requests.post(url, json=data)
+    r = sessions.post(Services.AVOGADRO, url, lane=lane, json=data)
     r.raise_for_status()
 
     return r.json()
+
+
+def calculate_mos(cjson, mos, resolution=None, lane=Lanes.BULK):
+    """Calculate the cubes of several MOs, with one request.
+
+    This is used to calculate cubes ahead of time, so it is in the bulk lane
+    by default.
+
+    Generates (mo, cjson) tuples, as the cubes are calculated.
+    """
+    base_url = avogadro_base_url()
+    path = 'calculate-mos'
+    url = '/'.join([base_url, path])
+
+    data = {
+        'cjson': cjson,
+        'mos': list(mos),
+    }
+    if resolution:
+        data['resolution'] = resolution
+
+    r = sessions.post(Services.AVOGADRO, url, lane=lane, json=data,
+                      stream=True)
+    try:
+        r.raise_for_status()
+        for line in r.iter_lines(chunk_size=64 * 1024):
+            if line:
+                result = json.loads(line)
+                yield result['mo'], result['cjson']
+    finally:
+        r.close()
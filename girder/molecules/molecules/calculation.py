@@ -1,11 +1,8 @@
 import cherrypy
-import tempfile
 from jsonpath_rw import parse
 from bson.objectid import ObjectId
 import json
 
-import openchemistry as oc
-
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.docs import addModel
 from girder.api import access
@@ -19,6 +16,13 @@ from girder.constants import AccessType, SortDir, TokenScope
 from molecules.models.calculation import Calculation as CalculationModel
 from molecules.utilities.molecules import create_molecule
 from molecules.utilities import async_requests
+from molecules.utilities import cjson_stream
+from molecules.utilities import conversion_cache
+from molecules.utilities import cube_cache
+from molecules.utilities import orbital_prefetch
+from molecules.utilities import orbitals
+from molecules.utilities import packed_arrays
+from molecules.utilities import raw_cube
 
 from . import avogadro
 from . import openbabel
@@ -38,6 +42,7 @@ class Calculation(Resource):
         self.route('DELETE', (':id',), self.delete)
         self.route('GET', (), self.find_calc)
         self.route('GET', ('types',), self.find_calc_types)
+        self.route('GET', ('cubes', 'cache'), self.get_cube_cache_stats)
         self.route('GET', (':id', 'vibrationalmodes'),
             self.get_calc_vibrational_modes)
         self.route('GET', (':id', 'vibrationalmodes', ':mode'),
@@ -50,6 +55,8 @@ class Calculation(Resource):
             self.get_calc_xyz)
         self.route('GET', (':id', 'cube', ':mo'),
             self.get_calc_cube)
+        self.route('GET', (':id', 'cube', ':mo', 'raw'),
+            self.get_calc_cube_raw)
         self.route('GET', (':id',),
             self.find_id)
         self.route('PUT', (':id', 'properties'),
@@ -70,6 +77,7 @@ class Calculation(Resource):
                                  level=AccessType.READ)
 
         del calc['access']
+        self._model.expand_cjson(calc)
 
         if 'cjson' in calc and 'vibrations' in calc['cjson']:
             return calc['cjson']['vibrations']
@@ -126,8 +134,15 @@ class Calculation(Resource):
         }
 
         mode = self._model.findOne(query, fields=projection)
+        vibrations = mode['cjson']['vibrations']
+
+        # $slice doesn't apply to packed arrays, select the row from the data
+        eigen_vectors = vibrations.get('eigenVectors')
+        if packed_arrays.is_packed(eigen_vectors):
+            vibrations['eigenVectors'] = packed_arrays.unpack_rows(
+                eigen_vectors, index, 1, self._model.database)
 
-        return mode['cjson']['vibrations']
+        return vibrations
 
     get_calc_vibrational_mode.description = (
         Description('Get a vibrational mode associated with a calculation')
@@ -160,6 +175,7 @@ class Calculation(Resource):
     @access.public
     @loadmodel(model='calculation', plugin='molecules', level=AccessType.READ)
     def get_calc_cjson(self, calculation, params):
+        self._model.expand_cjson(calculation)
         return calculation['cjson']
 
     get_calc_cjson.description = (
@@ -172,8 +188,10 @@ class Calculation(Resource):
     @access.public
     @loadmodel(model='calculation', plugin='molecules', level=AccessType.READ)
     def get_calc_xyz(self, calculation, params):
-        data = json.dumps(calculation['cjson'])
-        data = avogadro.convert_str(data, 'cjson', 'xyz')
+        self._model.expand_cjson(calculation)
+        data = conversion_cache.convert_cjson(calculation['cjson'], 'xyz',
+                                              calculation['_id'],
+                                              calculation.get('updated'))
 
         def stream():
             cherrypy.response.headers['Content-Type'] = Molecule.mime_types['xyz']
@@ -188,72 +206,128 @@ class Calculation(Resource):
             'The id of the calculation to return the structure for.',
             dataType='string', required=True, paramType='path'))
 
-    @access.public
-    def get_calc_cube(self, id, mo, params):
-        orig_mo = mo
+    def _parse_mo(self, id, mo):
+        # Get the index of the orbital mo, which can also be 'homo' or 'lumo'
         try:
-            mo = int(mo)
+            return int(mo)
         except ValueError:
             # Check for homo lumo
             mo = mo.lower()
             if mo in ['homo', 'lumo']:
                 cal = self._model.load(id, force=True)
-                # Electron count might be saved in several places...
-                path_expressions = [
-                    'cjson.orbitals.electronCount',
-                    'cjson.basisSet.electronCount',
-                    'properties.electronCount'
-                ]
-                matches = []
-                for expr in path_expressions:
-                    matches.extend(parse(expr).find(cal))
-                if len(matches) > 0:
-                    electron_count = matches[0].value
-                else:
+                indices = orbitals.homo_lumo(cal)
+                if indices is None:
                     raise RestException('Unable to access electronCount', 400)
 
-                # The index of the first orbital is 0, so homo needs to be
-                # electron_count // 2 - 1
-                if mo == 'homo':
-                    mo = int(electron_count / 2) - 1
-                elif mo == 'lumo':
-                    mo = int(electron_count / 2)
+                return indices[0] if mo == 'homo' else indices[1]
             else:
                 raise ValidationException('mo number be an integer or \'homo\'/\'lumo\'', 'mode')
 
-        cached = self._cube_model.find_mo(id, mo)
-
-        # If we have a cached cube file use that.
-        if cached:
-            return cached['cjson']
-
+    def _load_for_cube(self, id):
         fields = ['cjson', 'access', 'fileId']
 
         # Ignoring access control on file/data for now, all public.
         calc = self._model.load(id, fields=fields, force=True)
+        return self._model.expand_cjson(calc)
 
-        # This is where the cube gets calculated, should be cached in future.
-        if ('async' in params) and (params['async']):
-            async_requests.schedule_orbital_gen(
-                calc['cjson'], mo, id, orig_mo, self.getCurrentUser())
-            calc['cjson']['cube'] = {
-                'dimensions': [0, 0, 0],
-                'scalars': [],
-                'origin': [0, 0, 0],
-                'spacing': [1, 1, 1]
+    def _calculate_cube(self, id, mo, resolution=None):
+        cjson = avogadro.calculate_mo(self._load_for_cube(id)['cjson'], mo,
+                                      resolution)
+
+        # Remove the vibrational mode data from the cube - big, not needed here.
+        if 'vibrations' in cjson:
+            del cjson['vibrations']
+
+        return cjson
+
+    def _parse_resolution(self, params):
+        resolution = params.get('resolution') or cube_cache.default_resolution()
+        if resolution not in cube_cache.RESOLUTIONS:
+            raise RestException('resolution must be one of: %s' %
+                                ', '.join(cube_cache.RESOLUTIONS), 400)
+
+        return resolution
+
+    def _get_cube(self, id, mo, resolution, label=None, projection=None):
+        # Users that asked for the cube asynchronously while it is calculated
+        # here are notified, as they are when it is calculated in the
+        # background
+        def notify(waiters, error):
+            data = {
+                'id': id,
+                'mo': label if label is not None else mo,
+                'resolution': resolution
             }
-            return calc['cjson']
-        else:
-            cjson = avogadro.calculate_mo(calc['cjson'], mo)
+            if error:
+                data['error'] = error
+            async_requests.notify_cube_status(data, waiters)
 
-            # Remove the vibrational mode data from the cube - big, not needed here.
-            if 'vibrations' in cjson:
-                del cjson['vibrations']
+        return cube_cache.get(
+            id, mo, lambda: self._calculate_cube(id, mo, resolution),
+            resolution, notify, projection)
 
-            # Cache this cube for the next time, they can take a while to generate.
-            self._cube_model.create(id, mo, cjson)
+    @access.public
+    def get_calc_cube(self, id, mo, params):
+        orig_mo = mo
+        mo = self._parse_mo(id, mo)
+        resolution = self._parse_resolution(params)
+        progressive = str(params.get('progressive', '')).lower() in ['true', '1']
+
+        # This is where the cube gets calculated, unless it is cached. Only
+        # one request calculates a given cube, the others wait for it.
+        if ('async' in params) and (params['async']):
+            cached = cube_cache.find(id, mo, resolution)
+            if not cached:
+                user = self.getCurrentUser()
+                claimed = cube_cache.claim(id, mo, user, resolution)
+                if not claimed:
+                    # It is being calculated, or was just finished
+                    cached = cube_cache.find(id, mo, resolution)
+
+            if not cached:
+                calc = self._load_for_cube(id)
+                if claimed:
+                    async_requests.schedule_orbital_gen(
+                        calc['cjson'], mo, id, orig_mo, user, resolution)
+                else:
+                    calc['cjson']['generating_orbital'] = True
+                calc['cjson']['cube'] = {
+                    'dimensions': [0, 0, 0],
+                    'scalars': [],
+                    'origin': [0, 0, 0],
+                    'spacing': [1, 1, 1]
+                }
+                return calc['cjson']
+        elif progressive and resolution != cube_cache.PROGRESSIVE_RESOLUTION:
+            cached = cube_cache.find(id, mo, resolution)
+            refining = False
+            if not cached:
+                # Calculate the cube at the resolution that was asked for in
+                # the background, a cube.status notification announces it
+                user = self.getCurrentUser()
+                if cube_cache.claim(id, mo, user, resolution):
+                    calc = self._load_for_cube(id)
+                    async_requests.schedule_orbital_gen(
+                        calc['cjson'], mo, id, orig_mo, user, resolution)
+                    refining = True
+                else:
+                    cached = cube_cache.find(id, mo, resolution)
+                    refining = cached is None
 
-            return cjson
+            if not cached:
+                # Return a coarse cube in the meantime
+                resolution = cube_cache.PROGRESSIVE_RESOLUTION
+                cached = self._get_cube(id, mo, resolution, orig_mo)
+
+            cached['cjson']['generating_orbital'] = refining
+        else:
+            cached = self._get_cube(id, mo, resolution, orig_mo)
+
+        self._cube_model.expand_cjson(cached)
+        if isinstance(cached['cjson'].get('cube'), dict):
+            cached['cjson']['cube']['resolution'] = resolution
+
+        return cached['cjson']
 
     get_calc_cube.description = (
         Description('Get the cube for the supplied MO of the calculation in CJSON format')
@@ -264,7 +338,79 @@ class Calculation(Resource):
         .param(
             'mo',
             'The molecular orbital to get the cube for.',
-            dataType='string', required=True, paramType='path'))
+            dataType='string', required=True, paramType='path')
+        .param(
+            'resolution',
+            'The resolution of the cube: coarse, medium or fine. Defaults to '
+            'the molecules.cube_resolution setting, or medium.',
+            dataType='string', required=False,
+            enum=['coarse', 'medium', 'fine'])
+        .param(
+            'progressive',
+            'If the cube isn\'t cached at the resolution, return a coarse '
+            'cube, and calculate the cube at the resolution in the '
+            'background. A cube.status notification is sent once it is '
+            'ready. cube.resolution is the resolution of the returned cube.',
+            dataType='boolean', required=False, default=False))
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Get the size and hit rate of the cube cache.')
+        .notes('hits, misses and waits are counted by this process since it '
+               'started. storedHits is the total number of hits of the cubes '
+               'that are in the cache. Sizes are in bytes.')
+    )
+    def get_cube_cache_stats(self):
+        return cube_cache.stats()
+
+    @access.public
+    def get_calc_cube_raw(self, id, mo, params):
+        orig_mo = mo
+        mo = self._parse_mo(id, mo)
+        resolution = self._parse_resolution(params)
+
+        # The scalars of a cached cube are read separately, so that they
+        # aren't decoded into a list when they aren't packed
+        projection = {'cjson.cube.scalars': False}
+        cached = self._get_cube(id, mo, resolution, orig_mo, projection)
+        cube = cached['cjson'].get('cube')
+        if isinstance(cube, dict) and 'scalars' not in cube:
+            scalars = self._cube_model.scalars(cached['_id'])
+            if scalars is not None:
+                cube['scalars'] = scalars
+
+        gzip = str(params.get('gzip', '')).lower() in ['true', '1']
+
+        return raw_cube.stream_cube(cube,
+                                    self._cube_model.database, gzip,
+                                    resolution)
+
+    get_calc_cube_raw.description = (
+        Description('Get the cube for the supplied MO of the calculation as '
+                    'binary data')
+        .notes('The response is a JSON header with the dimensions, origin '
+               'and spacing of the cube, ended by a newline and padded to a '
+               'multiple of 4 bytes, followed by the scalars of the cube as '
+               'little endian float32. The X-Cube-Data-Offset header is the '
+               'length of the JSON header. A single HTTP Range is supported.')
+        .param(
+            'id',
+            'The id of the calculation to return the structure for.',
+            dataType='string', required=True, paramType='path')
+        .param(
+            'mo',
+            'The molecular orbital to get the cube for.',
+            dataType='string', required=True, paramType='path')
+        .param(
+            'resolution',
+            'The resolution of the cube: coarse, medium or fine. Defaults to '
+            'the molecules.cube_resolution setting, or medium.',
+            dataType='string', required=False,
+            enum=['coarse', 'medium', 'fine'])
+        .param(
+            'gzip',
+            'Compress the response with gzip. Ignored for Range requests.',
+            dataType='boolean', required=False, default=False))
 
     @access.user(scope=TokenScope.DATA_WRITE)
     def create_calc(self, params):
@@ -284,8 +430,21 @@ class Calculation(Resource):
         input_parameters = body.get('input', {}).get('parameters')
         if input_parameters is None:
             input_parameters = body.get('inputParameters', {})
+        geometry_hash = body.get('input', {}).get('geometryHash')
         file_id = None
         file_format = body.get('format', 'cjson')
+        reuse = body.get('reuse', False)
+
+        # With reuse, a pending submission of a calculation that is already
+        # running with the same image, parameters and geometry gets that
+        # calculation, which its results are then ingested into. Completed
+        # calculations are only reused before a taskflow is launched.
+        if reuse and props.get('pending'):
+            calc = CalculationModel().find_identical(
+                image, input_parameters, geometry_hash, user=user,
+                pending=True, level=AccessType.WRITE)
+            if calc is not None:
+                return CalculationModel().filter(calc, user)
 
         if 'fileId' in body:
             file = File().load(body['fileId'], user=getCurrentUser())
@@ -301,7 +460,12 @@ class Calculation(Resource):
                                                image=image,
                                                input_parameters=input_parameters,
                                                file_id=file_id,
-                                               notebooks=notebooks, public=public)
+                                               notebooks=notebooks, public=public,
+                                               geometry_hash=geometry_hash,
+                                               reuse=reuse)
+
+        # Calculate the cubes of the frontier orbitals in the background
+        orbital_prefetch.schedule(calc)
 
         cherrypy.response.status = 201
         cherrypy.response.headers['Location'] \
@@ -316,6 +480,10 @@ class Calculation(Resource):
 
     create_calc.description = (
         Description('Get the molecular structure of a give calculation in SDF format')
+        .notes('Set "reuse" to true in the body of a pending calculation to '
+               'get the identical pending calculation, with the same image '
+               'digest, parameters and geometry, that the user can write if '
+               'there is one, rather than creating another.')
         .param(
             'body',
             'The calculation data', dataType='CalculationData', required=True,
@@ -323,26 +491,17 @@ class Calculation(Resource):
 
     def _file_to_cjson(self, file, file_format):
         readers = {
-            'cjson': oc.CjsonReader
+            'cjson': cjson_stream.load
         }
 
         if file_format not in readers:
             raise Exception('Unknown file format %s' % file_format)
         reader = readers[file_format]
 
+        # The file is parsed as it is read, so that only a chunk of it is in
+        # memory at a time
         with File().open(file) as f:
-            calc_data = f.read().decode()
-
-        # SpooledTemporaryFile doesn't implement next(),
-        # workaround in case any reader needs it
-        tempfile.SpooledTemporaryFile.__next__ = lambda self: self.__iter__().__next__()
-
-        with tempfile.SpooledTemporaryFile(mode='w+', max_size=10*1024*1024) as tf:
-            tf.write(calc_data)
-            tf.seek(0)
-            cjson = reader(tf).read()
-
-        return cjson
+            return reader(f)
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
@@ -406,7 +565,12 @@ class Calculation(Resource):
                                               provenanceId)
             calculation['optimizedGeometryId'] = geometry.get('_id')
 
-        return CalculationModel().save(calculation)
+        calculation = CalculationModel().save(calculation)
+
+        # Calculate the cubes of the frontier orbitals in the background
+        orbital_prefetch.schedule(calculation)
+
+        return calculation
 
     @access.public
     @autoDescribeRoute(
@@ -429,20 +593,26 @@ class Calculation(Resource):
                 paramType='query', required=False)
         .param('creatorId', 'The id of the user that created the calculation',
                required=False)
+        .param('count', 'How to count the matches: exact (default), cached, '
+               'capped, estimated or none', required=False,
+               enum=['exact', 'cached', 'capped', 'estimated', 'none'])
+        .param('cursor', 'Continue after this cursor, which is the "next" of '
+               'the previous page, instead of using the offset',
+               required=False)
         .pagingParams(defaultSort='_id', defaultSortDir=SortDir.DESCENDING, defaultLimit=25)
     )
     def find_calc(self, moleculeId=None, geometryId=None, imageName=None,
                   inputParameters=None, inputGeometryHash=None,
                   name=None, inchi=None, inchikey=None, smiles=None,
-                  formula=None, creatorId=None, pending=None, limit=None,
-                  offset=None, sort=None):
+                  formula=None, creatorId=None, pending=None, count=None,
+                  cursor=None, limit=None, offset=None, sort=None):
         return CalculationModel().findcal(
             molecule_id=moleculeId, geometry_id=geometryId,
             image_name=imageName, input_parameters=inputParameters,
             input_geometry_hash=inputGeometryHash, name=name, inchi=inchi,
             inchikey=inchikey, smiles=smiles, formula=formula,
             creator_id=creatorId, pending=pending, limit=limit, offset=offset,
-            sort=sort, user=getCurrentUser())
+            sort=sort, user=getCurrentUser(), count=count, cursor=cursor)
 
     @access.public
     def find_id(self, id, params):
@@ -451,7 +621,7 @@ class Calculation(Resource):
         if not cal:
             raise RestException('Calculation not found.', code=404)
 
-        return cal
+        return self._model.expand_cjson(cal)
     find_id.description = (
         Description('Get the calculation by id')
         .param(
@@ -517,7 +687,7 @@ class Calculation(Resource):
         calculation['properties'] = props
         calculation = self._model.save(calculation)
 
-        return calculation
+        return self._model.expand_cjson(calculation)
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
@@ -0,0 +1,57 @@
+import click
+
+
+@click.group(name='molecules',
+             help='Maintenance commands for the molecules plugin.')
+def main():
+    pass
+
+
+@main.command('backfill-lowercase',
+              help='Set the lowercase name and formula fields, used for '
+                   'searching, on molecules that were created without them.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='The number of molecules to update per bulk write.')
+def backfill_lowercase(batch_size):
+    from molecules.models.molecule import Molecule
+
+    count = Molecule().backfill_lowercase_fields(batch_size)
+    click.echo('Updated %d molecules' % count)
+
+
+@main.command('backfill-fingerprints',
+              help='Compute the fingerprints, used for similarity searches, '
+                   'of molecules that were created without them. Restart '
+                   'girder afterwards so that it reloads its search index.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='The number of molecules to send to Open Babel at a time.')
+def backfill_fingerprints(batch_size):
+    from molecules.utilities.similarity import backfill_fingerprints
+
+    count = backfill_fingerprints(batch_size)
+    click.echo('Updated %d molecules' % count)
+
+
+@main.command('pack-arrays',
+              help='Pack the large arrays of the cjson of the calculations, '
+                   'geometries and cached cubes that were saved unpacked, '
+                   'or expand them all again with --unpack.')
+@click.option('--dtype', type=click.Choice(['float32', 'float64']),
+              default='float64', show_default=True,
+              help='The type to pack the arrays as.')
+@click.option('--unpack', is_flag=True,
+              help='Expand the packed arrays to lists.')
+@click.option('--batch-size', default=100, show_default=True,
+              help='The number of documents to update per bulk write.')
+def pack_arrays(dtype, unpack, batch_size):
+    from molecules.models.calculation import Calculation
+    from molecules.models.cubecache import Cubecache
+    from molecules.models.geometry import Geometry
+
+    for model in (Calculation(), Geometry(), Cubecache()):
+        if unpack:
+            count = model.unpack_existing(batch_size)
+        else:
+            count = model.pack_existing(dtype, batch_size)
+
+        click.echo('Updated %d %s' % (count, model.name))
@@ -10,6 +10,22 @@ class PluginSettings:
     JENA_DATASET = 'molecules.jena.dataset'
     OPENBABEL_BASE_URL = 'molecules.openbabel.url'
     AVOGADRO_BASE_URL = 'molecules.avogadro.url'
+    OPENBABEL_TIMEOUT = 'molecules.openbabel.timeout'
+    AVOGADRO_TIMEOUT = 'molecules.avogadro.timeout'
+    SERVICES_POOL_SIZE = 'molecules.services.pool_size'
+    SERVICES_MAX_WORKERS = 'molecules.services.max_workers'
+    SERVICES_RETRIES = 'molecules.services.retries'
+    SERVICES_BACKOFF_FACTOR = 'molecules.services.backoff_factor'
+    CONVERSION_CACHE_SIZE = 'molecules.conversion_cache.size'
+    CONVERSION_CACHE_MONGO = 'molecules.conversion_cache.mongo'
+    PACKED_ARRAYS = 'molecules.packed_arrays'
+    CUBE_CACHE_MAX_SIZE = 'molecules.cube_cache.max_size'
+    CUBE_CACHE_EVICTION = 'molecules.cube_cache.eviction'
+    CUBE_RESOLUTION = 'molecules.cube_resolution'
+    ORBITAL_PREFETCH = 'molecules.orbital_prefetch.enabled'
+    ORBITAL_PREFETCH_WINDOW = 'molecules.orbital_prefetch.window'
+    WORK_QUEUE_WORKERS = 'molecules.work_queue.workers'
+    PENDING_CALCULATION_TIMEOUT = 'molecules.pending_calculation.timeout'
 
 theory_priority = {
     'mm': 10, # (molecular mechanics)
@@ -1,24 +1,52 @@
-import sys
+import datetime
 import json
 from jsonschema import validate, ValidationError
 from bson.objectid import ObjectId
+from bson.son import SON
+from pymongo.errors import DuplicateKeyError
 import urllib
 import urllib.parse
 
 from girder.models.model_base import AccessControlledModel, ValidationException
+from girder.models.setting import Setting
 from girder.utility.model_importer import ModelImporter
 from girder.models.file import File
 from girder.models.item import Item
 from girder.models.folder import Folder
 from girder.constants import AccessType
+from molecules.constants import PluginSettings
+from molecules.utilities.pagination import COUNT_EXACT
+from molecules.utilities.pagination import count_matches
 from molecules.utilities.pagination import default_pagination_params
+from molecules.utilities.pagination import keyset_query
+from molecules.utilities.pagination import next_cursor
+from molecules.utilities.pagination import parse_count_params
 from molecules.utilities.pagination import search_results_dict
 
 from molecules.models.molecule import Molecule as MoleculeModel
+from molecules.models.packed_cjson import PackedCjson
 
 import openchemistry as oc
 
-class Calculation(AccessControlledModel):
+# Pending calculations older than this, in hours, are assumed to have failed.
+# They are no longer returned for identical submissions.
+DEFAULT_PENDING_TIMEOUT = 48
+
+
+def pending_timeout():
+    value = Setting().get(PluginSettings.PENDING_CALCULATION_TIMEOUT)
+    if value is None or value == '':
+        value = DEFAULT_PENDING_TIMEOUT
+
+    return datetime.timedelta(hours=float(value))
+
+
+def _pending_cutoff():
+    # The ids of calculations created before the timeout are lower than this
+    return ObjectId.from_datetime(datetime.datetime.utcnow() -
+                                  pending_timeout())
+
+class Calculation(PackedCjson, AccessControlledModel):
     '''
     {
         'frames': {
@@ -58,15 +86,30 @@ class Calculation(AccessControlledModel):
     def __init__(self):
         super(Calculation, self).__init__()
 
+    EXPOSED_FIELDS = ('_id', 'moleculeId', 'geometryId', 'fileId',
+                      'properties', 'notebooks', 'input', 'image', 'code')
+
     def initialize(self):
         self.name = 'calculations'
         self.ensureIndices([
-            'moleculeId', 'properties.pending'
+            'moleculeId', 'properties.pending',
+            # Used by the permission clauses of findcal
+            'public', 'access.users.id', 'access.groups.id',
+            # Used by find_identical
+            ([('image.digest', 1), ('input.parametersHash', 1),
+              ('input.geometryHash', 1), ('properties.pending', 1)], {}),
+            # Only one identical calculation is in flight at a time, so that
+            # identical submissions are coalesced onto it, see create_cjson
+            ([('image.digest', 1), ('input.parametersHash', 1),
+              ('input.geometryHash', 1)], {
+                'unique': True,
+                'name': 'in_flight_identical',
+                'partialFilterExpression': {'inFlight': True}
+            })
         ])
 
-        self.exposeFields(level=AccessType.READ, fields=(
-            '_id', 'moleculeId', 'geometryId', 'fileId', 'properties',
-            'notebooks', 'input', 'image', 'code'))
+        self.exposeFields(level=AccessType.READ,
+                          fields=Calculation.EXPOSED_FIELDS)
 
     def filter(self, calc, user):
         calc = super(Calculation, self).filter(doc=calc, user=user)
@@ -89,25 +132,34 @@ class Calculation(AccessControlledModel):
                                                            force=True)
             doc['moleculeId'] = mol['_id']
 
+        # Only pending calculations are in flight
+        if not (doc.get('properties') or {}).get('pending'):
+            doc.pop('inFlight', None)
+
         return doc
 
     def findcal(self, molecule_id=None, geometry_id=None, image_name=None,
                 input_parameters=None, input_geometry_hash=None,
                 name=None, inchi=None, inchikey=None, smiles=None,
                 formula=None, creator_id=None, pending=None, limit=None,
-                offset=None, sort=None, user=None):
+                offset=None, sort=None, user=None, count=COUNT_EXACT,
+                cursor=None):
         # Set these to their defaults if they are not already set
         limit, offset, sort = default_pagination_params(limit, offset, sort)
+        count, cursor = parse_count_params({'count': count, 'cursor': cursor})
+        if cursor is not None:
+            offset = 0
 
         query = {}
+        molecule_query = None
 
         # If a molecule id is specified it has higher priority
         if molecule_id:
             query['moleculeId'] = ObjectId(molecule_id)
         # Otherwise, if query parameters for the molecules are
-        # specified, search for matching molecules first
+        # specified, join the calculations with their molecules
         elif any((name, inchi, inchikey, smiles, formula)):
-            params = {'offset': 0, 'limit': sys.maxsize}
+            params = {}
 
             if name:
                 params['name'] = name
@@ -120,9 +172,7 @@ class Calculation(AccessControlledModel):
             if formula:
                 params['formula'] = formula
 
-            molecules = MoleculeModel().find_molecule(params)['results']
-            molecule_ids = [molecule['_id'] for molecule in molecules]
-            query['moleculeId'] = {'$in': molecule_ids}
+            molecule_query = MoleculeModel().search_query(params)
 
         if geometry_id:
             # This is currently not being stored as an ObjectId
@@ -152,24 +202,141 @@ class Calculation(AccessControlledModel):
                     '$ne': True
                 }
 
-        fields = ['image', 'input', 'code',
-                  'cjson.vibrations.modes', 'cjson.vibrations.intensities',
-                  'cjson.vibrations.frequencies', 'properties', 'fileId', 'access',
-                  'moleculeId', 'public']
-
-        calcs = self.find(query, fields=fields, limit=limit,
-                                 offset=offset, sort=sort)
-        num_matches = calcs.collection.count_documents(query)
-
-        calcs = self.filterResultsByPermission(calcs, user,
-            AccessType.READ, limit=limit)
-        calcs = [self.filter(x, user) for x in calcs]
-
-        return search_results_dict(calcs, num_matches, limit, offset, sort)
+        # Only return the calculations the user can read. As the permissions
+        # are part of the query, pages are full and the count is correct.
+        permissions = self.permissionClauses(user=user, level=AccessType.READ)
+        if permissions:
+            query = {'$and': [query, permissions]} if query else permissions
+
+        # The fields that filter() would keep
+        fields = list(Calculation.EXPOSED_FIELDS)
+
+        if molecule_query is None:
+            docs = self.find(keyset_query(query, cursor, sort), fields=fields,
+                             limit=limit, offset=offset, sort=sort)
+            count_query = query
+        else:
+            join = self._join_molecules(molecule_query)
+            pipeline = [
+                {'$match': keyset_query(query, cursor, sort)},
+                {'$sort': SON(sort)}
+            ] + join
+            if offset:
+                pipeline.append({'$skip': offset})
+            if limit:
+                pipeline.append({'$limit': limit})
+            pipeline.append({'$project': {x: True for x in fields}})
+
+            docs = self.collection.aggregate(pipeline)
+            count_query = [{'$match': query}] + join
+
+        calcs = [x for x in docs]
+
+        num_matches, exact = count_matches(self.collection, count_query,
+                                           count, offset)
+
+        return search_results_dict(calcs, num_matches, limit, offset, sort,
+                                   exact, next_cursor(calcs, limit, sort))
+
+    def _join_molecules(self, molecule_query):
+        # Stages that keep the calculations whose molecule matches
+        # molecule_query. mongodb coalesces the $lookup, $unwind and $match
+        # into one indexed lookup per calculation that only returns a matching
+        # molecule, so the calculations are streamed in order and no more of
+        # them are looked at than are needed for the page.
+        return [{
+            '$lookup': {
+                'from': MoleculeModel().name,
+                'localField': 'moleculeId',
+                'foreignField': '_id',
+                'as': '_molecule'
+            }
+        }, {
+            '$unwind': '$_molecule'
+        }, {
+            '$match': _prefix_query(molecule_query, '_molecule.')
+        }]
+
+    def find_identical(self, image, input_parameters, geometry_hash,
+                       user=None, pending=None, level=AccessType.READ):
+        '''
+        Find a calculation run with the same image digest, input parameters
+        and input geometry, that the user has level access to. Completed
+        calculations are preferred to pending ones, unless pending is given.
+        Pending calculations older than the pending timeout are ignored.
+        Returns None if there is none, or if any of the three is missing.
+        '''
+        query = identity_query(image, input_parameters, geometry_hash)
+        if query is None:
+            return None
+
+        states = [False, True] if pending is None else [pending]
+        for state in states:
+            if state:
+                query['properties.pending'] = True
+                query['_id'] = {'$gte': _pending_cutoff()}
+            else:
+                query['properties.pending'] = {'$ne': True}
+            cursor = self.findWithPermissions(query, user=user, level=level,
+                                              limit=1)
+            for calc in cursor:
+                return calc
+
+        return None
+
+    def _release_stale(self, query):
+        # Identical submissions are no longer coalesced onto the pending
+        # calculations of query that have timed out
+        query = dict(query)
+        query['inFlight'] = True
+        query['_id'] = {'$lt': _pending_cutoff()}
+        self.collection.update_many(query, {'$unset': {'inFlight': ''}})
+
+    def migrate_in_flight(self):
+        '''
+        Mark the newest of each group of identical public pending
+        calculations as in flight. There can be several of them from before
+        identical submissions were coalesced. The others are left as they
+        are.
+        '''
+        self.collection.update_many({
+            'inFlight': True,
+            '_id': {'$lt': _pending_cutoff()}
+        }, {
+            '$unset': {'inFlight': ''}
+        })
+
+        pipeline = [
+            {'$match': {
+                'properties.pending': True,
+                'public': True,
+                'inFlight': {'$exists': False},
+                'image.digest': {'$exists': True},
+                'input.parametersHash': {'$exists': True},
+                'input.geometryHash': {'$exists': True},
+                '_id': {'$gte': _pending_cutoff()}
+            }},
+            {'$group': {
+                '_id': {
+                    'digest': '$image.digest',
+                    'parametersHash': '$input.parametersHash',
+                    'geometryHash': '$input.geometryHash'
+                },
+                'newest': {'$max': '$_id'}
+            }}
+        ]
+        for group in self.collection.aggregate(pipeline):
+            try:
+                self.collection.update_one({'_id': group['newest']},
+                                           {'$set': {'inFlight': True}})
+            except DuplicateKeyError:
+                # One of them is already in flight
+                pass
 
     def create_cjson(self, user, cjson, props, molecule_id=None,
                      geometry_id=None, image=None, input_parameters=None,
-                     file_id = None, public=True, notebooks=None):
+                     file_id = None, public=True, notebooks=None,
+                     geometry_hash=None, reuse=False):
         if notebooks is None:
             notebooks = []
 
@@ -189,13 +356,37 @@ class Calculation(AccessControlledModel):
         if input_parameters is not None:
             calc.setdefault('input', {})['parameters'] = input_parameters
             calc.setdefault('input', {})['parametersHash'] = oc.hash_object(input_parameters)
+        if geometry_hash is not None:
+            calc.setdefault('input', {})['geometryHash'] = geometry_hash
 
         calc['creatorId'] = user['_id']
         self.setUserAccess(calc, user=user, level=AccessType.ADMIN)
         if public:
             self.setPublic(calc, True)
 
-        return self.save(calc)
+        # With reuse, identical public submissions are coalesced onto one
+        # pending calculation, unless it has timed out
+        query = identity_query(image, input_parameters, geometry_hash)
+        if (reuse and query is not None and public and
+                (props or {}).get('pending')):
+            calc['inFlight'] = True
+            self._release_stale(query)
+
+        try:
+            return self.save(calc)
+        except DuplicateKeyError:
+            # An identical calculation was submitted at the same time
+            existing = self.find_identical(image, input_parameters,
+                                           geometry_hash, user=user,
+                                           pending=True,
+                                           level=AccessType.WRITE)
+            if existing is not None:
+                return existing
+
+            # It is one the user can't ingest results into
+            calc.pop('_id', None)
+            calc.pop('inFlight', None)
+            return self.save(calc)
 
     def add_notebooks(self, calc, notebooks):
         query = {
@@ -227,3 +418,31 @@ class Calculation(AccessControlledModel):
             folder = Folder().load(scratch_folder_id, user=user, level=AccessType.WRITE)
             if folder:
                 Folder().remove(folder)
+
+
+def identity_query(image, input_parameters, geometry_hash):
+    """The query for the calculations that were run with the same image
+    digest, input parameters and input geometry, or None if any of them is
+    missing.
+    """
+    digest = image.get('digest') if isinstance(image, dict) else None
+    if not digest or input_parameters is None or not geometry_hash:
+        return None
+
+    return {
+        'image.digest': digest,
+        'input.parametersHash': oc.hash_object(input_parameters),
+        'input.geometryHash': geometry_hash
+    }
+
+
+def _prefix_query(query, prefix):
+    """Prefix the fields of a mongodb query, such as for a joined document"""
+    prefixed = {}
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            prefixed[key] = [_prefix_query(x, prefix) for x in value]
+        else:
+            prefixed[prefix + key] = value
+
+    return prefixed
@@ -0,0 +1,66 @@
+import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+from girder.models.model_base import Model
+
+# Entries are removed by MongoDB once they are older than this
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+
+class Conversioncache(Model):
+    '''
+    Second tier of the conversion cache, shared between all of the
+    girder processes.
+
+    {
+        'key': '<sha256 of the conversion>',
+        'output': '...',
+        'sourceIds': [<ids of the documents the input came from>],
+        'created': <datetime>
+    }
+    '''
+
+    def initialize(self):
+        self.name = 'conversioncache'
+        self.ensureIndices([
+            ('key', {'unique': True}),
+            'sourceIds',
+            ('created', {'expireAfterSeconds': DEFAULT_TTL})
+        ])
+
+    def validate(self, doc):
+        return doc
+
+    def find_key(self, key):
+        cached = self.findOne({'key': key}, fields=['output'])
+        if cached is None:
+            return None
+
+        return cached['output']
+
+    def create(self, key, output, source_id=None):
+        query = {
+            'key': key
+        }
+
+        updates = {
+            '$setOnInsert': {
+                'output': output,
+                'created': datetime.datetime.utcnow()
+            }
+        }
+
+        if source_id is not None:
+            updates['$addToSet'] = {
+                'sourceIds': source_id
+            }
+
+        try:
+            self.collection.update_one(query, updates, upsert=True)
+        except DuplicateKeyError:
+            # Another process cached the same conversion at the same time
+            pass
+
+    def remove_source(self, source_id):
+        self.removeWithQuery({'sourceIds': source_id})
@@ -1,18 +1,118 @@
+import datetime
+import time
+
+import bson
 from jsonschema import validate, ValidationError
+from bson.codec_options import CodecOptions
 from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
+from girder.models import getDbConnection
 from girder.models.model_base import AccessControlledModel, ValidationException
 from girder.utility.model_importer import ModelImporter
 from girder.constants import AccessType
+from molecules.models.packed_cjson import PackedCjson
+from molecules.utilities import packed_arrays
+
+# A request that is calculating a cube holds a pending marker document for
+# it, so that other requests wait for that cube rather than calculating it
+# again. Markers older than this are assumed to be abandoned.
+PENDING_TIMEOUT = datetime.timedelta(minutes=10)
+
+# How often to check whether a pending cube is ready
+POLL_INTERVAL = 0.25
+
+CUBE_INDEX = [('calculationId', 1), ('mo', 1), ('resolution', 1)]
+# The unique index before cubes had resolutions
+OLD_CUBE_INDEX = [('calculationId', 1), ('mo', 1)]
+# The resolution of the cubes cached before then. Their spacing was scaled
+# with the number of atoms, as medium does for most molecules.
+OLD_RESOLUTION = 'medium'
+
+# Each has an index, so that cubes are evicted without sorting them in memory
+EVICTION_SORTS = {
+    # Least recently used
+    'lru': [('lastAccessed', 1)],
+    # Least frequently used, least recently used first among equals
+    'lfu': [('hits', 1), ('lastAccessed', 1)]
+}
+
+
+def migrate():
+    '''
+    Prepare the cubes cached before CUBE_INDEX was unique for it: drop the
+    old index, which stops the resolutions of a cube coexisting, set the
+    resolution of the cubes that have none, and remove the duplicate cubes.
+    This must run before the model is first used, as that builds the index,
+    which would fail on the duplicates. Returns the number of cubes that
+    were removed.
+    '''
+    database = getDbConnection().get_database()
+    collection = database['cubecache']
+    indices = collection.index_information()
+    if any(x['key'] == CUBE_INDEX and x.get('unique')
+           for x in indices.values()):
+        return 0
+
+    for name, index in indices.items():
+        if index['key'] == OLD_CUBE_INDEX and index.get('unique'):
+            collection.drop_index(name)
+
+    collection.update_many({'resolution': {'$exists': False}},
+                           {'$set': {'resolution': OLD_RESOLUTION}})
+
+    # Keep a cube that is ready over a pending marker for it
+    pipeline = [
+        {'$sort': {'pending': 1}},
+        {'$group': {
+            '_id': {
+                'calculationId': '$calculationId',
+                'mo': '$mo',
+                'resolution': '$resolution'
+            },
+            'ids': {'$push': '$_id'},
+            'count': {'$sum': 1}
+        }},
+        {'$match': {'count': {'$gt': 1}}}
+    ]
+    count = 0
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        for id in group['ids'][1:]:
+            collection.delete_one({'_id': id})
+            packed_arrays.remove_gridfs(database, id)
+            count += 1
+
+    return count
+
 
-class Cubecache(AccessControlledModel):
+class Cubecache(PackedCjson, AccessControlledModel):
+    '''
+    {
+        'calculationId': <id of the calculation>,
+        'mo': <index of the orbital>,
+        'resolution': <'coarse', 'medium' or 'fine'>,
+        'cjson': {...},
+        'size': <bytes stored for the cjson>,
+        'hits': <number of times the cube was read from the cache>,
+        'lastAccessed': <datetime>,
+
+        # Only while the cube is being calculated
+        'pending': True,
+        'started': <datetime>,
+        'waiters': [<ids of the users to notify once it is ready>]
+    }
+    '''
 
     def __init__(self):
         super(Cubecache, self).__init__()
 
     def initialize(self):
         self.name = 'cubecache'
-        self.ensureIndices(['calculationId', 'mo'])
+        self.ensureIndices([
+            (CUBE_INDEX, {'unique': True})
+        ] + [(sort, {}) for sort in EVICTION_SORTS.values()])
 
         self.exposeFields(level=AccessType.READ, fields=(
             '_id', 'calculationId', 'mo', 'cjson'))
@@ -32,26 +132,262 @@ class Cubecache(AccessControlledModel):
                                                                force=True)
             doc['calculationId'] = calc['_id']
 
+        # The cjson is packed by now, if packing is enabled
+        if 'cjson' in doc:
+            doc['size'] = (len(bson.encode(doc['cjson'])) +
+                           packed_arrays.gridfs_size(doc['cjson']))
+
         return doc
 
-    def create(self, calcId, mo, cjson):
-        cache = {
-            'calculationId': calcId,
+    def _key(self, calcId, mo, resolution=None):
+        return {
+            'calculationId': ObjectId(calcId),
             'mo': mo,
-            'cjson': cjson
+            'resolution': resolution
         }
 
-        # For now set as public
-        self.setPublic(cache, True)
+    def create(self, calcId, mo, cjson, resolution=None):
+        '''
+        Cache the cube of orbital mo at resolution. Returns the cached
+        document, which is the one created by another request if that
+        finished first.
+        '''
+        query = self._key(calcId, mo, resolution)
+        cache = self.collection.find_one(query)
+        if cache is not None and not cache.get('pending'):
+            return cache
 
-        return self.save(cache)
+        if cache is None:
+            cache = dict(query)
+            # For now set as public
+            self.setPublic(cache, True)
 
-    def find_mo(self, calcId, mo):
-        query = {
-            'calculationId': ObjectId(calcId),
-            'mo': mo
+        cache.pop('pending', None)
+        cache.pop('started', None)
+        cache.pop('waiters', None)
+        cache.update({
+            'cjson': cjson,
+            'hits': 0,
+            'lastAccessed': datetime.datetime.utcnow()
+        })
+
+        try:
+            return self.save(cache)
+        except DuplicateKeyError:
+            return self.collection.find_one(query)
+
+    def complete(self, calcId, mo, cjson, resolution=None):
+        '''
+        Replace the pending marker of orbital mo with its cube, in one step
+        so that a waiter added in the meantime isn't missed. Returns a tuple
+        of the cached document and the ids of the users that were waiting
+        for it. Without a marker the cube is cached by create().
+        '''
+        query = self._key(calcId, mo, resolution)
+        query['pending'] = True
+        marker = self.collection.find_one(query, projection=['_id'])
+        if marker is None:
+            return self.create(calcId, mo, cjson, resolution), []
+
+        cache = self._key(calcId, mo, resolution)
+        cache.update({
+            'cjson': self.pack_cjson(cjson, marker['_id']),
+            'hits': 0,
+            'lastAccessed': datetime.datetime.utcnow()
+        })
+        cache = self.validate(cache)
+
+        update = {
+            '$set': cache,
+            '$unset': {'pending': '', 'started': '', 'waiters': ''}
+        }
+        query = {'_id': marker['_id'], 'pending': True}
+        previous = self.collection.find_one_and_update(
+            query, update, projection=['waiters'])
+        if previous is None:
+            # The marker was released in the meantime
+            packed_arrays.remove_gridfs(self.database, marker['_id'])
+            return self.create(calcId, mo, cjson, resolution), []
+
+        cache.update({'_id': marker['_id'], 'cjson': cjson})
+        return cache, previous.get('waiters', [])
+
+    def find_mo(self, calcId, mo, resolution=None, projection=None):
+        '''
+        Get the cached cube of orbital mo, recording the access.
+        '''
+        query = self._key(calcId, mo, resolution)
+        query['pending'] = {'$ne': True}
+
+        update = {
+            '$set': {'lastAccessed': datetime.datetime.utcnow()},
+            '$inc': {'hits': 1}
         }
 
-        cache = self.findOne(query)
+        return self.collection.find_one_and_update(
+            query, update, projection=projection,
+            return_document=ReturnDocument.AFTER)
 
-        return cache
+    def scalars(self, id):
+        '''
+        Get the scalars of the cube of a cached document, without decoding
+        them into a list. Returns the packed array, or a numpy array if they
+        aren't packed, or None if there aren't any.
+        '''
+        collection = self.collection.with_options(
+            codec_options=CodecOptions(document_class=RawBSONDocument))
+        doc = collection.find_one({'_id': ObjectId(id)},
+                                  projection={'_id': False,
+                                              'cjson.cube.scalars': True})
+        if doc is None or 'cube' not in doc.get('cjson', {}):
+            return None
+
+        # The cube only holds the scalars: their type, the key as a C
+        # string, and the value
+        raw = doc['cjson']['cube'].raw
+        key = b'scalars\x00'
+        start = 5 + len(key)
+        if len(raw) <= start or raw[5:start] != key:
+            return None
+
+        if raw[4:5] == b'\x04':
+            array = packed_arrays.bson_array(raw[start:-1])
+            if array is not None:
+                return array
+
+        # A packed array, or not all doubles
+        return bson.decode(raw)['scalars']
+
+    def claim(self, calcId, mo, user=None, resolution=None):
+        '''
+        Mark the cube of orbital mo as being calculated. Returns False if it
+        is already cached or being calculated by another request.
+        '''
+        now = datetime.datetime.utcnow()
+        marker = self._key(calcId, mo, resolution)
+        marker.update({
+            'pending': True,
+            'started': now,
+            'waiters': [user['_id']] if user else []
+        })
+        self.setPublic(marker, True)
+
+        try:
+            self.save(marker)
+            return True
+        except DuplicateKeyError:
+            pass
+
+        # Take over the marker if the request that held it has gone away
+        query = self._key(calcId, mo, resolution)
+        query.update({
+            'pending': True,
+            'started': {'$lt': now - PENDING_TIMEOUT}
+        })
+        update = {
+            '$set': {'started': now}
+        }
+        if user:
+            update['$addToSet'] = {'waiters': user['_id']}
+
+        return self.collection.update_one(query, update).modified_count == 1
+
+    def add_waiter(self, calcId, mo, user, resolution=None):
+        '''
+        Add a user to notify once the pending cube of orbital mo is ready.
+        Returns False if the cube isn't pending.
+        '''
+        query = self._key(calcId, mo, resolution)
+        query['pending'] = True
+        update = {
+            '$addToSet': {'waiters': user['_id']}
+        }
+
+        return self.collection.update_one(query, update).matched_count == 1
+
+    def release(self, calcId, mo, resolution=None):
+        '''
+        Remove the pending marker of orbital mo, after its calculation failed.
+        Returns the marker, or None if there wasn't one.
+        '''
+        query = self._key(calcId, mo, resolution)
+        query['pending'] = True
+
+        return self.collection.find_one_and_delete(query)
+
+    def wait(self, calcId, mo, resolution=None, timeout=PENDING_TIMEOUT,
+             projection=None):
+        '''
+        Wait for another request to calculate the cube of orbital mo.
+        Returns the cached cube, or None if the calculation failed or took
+        longer than timeout.
+        '''
+        deadline = time.time() + timeout.total_seconds()
+        query = self._key(calcId, mo, resolution)
+        while time.time() < deadline:
+            cache = self.collection.find_one(query, projection=['pending'])
+            if cache is None:
+                return None
+            if not cache.get('pending'):
+                return self.find_mo(calcId, mo, resolution, projection)
+
+            time.sleep(POLL_INTERVAL)
+
+        return None
+
+    def evict(self, max_size, policy='lru', size=None):
+        '''
+        Remove cubes, least recently or least frequently used first, until
+        the cache holds at most max_size bytes. size is the number of bytes
+        the cache holds, which is added up if it isn't given. Returns the
+        number of cubes that were removed.
+        '''
+        if size is None:
+            size = self.size()
+        if size <= max_size:
+            return 0
+
+        count = 0
+        query = {'pending': {'$ne': True}}
+        cursor = self.collection.find(query, projection=['size'],
+                                      sort=EVICTION_SORTS[policy])
+        for cache in cursor:
+            if size <= max_size:
+                break
+
+            # The cjson is only needed for its packed arrays in GridFS
+            self.remove(self.collection.find_one(
+                {'_id': cache['_id']}, projection=['cjson']) or cache)
+            size -= cache.get('size', 0)
+            count += 1
+
+        return count
+
+    def size(self):
+        '''
+        Get the number of bytes held by the cache.
+        '''
+        pipeline = [
+            {'$group': {'_id': None, 'size': {'$sum': '$size'}}}
+        ]
+        result = next(self.collection.aggregate(pipeline), None)
+
+        return result['size'] if result else 0
+
+    def stats(self):
+        pipeline = [
+            {'$group': {
+                '_id': None,
+                'entries': {'$sum': {'$cond': ['$pending', 0, 1]}},
+                'pending': {'$sum': {'$cond': ['$pending', 1, 0]}},
+                'size': {'$sum': '$size'},
+                'hits': {'$sum': '$hits'}
+            }}
+        ]
+        stats = next(self.collection.aggregate(pipeline), None) or {}
+        return {
+            'entries': stats.get('entries', 0),
+            'pending': stats.get('pending', 0),
+            'size': stats.get('size', 0),
+            'hits': stats.get('hits', 0)
+        }
@@ -4,12 +4,17 @@ from girder.models.model_base import AccessControlledModel
 from girder.constants import AccessType
 
 from molecules.models.molecule import Molecule as MoleculeModel
+from molecules.models.packed_cjson import PackedCjson
 from molecules.utilities.get_cjson_energy import get_cjson_energy
+from molecules.utilities.pagination import count_matches
+from molecules.utilities.pagination import keyset_query
+from molecules.utilities.pagination import next_cursor
+from molecules.utilities.pagination import parse_count_params
 from molecules.utilities.pagination import parse_pagination_params
 from molecules.utilities.pagination import search_results_dict
 from molecules.utilities.whitelist_cjson import whitelist_cjson
 
-class Geometry(AccessControlledModel):
+class Geometry(PackedCjson, AccessControlledModel):
 
     def __init__(self):
         super(Geometry, self).__init__()
@@ -59,6 +64,9 @@ class Geometry(AccessControlledModel):
     def find_geometries(self, moleculeId, user, paging_params):
 
         limit, offset, sort = parse_pagination_params(paging_params)
+        count, cursor = parse_count_params(paging_params)
+        if cursor is not None:
+            offset = 0
 
         query = {
             'moleculeId': ObjectId(moleculeId)
@@ -72,11 +80,14 @@ class Geometry(AccessControlledModel):
           'energy'
         ]
 
-        cursor = self.findWithPermissions(query, user=user, fields=fields,
-                                          limit=limit, offset=offset,
-                                          sort=sort)
+        geometries = self.findWithPermissions(keyset_query(query, cursor, sort),
+                                              user=user, fields=fields,
+                                              limit=limit, offset=offset,
+                                              sort=sort)
+        geometries = [x for x in geometries]
 
-        num_matches = cursor.collection.count_documents(query)
+        num_matches, exact = count_matches(self.collection, query, count,
+                                           offset)
 
-        geometries = [x for x in cursor]
-        return search_results_dict(geometries, num_matches, limit, offset, sort)
+        return search_results_dict(geometries, num_matches, limit, offset, sort,
+                                   exact, next_cursor(geometries, limit, sort))
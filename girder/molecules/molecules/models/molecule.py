@@ -4,6 +4,8 @@ from bson.objectid import ObjectId
 import json
 import re
 
+from pymongo import UpdateOne
+
 from girder.models.model_base import AccessControlledModel
 from girder.constants import AccessType
 from girder.exceptions import RestException, ValidationException
@@ -11,6 +13,10 @@ from molecules import avogadro
 from molecules import openbabel
 
 from molecules import query as mol_query
+from molecules.utilities.pagination import count_matches
+from molecules.utilities.pagination import keyset_query
+from molecules.utilities.pagination import next_cursor
+from molecules.utilities.pagination import parse_count_params
 from molecules.utilities.pagination import parse_pagination_params
 from molecules.utilities.pagination import search_results_dict
 from molecules.utilities.has_3d_coords import cjson_has_3d_coords
@@ -21,16 +27,43 @@ class Molecule(AccessControlledModel):
         super(Molecule, self).__init__()
         self.ensureIndex('properties.formula')
         self.ensureIndex('inchikey')
+        self.ensureIndex('nameLower')
+        self.ensureIndex('properties.formulaLower')
 
     def initialize(self):
         self.name = 'molecules'
 
     def validate(self, doc):
+        set_lowercase_fields(doc)
         return doc
 
     def find_molecule(self, search = None):
         limit, offset, sort = parse_pagination_params(search)
+        count, cursor = parse_count_params(search)
+        if cursor is not None:
+            offset = 0
+
+        query = self.search_query(search)
+
+        fields = [
+          'inchikey',
+          'smiles',
+          'properties',
+          'name'
+        ]
+
+        mols = self.find(keyset_query(query, cursor, sort), fields=fields,
+                         limit=limit, offset=offset, sort=sort)
+        mols = [x for x in mols]
 
+        num_matches, exact = count_matches(self.collection, query, count,
+                                           offset)
+
+        return search_results_dict(mols, num_matches, limit, offset, sort,
+                                   exact, next_cursor(mols, limit, sort))
+
+    def search_query(self, search=None):
+        """Get the mongodb query for the search params of find_molecule"""
         if search is None:
             search = {}
 
@@ -45,8 +78,9 @@ class Molecule(AccessControlledModel):
         elif search:
             # If the search dict is not empty, perform a search
             if 'name' in search:
-                query['name'] = { '$regex': search['name'],
-                                  '$options': 'i' }
+                # Match the start of the name, ignoring the case
+                name = re.escape(search['name'].lower())
+                query['nameLower'] = { '$regex': '^' + name }
             if 'inchi' in search:
                 query['inchi'] = search['inchi']
             if 'inchikey' in search:
@@ -55,25 +89,11 @@ class Molecule(AccessControlledModel):
                 # Make sure it is canonical before searching
                 query['smiles'] = openbabel.to_smiles(search['smiles'], 'smi')
             if 'formula' in search:
-                formula_regx = re.compile(search['formula'], re.IGNORECASE)
-                query['properties.formula'] = formula_regx
+                query['properties.formulaLower'] = search['formula'].lower()
             if 'creatorId' in search:
                 query['creatorId'] = ObjectId(search['creatorId'])
 
-        fields = [
-          'inchikey',
-          'smiles',
-          'properties',
-          'name'
-        ]
-
-        cursor = self.find(query, fields=fields, limit=limit, offset=offset,
-                           sort=sort)
-
-        num_matches = cursor.collection.count_documents(query)
-
-        mols = [x for x in cursor]
-        return search_results_dict(mols, num_matches, limit, offset, sort)
+        return query
 
     def find_inchi(self, inchi):
         query = { 'inchi': inchi }
@@ -129,3 +149,63 @@ class Molecule(AccessControlledModel):
     def has_3d_coords(self, mol):
         # This functions properly if passed None
         return cjson_has_3d_coords(mol.get('cjson'))
+
+    def backfill_lowercase_fields(self, batch_size=1000):
+        """Set the lowercase fields of molecules created before they existed.
+
+        Returns the number of molecules that were updated.
+        """
+        query = {
+            '$or': [{
+                'name': {'$exists': True},
+                'nameLower': {'$exists': False}
+            }, {
+                'properties.formula': {'$exists': True},
+                'properties.formulaLower': {'$exists': False}
+            }]
+        }
+        fields = ['name', 'properties.formula']
+
+        count = 0
+        operations = []
+        for mol in self.collection.find(query, projection=fields):
+            updates = lowercase_fields(mol)
+            if updates:
+                operations.append(UpdateOne({'_id': mol['_id']},
+                                          {'$set': updates}))
+
+            if len(operations) >= batch_size:
+                count += self.collection.bulk_write(operations).modified_count
+                operations = []
+
+        if operations:
+            count += self.collection.bulk_write(operations).modified_count
+
+        return count
+
+
+def lowercase_fields(mol):
+    """Get the lowercase fields of a molecule, keyed by their dotted path.
+
+    Names and formulas are searched case insensitively, using these fields so
+    that the searches can use an index.
+    """
+    fields = {}
+
+    name = mol.get('name')
+    if isinstance(name, str):
+        fields['nameLower'] = name.lower()
+
+    formula = mol.get('properties', {}).get('formula')
+    if isinstance(formula, str):
+        fields['properties.formulaLower'] = formula.lower()
+
+    return fields
+
+
+def set_lowercase_fields(mol):
+    for key, value in lowercase_fields(mol).items():
+        if key.startswith('properties.'):
+            mol['properties'][key[len('properties.'):]] = value
+        else:
+            mol[key] = value
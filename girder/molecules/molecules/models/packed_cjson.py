@@ -0,0 +1,123 @@
+from pymongo import UpdateOne
+
+from girder.models.setting import Setting
+
+from molecules.constants import PluginSettings
+from molecules.utilities import packed_arrays
+
+
+class PackedCjson(object):
+    '''
+    Mixin for the models that store cjson. If the packed arrays setting is
+    set, the large arrays of the cjson are packed when a document is saved,
+    see packed_arrays. Documents are loaded with their arrays packed, and
+    expand_cjson() expands them when they are needed as lists.
+    '''
+
+    def save(self, doc, *args, **kwargs):
+        cjson = doc.get('cjson')
+        dtype = Setting().get(PluginSettings.PACKED_ARRAYS)
+        if not dtype or not isinstance(cjson, dict):
+            return super(PackedCjson, self).save(doc, *args, **kwargs)
+
+        is_new = '_id' not in doc
+        doc['cjson'] = packed_arrays.pack_cjson(cjson, dtype, self.database,
+                                                doc.get('_id'))
+        try:
+            doc = super(PackedCjson, self).save(doc, *args, **kwargs)
+
+            ids = packed_arrays.gridfs_ids(doc['cjson'])
+            if is_new and ids:
+                # New documents only have an id once they have been saved
+                packed_arrays.set_gridfs_owner(self.database, ids, doc['_id'])
+            elif not is_new:
+                # Remove the arrays of the previous version of the document
+                packed_arrays.remove_gridfs(self.database, doc['_id'],
+                                            keep=ids)
+        finally:
+            # Callers keep the cjson they saved
+            doc['cjson'] = cjson
+
+        return doc
+
+    def pack_cjson(self, cjson, owner=None):
+        '''
+        Get cjson with its large arrays packed, if the packed arrays setting
+        is set, for a document that is stored without save(). owner is the
+        id of the document.
+        '''
+        dtype = Setting().get(PluginSettings.PACKED_ARRAYS)
+        if not dtype or not isinstance(cjson, dict):
+            return cjson
+
+        return packed_arrays.pack_cjson(cjson, dtype, self.database, owner)
+
+    def remove(self, doc, *args, **kwargs):
+        result = super(PackedCjson, self).remove(doc, *args, **kwargs)
+        if packed_arrays.gridfs_ids(doc.get('cjson')):
+            packed_arrays.remove_gridfs(self.database, doc['_id'])
+
+        return result
+
+    def expand_cjson(self, doc):
+        '''
+        Expand the packed arrays of the cjson of doc, in place. Returns doc.
+        '''
+        if doc is not None and packed_arrays.has_packed(doc.get('cjson')):
+            doc['cjson'] = packed_arrays.unpack_cjson(doc['cjson'],
+                                                      self.database)
+
+        return doc
+
+    def pack_existing(self, dtype, batch_size=100):
+        '''
+        Pack the arrays of the documents that were saved unpacked. Returns the
+        number of documents that were updated.
+        '''
+        def pack(doc):
+            return packed_arrays.pack_cjson(doc['cjson'], dtype, self.database,
+                                            doc['_id'])
+
+        return self._update_cjson(pack, batch_size)
+
+    def unpack_existing(self, batch_size=100):
+        '''
+        Expand the packed arrays of all of the documents. Returns the number
+        of documents that were updated.
+        '''
+        owners = []
+
+        def unpack(doc):
+            if packed_arrays.gridfs_ids(doc['cjson']):
+                owners.append(doc['_id'])
+
+            return packed_arrays.unpack_cjson(doc['cjson'], self.database)
+
+        count = self._update_cjson(unpack, batch_size)
+        for owner in owners:
+            packed_arrays.remove_gridfs(self.database, owner)
+
+        return count
+
+    def _update_cjson(self, func, batch_size):
+        # Replace the cjson of each document with func(doc), if it changed
+        count = 0
+        operations = []
+        cursor = self.collection.find({'cjson': {'$exists': True}},
+                                      projection=['cjson'],
+                                      batch_size=batch_size)
+        for doc in cursor:
+            cjson = func(doc)
+            if cjson is doc['cjson']:
+                continue
+
+            operations.append(UpdateOne({'_id': doc['_id']},
+                                        {'$set': {'cjson': cjson}}))
+            if len(operations) >= batch_size:
+                count += self.collection.bulk_write(operations).modified_count
+                operations = []
+
+        if operations:
+            count += self.collection.bulk_write(operations).modified_count
+
+        return count
@@ -0,0 +1,304 @@
+import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from girder.models.model_base import Model
+
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+# A job whose worker hasn't acknowledged it by the end of its lease is
+# assumed to be lost (for example, girder was restarted), and is queued
+# again by the reaper. Workers renew the leases of the jobs they are running,
+# so a job can run for longer than this.
+DEFAULT_LEASE = datetime.timedelta(minutes=15)
+DEFAULT_MAX_ATTEMPTS = 5
+# The delay before the retry of a failed job is doubled after each attempt
+BACKOFF = datetime.timedelta(seconds=10)
+MAX_BACKOFF = datetime.timedelta(minutes=10)
+
+# Finished jobs are kept for the latency metrics, then removed by MongoDB
+FINISHED_TTL = 7 * 24 * 60 * 60
+
+
+class Workqueue(Model):
+    '''
+    Durable queue of background jobs, shared between all of the girder
+    processes.
+
+    {
+        'type': <name of the handler of the job>,
+        'key': <id of the document the job is for>,
+        'payload': {...},
+        'userId': <id of the user that queued the job, or None>,
+        'state': <'queued', 'leased', 'done' or 'failed'>,
+        'active': True, # Only while queued or leased
+        'attempts': <number of times the job was claimed>,
+        'maxAttempts': <number of attempts before the job fails>,
+        'created': <datetime>,
+        'available': <datetime from which it can be claimed>,
+        'owner': <the worker holding the lease>,
+        'leaseExpires': <datetime>,
+        'started': <datetime of the last claim>,
+        'finished': <datetime>,
+        'error': <why the last attempt failed>
+    }
+    '''
+
+    def initialize(self):
+        self.name = 'workqueue'
+        self.ensureIndices([
+            # Only one active job of a type for a document
+            ([('type', 1), ('key', 1)], {
+                'unique': True,
+                'partialFilterExpression': {'active': True}
+            }),
+            ([('state', 1), ('available', 1)], {}),
+            ([('state', 1), ('leaseExpires', 1)], {}),
+            ('finished', {'expireAfterSeconds': FINISHED_TTL})
+        ])
+
+    def validate(self, doc):
+        return doc
+
+    def enqueue(self, type, key, payload=None, user=None,
+                max_attempts=DEFAULT_MAX_ATTEMPTS):
+        '''
+        Queue a job of type for the document key. Returns the job, which is
+        the one already queued if there is an active job of type for key.
+        '''
+        now = datetime.datetime.utcnow()
+        job = {
+            'type': type,
+            'key': ObjectId(key),
+            'payload': payload or {},
+            'userId': user['_id'] if user else None,
+            'state': QUEUED,
+            'active': True,
+            'attempts': 0,
+            'maxAttempts': max_attempts,
+            'created': now,
+            'available': now
+        }
+
+        try:
+            return self.save(job)
+        except DuplicateKeyError:
+            return self.find_active(type, key)
+
+    def find_active(self, type, key):
+        return self.collection.find_one({
+            'type': type,
+            'key': ObjectId(key),
+            'active': True
+        })
+
+    def is_active(self, type, key):
+        '''
+        Whether there is a job of type for key that is queued or running.
+        '''
+        query = {
+            'type': type,
+            'key': ObjectId(key),
+            'active': True
+        }
+
+        return self.collection.count_documents(query, limit=1) > 0
+
+    def claim(self, owner, lease=DEFAULT_LEASE):
+        '''
+        Lease the job that has been available the longest. Returns the job,
+        or None if there are no jobs available.
+        '''
+        now = datetime.datetime.utcnow()
+        query = {
+            'state': QUEUED,
+            'available': {'$lte': now}
+        }
+        update = {
+            '$set': {
+                'state': LEASED,
+                'owner': owner,
+                'leaseExpires': now + lease,
+                'started': now
+            },
+            '$inc': {'attempts': 1}
+        }
+
+        return self.collection.find_one_and_update(
+            query, update, sort=[('available', 1)],
+            return_document=ReturnDocument.AFTER)
+
+    def _update_leased(self, job, owner, update):
+        query = {
+            '_id': job['_id'],
+            'state': LEASED,
+            'owner': owner
+        }
+
+        return self.collection.update_one(query, update).modified_count == 1
+
+    def renew(self, job, owner, lease=DEFAULT_LEASE):
+        '''
+        Extend the lease of a job that is still running. Returns False if
+        owner no longer holds the lease.
+        '''
+        update = {
+            '$set': {
+                'leaseExpires': datetime.datetime.utcnow() + lease
+            }
+        }
+
+        return self._update_leased(job, owner, update)
+
+    def ack(self, job, owner):
+        '''
+        Mark a leased job as done. Returns False if owner no longer holds
+        the lease.
+        '''
+        update = {
+            '$set': {
+                'state': DONE,
+                'finished': datetime.datetime.utcnow()
+            },
+            '$unset': {
+                'active': '',
+                'owner': '',
+                'leaseExpires': ''
+            }
+        }
+
+        return self._update_leased(job, owner, update)
+
+    def fail(self, job, owner, error, retry=True):
+        '''
+        Record the failure of an attempt at a leased job. The job is queued
+        again after a backoff, unless retry is False or it has run out of
+        attempts. Returns False if owner no longer holds the lease.
+        '''
+        now = datetime.datetime.utcnow()
+        if retry and job['attempts'] < job['maxAttempts']:
+            backoff = min(BACKOFF * 2 ** (job['attempts'] - 1), MAX_BACKOFF)
+            update = {
+                '$set': {
+                    'state': QUEUED,
+                    'available': now + backoff,
+                    'error': error
+                },
+                '$unset': {
+                    'owner': '',
+                    'leaseExpires': ''
+                }
+            }
+        else:
+            update = {
+                '$set': {
+                    'state': FAILED,
+                    'finished': now,
+                    'error': error
+                },
+                '$unset': {
+                    'active': '',
+                    'owner': '',
+                    'leaseExpires': ''
+                }
+            }
+
+        return self._update_leased(job, owner, update)
+
+    def reap(self):
+        '''
+        Queue the jobs whose leases have expired again, or fail them if they
+        have run out of attempts. Returns the number of jobs queued again.
+        '''
+        now = datetime.datetime.utcnow()
+        query = {
+            'state': LEASED,
+            'leaseExpires': {'$lt': now}
+        }
+
+        exhausted = dict(query)
+        exhausted['$expr'] = {'$gte': ['$attempts', '$maxAttempts']}
+        self.collection.update_many(exhausted, {
+            '$set': {
+                'state': FAILED,
+                'finished': now,
+                'error': 'The lease of the job expired.'
+            },
+            '$unset': {
+                'active': '',
+                'owner': '',
+                'leaseExpires': ''
+            }
+        })
+
+        result = self.collection.update_many(query, {
+            '$set': {
+                'state': QUEUED,
+                'available': now,
+                'error': 'The lease of the job expired.'
+            },
+            '$unset': {
+                'owner': '',
+                'leaseExpires': ''
+            }
+        })
+
+        return result.modified_count
+
+    def stats(self, since=None):
+        '''
+        Get the number of jobs of each type in each state, and the latency
+        of the jobs that finished since the given datetime.
+        '''
+        stats = {}
+        pipeline = [
+            {'$group': {
+                '_id': {'type': '$type', 'state': '$state'},
+                'count': {'$sum': 1}
+            }}
+        ]
+        for group in self.collection.aggregate(pipeline):
+            type_stats = stats.setdefault(group['_id']['type'], {
+                QUEUED: 0,
+                LEASED: 0,
+                DONE: 0,
+                FAILED: 0
+            })
+            type_stats[group['_id']['state']] = group['count']
+
+        if since is None:
+            since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+
+        # In milliseconds. The wait is from when the job was queued to its
+        # last attempt, the run time is that of the last attempt.
+        pipeline = [
+            {'$match': {
+                'state': {'$in': [DONE, FAILED]},
+                'finished': {'$gte': since},
+                'started': {'$exists': True}
+            }},
+            {'$project': {
+                'type': 1,
+                'wait': {'$subtract': ['$started', '$created']},
+                'run': {'$subtract': ['$finished', '$started']}
+            }},
+            {'$group': {
+                '_id': '$type',
+                'count': {'$sum': 1},
+                'meanWait': {'$avg': '$wait'},
+                'maxWait': {'$max': '$wait'},
+                'meanRun': {'$avg': '$run'},
+                'maxRun': {'$max': '$run'}
+            }}
+        ]
+        for group in self.collection.aggregate(pipeline):
+            latency = dict(group)
+            del latency['_id']
+            stats.setdefault(group['_id'], {})['latency'] = latency
+
+        return stats
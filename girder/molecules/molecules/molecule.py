@@ -23,7 +23,15 @@ from . import query
 from . import semantic
 from . import constants
 from molecules.utilities import async_requests
+from molecules.utilities import conversion_cache
+from molecules.utilities import similarity
+from molecules.utilities import substructure
+from molecules.utilities import work_queue
 from molecules.utilities.molecules import create_molecule
+from molecules.utilities.pagination import count_matches
+from molecules.utilities.pagination import keyset_query
+from molecules.utilities.pagination import next_cursor
+from molecules.utilities.pagination import parse_count_params
 from molecules.utilities.pagination import parse_pagination_params
 from molecules.utilities.pagination import search_results_dict
 
@@ -56,12 +64,16 @@ class Molecule(Resource):
         self.route('GET', (':id', ), self.find_id)
         self.route('GET', (':id', 'svg'), self.get_svg)
         self.route('GET', ('search',), self.search)
+        self.route('GET', ('substructure',), self.substructure_search)
         self.route('POST', (), self.create)
         self.route('DELETE', (':id',), self.delete)
         self.route('PATCH', (':id',), self.update)
         self.route('PATCH', (':id', 'notebooks'), self.add_notebooks)
         self.route('POST', ('conversions', ':output_format'), self.conversions)
+        self.route('GET', ('conversions', 'cache'),
+                   self.get_conversion_cache_stats)
         self.route('POST', (':id', '3d'), self.generate_3d_coords)
+        self.route('GET', ('queue',), self.get_work_queue_stats)
 
         # Methods for geometries
         self.route('GET', (':moleculeId', 'geometries'), self.find_geometries)
@@ -80,6 +92,8 @@ class Molecule(Resource):
             del doc['sdf']
         if 'svg' in doc:
             del doc['svg']
+        if 'fingerprint' in doc:
+            del doc['fingerprint']
         doc['_id'] = str(doc['_id'])
         if 'cjson' in doc:
             if cjson:
@@ -92,6 +106,13 @@ class Molecule(Resource):
 
         return doc
 
+    def _clean_molecule(self, mol, cjson=True):
+        # Whether the SVG and 3D coordinates are being generated is derived
+        # from the jobs in the work queue
+        mol.update(async_requests.generating_flags(mol))
+
+        return self._clean(mol, cjson)
+
     @access.public
     def find(self, params):
         return MoleculeModel().find_molecule(params)
@@ -113,6 +134,13 @@ class Molecule(Resource):
             .param('queryString', 'The query string to use for this search '
                                   '(supercedes all other search parameters)',
                    paramType='query', required=False)
+            .param('count', 'How to count the matches: exact (default), '
+                   'cached, capped, estimated or none', paramType='query',
+                   required=False,
+                   enum=['exact', 'cached', 'capped', 'estimated', 'none'])
+            .param('cursor', 'Continue after this cursor, which is the "next" '
+                   'of the previous page, instead of using the offset',
+                   paramType='query', required=False)
             .pagingParams(defaultSort='_id',
                           defaultSortDir=SortDir.DESCENDING,
                           defaultLimit=25)
@@ -123,7 +151,7 @@ class Molecule(Resource):
         mol = MoleculeModel().find_inchikey(inchikey)
         if not mol:
             raise RestException('Molecule not found.', code=404)
-        return self._clean(mol)
+        return self._clean_molecule(mol)
     find_inchikey.description = (
             Description('Find a molecule by InChI key.')
             .param('inchikey', 'The InChI key of the molecule', paramType='path')
@@ -139,7 +167,7 @@ class Molecule(Resource):
         cjsonParam = params.get('cjson')
         if cjsonParam is not None:
             cjson = cjsonParam.lower() == 'true'
-        return self._clean(mol, cjson)
+        return self._clean_molecule(mol, cjson)
     find_id.description = (
         Description('Get a specific molecule by id')
         .param('id', 'The id of the molecule', paramType='path')
@@ -194,7 +222,7 @@ class Molecule(Resource):
         if not mol:
             raise RestException('Invalid request', code=400)
 
-        return self._clean(mol)
+        return self._clean_molecule(mol)
 
     addModel('Molecule', 'MoleculeParams', {
         "id": "MoleculeParams",
@@ -251,6 +279,7 @@ class Molecule(Resource):
 
         if 'name' in body:
             updates['$set']['name'] = body['name']
+            updates['$set']['nameLower'] = body['name'].lower()
 
         if 'logs' in body:
             updates['$addToSet']['logs'] = body['logs']
@@ -263,7 +292,7 @@ class Molecule(Resource):
         # Reload the molecule
         mol = MoleculeModel().load(id, user=user)
 
-        return self._clean(mol)
+        return self._clean_molecule(mol)
     addModel('Molecule', 'UpdateMoleculeParams', {
         "id": "UpdateMoleculeParams",
         "properties": {
@@ -376,6 +405,21 @@ class Molecule(Resource):
             .errorResponse('Invalid request body.', 400)
             .errorResponse('Input format not supported.', code=400))
 
+    @access.admin
+    @autoDescribeRoute(
+        Description('Get the hit and miss counts of the conversion cache.')
+    )
+    def get_conversion_cache_stats(self):
+        return conversion_cache.stats()
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Get the depth and latency of the queue of background '
+                    'jobs.')
+    )
+    def get_work_queue_stats(self):
+        return work_queue.stats()
+
     @access.public
     def get_format(self, id, output_format, params):
         # For now will for force load ( i.e. ignore access control )
@@ -391,9 +435,13 @@ class Molecule(Resource):
                 # Returning None implies that there are no 3D coordinates
                 return
 
-            data = json.dumps(molecule['cjson'])
-            if output_format != 'cjson':
-                data = avogadro.convert_str(data, 'cjson', output_format)
+            if output_format == 'cjson':
+                data = json.dumps(molecule['cjson'])
+            else:
+                data = conversion_cache.convert_cjson(molecule['cjson'],
+                                                      output_format,
+                                                      molecule['_id'],
+                                                      molecule.get('updated'))
         else:
             # Right now, all 2d output formats are stored in the molecule
             data = molecule[output_format]
@@ -440,6 +488,7 @@ class Molecule(Resource):
     @access.public
     def search(self, params):
         limit, offset, sort = parse_pagination_params(params)
+        count, cursor = parse_count_params(params)
 
         query_string = params.get('q')
         formula = params.get('formula')
@@ -449,7 +498,9 @@ class Molecule(Resource):
 
         if query_string is not None:
             try:
-                mongo_query = query.to_mongo_query(query_string)
+                smiles = query.to_similarity_query(query_string)
+                if smiles is None:
+                    mongo_query = query.to_mongo_query(query_string)
             except query.InvalidQuery:
                 raise RestException('Invalid query', 400)
 
@@ -459,13 +510,24 @@ class Molecule(Resource):
               'properties',
               'name'
             ]
-            cursor = MoleculeModel().find(query=mongo_query, fields=fields,
-                                          limit=limit, offset=offset,
-                                          sort=sort)
-            mols = [x for x in cursor]
-            num_matches = cursor.collection.count_documents(mongo_query)
 
-            return search_results_dict(mols, num_matches, limit, offset, sort)
+            if smiles is not None:
+                return self._similarity_search(smiles, params.get('threshold'),
+                                               fields, limit, offset, sort)
+
+            if cursor is not None:
+                offset = 0
+
+            model = MoleculeModel()
+            mols = model.find(query=keyset_query(mongo_query, cursor, sort),
+                              fields=fields, limit=limit, offset=offset,
+                              sort=sort)
+            mols = [x for x in mols]
+            num_matches, exact = count_matches(model.collection, mongo_query,
+                                               count, offset)
+
+            return search_results_dict(mols, num_matches, limit, offset, sort,
+                                       exact, next_cursor(mols, limit, sort))
 
         elif formula:
             # Search using formula
@@ -489,18 +551,109 @@ class Molecule(Resource):
             mol = create_molecule(sdf_data, 'sdf', getCurrentUser(), True,
                                   provenance=provenance)
 
-            return search_results_dict([mol], 1, limit, offset, sort)
+            return search_results_dict([self._clean(mol)], 1, limit, offset,
+                                       sort)
+
+    def _similarity_search(self, smiles, threshold, fields, limit, offset,
+                           sort):
+        if threshold is not None:
+            try:
+                threshold = float(threshold)
+            except ValueError:
+                raise RestException('Invalid threshold', 400)
+
+            if not 0 <= threshold <= 1:
+                raise RestException('The threshold must be between 0 and 1',
+                                    400)
+
+        # The results are sorted by similarity rather than by sort
+        num_matches, matches = similarity.search(smiles, limit, offset,
+                                                 threshold)
+
+        ids = [x[0] for x in matches]
+        cursor = MoleculeModel().find(query={'_id': {'$in': ids}},
+                                      fields=fields)
+        mols = {x['_id']: x for x in cursor}
+
+        results = []
+        for id, score in matches:
+            mol = mols.get(id)
+            if mol is None:
+                continue
+
+            mol['similarity'] = score
+            results.append(mol)
+
+        # Drop molecules that were removed by another process
+        similarity.forget([id for id in ids if id not in mols])
+
+        return search_results_dict(results, num_matches, limit, offset, sort)
 
 
     search.description = (
             Description('Search for molecules using a query string, formula, or cactus')
-            .param('q', 'The query string to use for this search', paramType='query', required=False)
+            .param('q', 'The query string to use for this search. The '
+                   'smiles~slr~<smiles> query finds the molecules that are '
+                   'most similar to <smiles>, in order of decreasing '
+                   'similarity', paramType='query', required=False)
+            .param('threshold', 'The minimum Tanimoto similarity, between 0 '
+                   'and 1, of the molecules found by a similarity search',
+                   paramType='query', required=False)
             .param('formula', 'The formula (using the "Hill Order") to search for', paramType='query', required=False)
             .param('cactus', 'The identifier to pass to cactus', paramType='query', required=False)
+            .param('count', 'How to count the matches: exact (default), '
+                   'cached, capped, estimated or none', paramType='query',
+                   required=False,
+                   enum=['exact', 'cached', 'capped', 'estimated', 'none'])
+            .param('cursor', 'Continue after this cursor, which is the "next" '
+                   'of the previous page, instead of using the offset',
+                   paramType='query', required=False)
             .pagingParams(defaultSort='_id',
                           defaultSortDir=SortDir.DESCENDING,
                           defaultLimit=25))
 
+    @access.public
+    @autoDescribeRoute(
+        Description('Find the molecules that contain a substructure.')
+        .notes('The molecules are returned a page at a time, and only as '
+               'many molecules are checked as are needed for the page. As a '
+               'result, "matches" is the number of molecules up to the end '
+               'of the page, plus one if there are more molecules after it.')
+        .param('smiles', 'The SMILES of the substructure.')
+        .param('limit', 'Result set size limit.', dataType='integer',
+               required=False, default=25)
+        .param('offset', 'Offset into result set.', dataType='integer',
+               required=False, default=0)
+        .errorResponse('Invalid substructure.', 400)
+        .errorResponse('The Open Babel service failed, or is unavailable.',
+                       502)
+    )
+    def substructure_search(self, smiles, limit, offset):
+        try:
+            ids, more = substructure.search(smiles, limit, offset)
+        except requests.HTTPError as e:
+            # Only the requests that the service rejected are invalid
+            status = e.response.status_code if e.response is not None else 500
+            if 400 <= status < 500:
+                raise RestException('Invalid substructure.', 400)
+
+            raise RestException('The Open Babel service failed, or is '
+                                'unavailable.', 503 if status == 503 else 502)
+
+        fields = [
+          'inchikey',
+          'smiles',
+          'properties',
+          'name'
+        ]
+        cursor = MoleculeModel().find(query={'_id': {'$in': ids}},
+                                      fields=fields)
+        mols = {x['_id']: x for x in cursor}
+        results = [mols[x] for x in ids if x in mols]
+
+        num_matches = offset + len(ids) + (1 if more else 0)
+        return search_results_dict(results, num_matches, limit, offset, None)
+
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
             Description('Generate 3D coordinates for a molecule.')
@@ -516,8 +669,9 @@ class Molecule(Resource):
         """Generate 3D coords if not present and not being generated"""
 
         if (MoleculeModel().has_3d_coords(mol) or
-                mol.get('generating_3d_coords', False)):
-            return self._clean(mol)
+                work_queue.is_active(async_requests.COORDS_3D_JOB,
+                                     mol['_id'])):
+            return self._clean_molecule(mol)
 
         try:
             steps = int(steps)
@@ -529,22 +683,30 @@ class Molecule(Resource):
         async_requests.schedule_3d_coords_gen(mol, user,
                                               gen3d_forcefield=forcefield,
                                               gen3d_steps=steps)
-        return self._clean(mol)
+        return self._clean_molecule(mol)
 
     @access.public
     @autoDescribeRoute(
         Description('Find geometries of a given molecule.')
         .param('moleculeId', 'The id of the parent molecule.')
+        .param('count', 'How to count the matches: exact (default), cached, '
+               'capped, estimated or none', required=False,
+               enum=['exact', 'cached', 'capped', 'estimated', 'none'])
+        .param('cursor', 'Continue after this cursor, which is the "next" of '
+               'the previous page, instead of using the offset',
+               required=False)
         .pagingParams(defaultSort='_id',
                       defaultSortDir=SortDir.DESCENDING,
                       defaultLimit=25)
     )
-    def find_geometries(self, moleculeId, limit, offset, sort):
+    def find_geometries(self, moleculeId, count, cursor, limit, offset, sort):
         paging_params = {
             'limit': limit,
             'offset': offset,
             'sort': sort[0][0],
-            'sortdir': sort[0][1]
+            'sortdir': sort[0][1],
+            'count': count,
+            'cursor': cursor
         }
         user = getCurrentUser()
         return GeometryModel().find_geometries(moleculeId, user, paging_params)
@@ -562,6 +724,8 @@ class Molecule(Resource):
         if not geometry:
             raise RestException('Geometry not found.', code=404)
 
+        GeometryModel().expand_cjson(geometry)
+
         return self._clean(geometry)
 
     @access.public
@@ -588,9 +752,15 @@ class Molecule(Resource):
         if not geometry:
             raise RestException('Geometry not found.', code=404)
 
-        data = json.dumps(geometry['cjson'])
-        if output_format != 'cjson':
-            data = avogadro.convert_str(data, 'cjson', output_format)
+        GeometryModel().expand_cjson(geometry)
+
+        if output_format == 'cjson':
+            data = json.dumps(geometry['cjson'])
+        else:
+            data = conversion_cache.convert_cjson(geometry['cjson'],
+                                                  output_format,
+                                                  geometry['_id'],
+                                                  geometry.get('updated'))
 
         def stream():
             cherrypy.response.headers['Content-Type'] = (
@@ -1,10 +1,12 @@
+import base64
 import json
-import requests
 
 from girder.models.setting import Setting
 
 from molecules.avogadro import convert_str as avo_convert_str
 from molecules.constants import PluginSettings
+from molecules.utilities import sessions
+from molecules.utilities.sessions import Lanes, Services
 from molecules.utilities.has_3d_coords import cjson_has_3d_coords
 
 def openbabel_base_url():
@@ -15,7 +17,8 @@ def openbabel_base_url():
     return base_url
 
 
-def convert_str(data_str, input_format, output_format, extra_options=None):
+def convert_str(data_str, input_format, output_format, extra_options=None,
+                lane=Lanes.INTERACTIVE):
 
     if extra_options is None:
         extra_options = {}
@@ -30,7 +33,7 @@ def convert_str(data_str, input_format, output_format, extra_options=None):
     }
     data.update(extra_options)
 
-    r = requests.post(url, json=data)
+    r = sessions.post(Services.OPENBABEL, url, lane=lane, json=data)
 
     if r.headers and 'content-type' in r.headers:
         mimetype = r.headers['content-type']
@@ -40,6 +43,39 @@ def convert_str(data_str, input_format, output_format, extra_options=None):
     return r.text, mimetype
 
 
+def convert_str_batch(records, output_format, lane=Lanes.BULK):
+    # Each record is a tuple of (data_str, input_format, extra_options),
+    # where extra_options may be omitted. The results are returned in the
+    # same order as the records. A record that could not be converted
+    # has a dict containing "error" as its result. Batches are for
+    # background work, so they are in the bulk lane by default.
+
+    base_url = openbabel_base_url()
+    path = 'convert-batch'
+    url = '/'.join([base_url, path, output_format])
+
+    molecules = []
+    for record in records:
+        data_str, input_format = record[:2]
+        mol = {
+            'format': input_format,
+            'data': data_str
+        }
+        if len(record) > 2 and record[2]:
+            mol['options'] = record[2]
+
+        molecules.append(mol)
+
+    data = {
+        'molecules': molecules
+    }
+
+    r = sessions.post(Services.OPENBABEL, url, lane=lane, json=data)
+    r.raise_for_status()
+
+    return r.json()['results']
+
+
 def to_inchi(data_str, input_format):
 
     result, mime = convert_str(data_str, input_format, 'inchi')
@@ -54,6 +90,71 @@ def to_smiles(data_str, input_format):
     return result
 
 
+def to_inchi_batch(records):
+    # Returns a list of (inchi, inchikey) tuples, in the same order as
+    # the (data_str, input_format) records. Both are None for a record
+    # that could not be converted.
+
+    results = convert_str_batch(records, 'inchi')
+    return [(x.get('inchi'), x.get('inchikey')) for x in results]
+
+
+def to_smiles_batch(records):
+    # Returns a list of smiles, in the same order as the
+    # (data_str, input_format) records. The smiles is None for a record
+    # that could not be converted.
+
+    results = convert_str_batch(records, 'smi')
+    return [x.get('data') for x in results]
+
+
+def fingerprint(data_str, input_format, fp_type='FP2'):
+    # Returns the bit packed fingerprint as bytes
+
+    extra_options = {
+        'fingerprintType': fp_type
+    }
+
+    result, mime = convert_str(data_str, input_format, 'fingerprint',
+                               extra_options)
+    return base64.b64decode(json.loads(result)['fingerprint'])
+
+
+def fingerprint_batch(records, fp_type='FP2'):
+    # Returns a list of bit packed fingerprints, in the same order as the
+    # (data_str, input_format) records. The fingerprint is None for a
+    # record that could not be converted.
+
+    options = {
+        'fingerprintType': fp_type
+    }
+    records = [(x[0], x[1], options) for x in records]
+
+    results = convert_str_batch(records, 'fingerprint')
+    return [base64.b64decode(x['fingerprint']) if 'fingerprint' in x else None
+            for x in results]
+
+
+def substructure_match(pattern, smiles):
+    # Returns a list of bools, in the same order as smiles, that are True
+    # for the molecules that contain the pattern (SMARTS or SMILES).
+
+    base_url = openbabel_base_url()
+    url = '/'.join([base_url, 'substructure'])
+
+    data = {
+        'pattern': pattern,
+        'molecules': smiles,
+        'format': 'smi'
+    }
+
+    r = sessions.post(Services.OPENBABEL, url, lane=Lanes.INTERACTIVE,
+                      json=data)
+    r.raise_for_status()
+
+    return r.json()['matches']
+
+
 def gen_sdf_no_3d(data_str, input_format, add_hydrogens=True):
 
     extra_options = {
@@ -75,7 +176,29 @@ def properties(data_str, input_format, add_hydrogens=True):
         'addHydrogens': add_hydrogens
     }
 
-    r = requests.post(url, json=data)
+    r = sessions.post(Services.OPENBABEL, url, lane=Lanes.INTERACTIVE,
+                      json=data)
+
+    return r.json()
+
+
+def ingest(data_str, input_format, add_hydrogens=True,
+           lane=Lanes.INTERACTIVE):
+    # Returns a dict containing the inchi, inchikey, canonical smiles,
+    # properties, and the fingerprint, all from one call.
+
+    base_url = openbabel_base_url()
+    path = 'ingest'
+    url = '/'.join([base_url, path])
+
+    data = {
+        'format': input_format,
+        'data': data_str,
+        'addHydrogens': add_hydrogens
+    }
+
+    r = sessions.post(Services.OPENBABEL, url, lane=lane, json=data)
+    r.raise_for_status()
 
     return r.json()
 
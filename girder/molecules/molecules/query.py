@@ -1,4 +1,5 @@
 from pyparsing import *
+import functools
 import string
 import re
 
@@ -15,7 +16,8 @@ import re
 #   ~gte~  - numeric greater or equal than, has not meaning for strings.
 #   ~lt~   - numeric less than, has not meaning for strings.
 #   ~lte~  - numeric less or equal than, has not meaning for strings.
-#   ~slr~  - similarity search based on smile
+#   ~slr~  - similarity search based on smiles, can only be used on its own
+#           with the smiles field, e.g. smiles~slr~CCO
 #
 # The comparison operators can be using with the follow string fields:
 #   inchi
@@ -54,6 +56,32 @@ OR = '~or~'
 AND = '~and~'
 SIMILAR = '~slr~'
 
+# Map query key to mongodb properties
+_key_map = {
+        'mass': 'properties.mass',
+        'atomCount': 'properties.atomCount',
+        'heavyAtomCount': 'properties.heavyAtomCount',
+        'formula': 'properties.formula'
+}
+
+# Fields that are compared case insensitively, mapped to the lowercase
+# copies of them that are stored on the molecules.
+_lower_case_key_map = {
+        'name': 'nameLower',
+        'formula': 'properties.formulaLower'
+}
+
+# InChI keys are always upper case
+_upper_case_fields = ['inchikey']
+
+
+def _map_key(key):
+    if isinstance(key, str):
+        return _key_map.get(key, key)
+
+    return key
+
+
 # The root of the operator hierarchy
 class Operator(object):
     def __init__(self, t):
@@ -63,9 +91,15 @@ class Operator(object):
     def query(self):
         pass
 
+# similarity search, which is performed by the fingerprint index rather than
+# by mongodb
 class Similar(Operator):
+    @property
+    def smiles(self):
+        return self.args[1].strip()
+
     def query(self):
-        return 'similarity?q=%s' % self.args[1]
+        raise ParseException('Similarity searches have no mongodb query')
 
 # basic comparison
 class Comparison(Operator):
@@ -79,35 +113,44 @@ class Comparison(Operator):
 
     def query(self):
         q = dict()
-        q[self.args[0]] = {self._op_map[self.op]: self.args[1]}
+        q[_map_key(self.args[0])] = {self._op_map[self.op]: self.args[1]}
 
         return q
 
 # numeric equals
 class NumericEquals(Comparison):
   def query(self):
-    return {self.args[0]: self.args[1]}
+    return {_map_key(self.args[0]): self.args[1]}
 
 # string equals
 class StringEquals(Comparison):
     def query(self):
-        value = self.args[1]
+        field = self.args[0]
+        value = self.args[1].strip()
 
-        #if self.args[0] == 'inchi':
-        #    value = value.replace('InChI=', '')
+        if field in _upper_case_fields:
+            value = value.upper()
 
-        value = value.strip()
+        if field in _lower_case_key_map:
+            key = _lower_case_key_map[field]
+            value = value.lower()
+        else:
+            key = _map_key(field)
 
-        # For now treat everything as a regex so we can support case insensitive
-        # matching. We should really store everything in lowercase so that we
-        # can do direct match with out regex as this is more efficient.
-        value = value.replace('*', '.*')
-        value = value.replace('(', '\(')
-        value = value.replace('[', '\[')
-        value = value.replace('+', '\+')
-        value = re.compile('^%s$' % value, flags=re.IGNORECASE)
+        # Use a direct match whenever we can, as it can use an index.
+        if '*' not in value:
+            return {key: value}
 
-        return {self.args[0]: value}
+        # Otherwise * is a wildcard. A trailing wildcard is dropped so that
+        # the regex is a prefix match, which can also use an index.
+        pieces = [re.escape(x) for x in value.split('*')]
+        pattern = '^' + '.*'.join(pieces)
+        if pattern.endswith('.*'):
+            pattern = pattern[:-2]
+        else:
+            pattern += '$'
+
+        return {key: re.compile(pattern)}
 
 # boolean operators
 class BooleanOp(Operator):
@@ -189,8 +232,12 @@ boolean_expression = operatorPrecedence(comparison,
                            [(AND, 2, opAssoc.LEFT, BooleanOp),
                             (OR, 2, opAssoc.LEFT, BooleanOp)]
                           )
-similar_operand = smiles_field | string
-similar_expression = operatorPrecedence(similar_operand, [(SIMILAR, 2, opAssoc.LEFT, Similar)])
+# SMILES use many more characters than the other strings, such as # and @
+smiles_string = Word(''.join(c for c in printables if c != '~'))
+similar_expression = Group(smiles_field + Literal(SIMILAR) +
+                           smiles_string).setParseAction(Similar)
+
+query_expression = similar_expression | boolean_expression
 
 class InvalidQuery(Exception):
     def __init__(self, query):
@@ -199,49 +246,46 @@ class InvalidQuery(Exception):
     def __str__(self, *args, **kwargs):
         return "Invalid query: %s" % self.query
 
-def _replace_key(d, key, new_key):
-    for k, v in d.items():
-        if isinstance(v, dict):
-            _replace_key(v, key, new_key)
-        elif isinstance(v, list):
-            for i in v:
-                _replace_key(i, key, new_key)
-
-        if k == key:
-            d[new_key] = v
-            del d[key]
-
-    return d
-
-# Map query key to mongodb properties
-_key_map = {
-        'mass': 'properties.mass',
-        'atomCount': 'properties.atomCount',
-        'heavyAtomCount': 'properties.heavyAtomCount',
-        'formula': 'properties.formula'
-}
+# The number of parsed queries to keep around. Parsing is by far the most
+# expensive part of converting a query.
+PARSE_CACHE_SIZE = 1024
 
-# main function used by external modules to convert query into dict that can
-# be used with pymongo find function.
-def to_mongo_query(query):
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse(query):
+    """Parse the query string and return the root Operator of its AST.
 
+    The result is cached, so the returned AST must not be modified.
+    """
     try:
-        result = boolean_expression.parseString(query, parseAll=True)
+        result = query_expression.parseString(query, parseAll=True)
+    except ParseException:
+        raise InvalidQuery(query)
 
-        if len(result) != 1:
-            raise InvalidQuery(query)
+    if len(result) != 1:
+        raise InvalidQuery(query)
 
-        if not isinstance(result[0], Operator):
-            raise InvalidQuery(query)
+    if not isinstance(result[0], Operator):
+        raise InvalidQuery(query)
 
-        q = result[0].query()
+    return result[0]
 
-        for (key, value) in _key_map.items():
-            print(key)
-            _replace_key(q, key, value)
+# Returns the smiles to search for if this is a similarity query, otherwise
+# None.
+def to_similarity_query(query):
+    ast = parse(query)
+    if isinstance(ast, Similar):
+        return ast.smiles
 
-        print(q)
+    return None
 
-        return q
+# main function used by external modules to convert query into dict that can
+# be used with pymongo find function.
+def to_mongo_query(query):
+    ast = parse(query)
+    if isinstance(ast, Similar):
+        raise InvalidQuery(query)
+
+    try:
+        return ast.query()
     except ParseException:
         raise InvalidQuery(query)
@@ -0,0 +1,91 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from utilities import cjson_stream
+
+#
+# Benchmark of the peak memory and time taken to parse large calculation
+# output files, read whole (as _file_to_cjson used to: the file is read and
+# decoded, copied into a SpooledTemporaryFile, then parsed with json.load)
+# and streamed with cjson_stream.
+#
+# The files are synthetic cjson whose size is dominated by a cube and the MO
+# coefficients, as for real outputs. The peak includes the parsed cjson, which
+# is the same for both, and is measured by tracemalloc, which also slows
+# both down.
+#
+# Run from this directory with:
+#
+#   PYTHONPATH=.. python benchmark_cjson_stream.py [size in MB ...]
+#
+
+SIZES = [100, 300]
+
+
+def write_cjson(f, size):
+    # About 20 bytes per number
+    count = size * 1024 * 1024 // 20
+    rng = np.random.default_rng(0)
+    f.write(b'{"chemicalJson": 1, "atoms": {"elements": {"number": [6, 1]}, '
+            b'"coords": {"3d": [0.0, 0.0, 0.0, 1.0, 0.0, 0.0]}}, ')
+    for key, n in (('orbitals', count // 4), ('cube', count - count // 4)):
+        f.write(b'"%s": {"values": [' % key.encode())
+        for start in range(0, n, 100000):
+            values = rng.standard_normal(min(100000, n - start))
+            if start:
+                f.write(b', ')
+            f.write(', '.join(map(repr, values.tolist())).encode())
+        f.write(b']}, ' if key == 'orbitals' else b']}')
+    f.write(b'}')
+
+
+def read_whole(path):
+    with open(path, 'rb') as f:
+        calc_data = f.read().decode()
+
+    with tempfile.SpooledTemporaryFile(mode='w+',
+                                       max_size=10*1024*1024) as tf:
+        tf.write(calc_data)
+        tf.seek(0)
+        return json.load(tf)
+
+
+def read_stream(path):
+    with open(path, 'rb') as f:
+        return cjson_stream.load(f)
+
+
+def bench(func, path):
+    tracemalloc.start()
+    start = time.time()
+    func(path)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak / 1024 ** 2, elapsed
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or SIZES
+
+    print('%8s %10s %14s %10s' % ('File MB', 'Reader', 'Peak MB', 'Time (s)'))
+    for size in sizes:
+        fd, path = tempfile.mkstemp(suffix='.cjson')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_cjson(f, size)
+            file_size = os.path.getsize(path) / 1024 ** 2
+
+            for name, func in (('whole', read_whole), ('stream', read_stream)):
+                peak, elapsed = bench(func, path)
+                print('%8.0f %10s %14.0f %10.1f' % (file_size, name, peak,
+                                                    elapsed))
+        finally:
+            os.remove(path)
@@ -0,0 +1,89 @@
+import timeit
+
+import bson
+import numpy as np
+
+from utilities import packed_arrays
+
+#
+# Benchmark of the size of calculation documents, and of the time taken to
+# encode, decode and expand them, with their cjson arrays stored as BSON
+# arrays of doubles, and packed as float64 and float32.
+#
+# The documents are synthetic calculations, with the arrays that dominate the
+# size of real ones: coordinates, vibrational eigenvectors, MO coefficients,
+# and a cached cube. Decode is the time to load a document as it is stored,
+# Load includes expanding the packed arrays back to lists.
+#
+# Run from this directory with:
+#
+#   PYTHONPATH=.. python benchmark_packed_arrays.py
+#
+
+# (atoms, basis functions, cube points per side)
+SIZES = [(20, 150, 40), (50, 500, 80)]
+
+
+def synthetic_calculation(rng, atoms, basis, points):
+    modes = 3 * atoms
+    return {
+        'cjson': {
+            'atoms': {
+                'elements': {'number': [6] * atoms},
+                'coords': {'3d': (rng.random(3 * atoms) * 10).tolist()}
+            },
+            'vibrations': {
+                'modes': list(range(modes)),
+                'frequencies': (rng.random(modes) * 3000).tolist(),
+                'eigenVectors': rng.standard_normal((modes, modes)).tolist()
+            },
+            'orbitals': {
+                'moCoefficients': rng.standard_normal(basis * basis).tolist()
+            },
+            'cube': {
+                'dimensions': [points] * 3,
+                'scalars': rng.standard_normal(points ** 3).tolist()
+            }
+        }
+    }
+
+
+def bench(func):
+    # Milliseconds, best of 5
+    return min(timeit.repeat(func, repeat=5, number=1)) * 1e3
+
+
+def load(data):
+    doc = bson.decode(data)
+    packed_arrays.unpack_cjson(doc['cjson'])
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+
+    for atoms, basis, points in SIZES:
+        doc = synthetic_calculation(rng, atoms, basis, points)
+
+        print('Atoms: %d, basis functions: %d, cube: %d^3' %
+              (atoms, basis, points))
+        print('  %-10s %12s %12s %12s %12s' % ('', 'Size (MB)', 'Save (ms)',
+                                               'Decode (ms)', 'Load (ms)'))
+        for dtype in [None, 'float64', 'float32']:
+            if dtype is None:
+                stored = doc
+            else:
+                stored = dict(doc, cjson=packed_arrays.pack_cjson(doc['cjson'],
+                                                                  dtype))
+
+            data = bson.encode(stored)
+            size = len(data) / 1e6
+            if dtype is None:
+                save = bench(lambda: bson.encode(stored))
+            else:
+                save = bench(lambda: bson.encode(dict(
+                    doc, cjson=packed_arrays.pack_cjson(doc['cjson'], dtype))))
+            decode = bench(lambda: bson.decode(data))
+            load_time = bench(lambda: load(data))
+
+            print('  %-10s %12.2f %12.1f %12.1f %12.1f' % (
+                dtype or 'list', size, save, decode, load_time))
@@ -0,0 +1,155 @@
+import contextlib
+import io
+import re
+import timeit
+
+import query
+
+#
+# Benchmark of the parse and plan latency of the query planner, compared
+# with the previous implementation, which reparsed every query and then
+# remapped the keys with one walk of the result per mapped key.
+#
+# Run from this directory with:
+#
+#   PYTHONPATH=.. python benchmark_query.py
+#
+
+# Query strings as sent by the web client
+corpus = [
+    'name~eq~ethane',
+    'name~eq~caffeine',
+    'name~eq~acetic*',
+    'formula~eq~C2H6',
+    'formula~eq~C8H10N4O2',
+    'inchikey~eq~OTMSDBZUPAUEDD-UHFFFAOYSA-N',
+    'inchi~eq~InChI=1S/C2H6/c1-2/h1-2H3',
+    'inchi~eq~InChI=1S/C2H6*',
+    'smiles~eq~CC',
+    'smiles~eq~CC=O',
+    'mass~gt~100',
+    'mass~gt~100~and~mass~lt~200',
+    'atomCount~lt~10~or~mass~lt~10~and~mass~gt~100',
+    'heavyAtomCount~gte~6~and~atomCount~lte~24',
+    'name~eq~benzene~or~formula~eq~C6H6',
+    'mass~gt~1~and~mass~gt~2~and~mass~gt~3~or~mass~lt~1',
+    'mass~lt~1~and~atomCount~gt~23~or~atomCount~lt~1~and~mass~lt~0',
+]
+
+
+def _legacy_replace_key(d, key, new_key):
+    # The original iterated over the dict while changing its keys, which is
+    # an error in Python 3, so iterate over a copy of the items instead.
+    for k, v in list(d.items()):
+        if isinstance(v, dict):
+            _legacy_replace_key(v, key, new_key)
+        elif isinstance(v, list):
+            for i in v:
+                _legacy_replace_key(i, key, new_key)
+
+        if k == key:
+            d[new_key] = v
+            del d[key]
+
+    return d
+
+
+def _legacy_string_equals(self):
+    value = self.args[1]
+    value = value.strip()
+    value = value.replace('*', '.*')
+    value = value.replace('(', '\\(')
+    value = value.replace('[', '\\[')
+    value = value.replace('+', '\\+')
+    value = re.compile('^%s$' % value, flags=re.IGNORECASE)
+
+    return {self.args[0]: value}
+
+
+class _LegacyStringEquals(query.StringEquals):
+    query = _legacy_string_equals
+
+
+class _LegacyComparison(query.Comparison):
+    def query(self):
+        return {self.args[0]: {self._op_map[self.op]: self.args[1]}}
+
+
+class _LegacyNumericEquals(query.NumericEquals):
+    def query(self):
+        return {self.args[0]: self.args[1]}
+
+
+def _legacy_grammar():
+    from pyparsing import operatorPrecedence, opAssoc
+
+    numeric_comparison = operatorPrecedence(
+        query.comparison_operand,
+        [(query.GT, 2, opAssoc.LEFT, _LegacyComparison),
+         (query.GTE, 2, opAssoc.LEFT, _LegacyComparison),
+         (query.LT, 2, opAssoc.LEFT, _LegacyComparison),
+         (query.LTE, 2, opAssoc.LEFT, _LegacyComparison),
+         (query.NE, 2, opAssoc.LEFT, _LegacyComparison),
+         (query.EQ, 2, opAssoc.LEFT, _LegacyNumericEquals)])
+
+    string_comparison = operatorPrecedence(
+        query.comparison_string_operand,
+        [(query.EQ, 2, opAssoc.LEFT, _LegacyStringEquals),
+         (query.NE, 2, opAssoc.LEFT, _LegacyComparison)])
+
+    comparison = numeric_comparison | string_comparison
+
+    return operatorPrecedence(comparison,
+                              [(query.AND, 2, opAssoc.LEFT, query.BooleanOp),
+                               (query.OR, 2, opAssoc.LEFT, query.BooleanOp)])
+
+
+_legacy_boolean_expression = _legacy_grammar()
+
+
+def legacy_to_mongo_query(query_string):
+    result = _legacy_boolean_expression.parseString(query_string,
+                                                    parseAll=True)
+    q = result[0].query()
+
+    # The original printed every key and the result
+    with contextlib.redirect_stdout(io.StringIO()):
+        for (key, value) in query._key_map.items():
+            print(key)
+            _legacy_replace_key(q, key, value)
+
+        print(q)
+
+    return q
+
+
+def bench(func, repeat=3, number=3):
+    def run():
+        for query_string in corpus:
+            func(query_string)
+
+    times = timeit.repeat(run, repeat=repeat, number=number)
+    # Microseconds per query, best of the repeats
+    return min(times) / (number * len(corpus)) * 1e6
+
+
+if __name__ == '__main__':
+    # Make sure both implementations accept the whole corpus
+    for query_string in corpus:
+        legacy_to_mongo_query(query_string)
+        query.to_mongo_query(query_string)
+
+    legacy = bench(legacy_to_mongo_query)
+
+    query.parse.cache_clear()
+    cold = bench(lambda q: (query.parse.cache_clear(),
+                            query.to_mongo_query(q)))
+
+    query.parse.cache_clear()
+    warm = bench(query.to_mongo_query)
+
+    print('Queries in corpus: %d' % len(corpus))
+    print('Before (parse + remap keys):   %8.1f us/query' % legacy)
+    print('After, uncached parse:         %8.1f us/query' % cold)
+    print('After, cached parse:           %8.1f us/query' % warm)
+    print('Speedup (cached):              %8.1fx' % (legacy / warm))
@@ -0,0 +1,69 @@
+import timeit
+
+import numpy as np
+
+from utilities.fingerprint_index import FingerprintIndex
+
+#
+# Benchmark of the latency of similarity searches with the in memory
+# fingerprint index, at 10^5 and 10^6 molecules. The fingerprints are random
+# 1024 bit (FP2 sized) fingerprints, with about 10% of the bits set, which
+# is typical of FP2 fingerprints of drug like molecules.
+#
+# Run from this directory with:
+#
+#   PYTHONPATH=.. python benchmark_similarity.py
+#
+
+FINGERPRINT_BYTES = 128
+SIZES = [10 ** 5, 10 ** 6]
+QUERIES = 20
+
+
+def random_fingerprints(rng, n, chunk_size=10000):
+    chunks = []
+    for start in range(0, n, chunk_size):
+        m = min(chunk_size, n - start)
+        bits = rng.random((m, FINGERPRINT_BYTES * 8)) < 0.1
+        chunks.append(np.packbits(bits, axis=1, bitorder='little'))
+
+    return np.concatenate(chunks)
+
+
+def bench(func, fps):
+    times = []
+    for fp in fps:
+        times.append(min(timeit.repeat(lambda: func(fp), repeat=3, number=1)))
+
+    # Milliseconds per query, median over the queries
+    return np.median(times) * 1e3
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    queries = [x.tobytes() for x in random_fingerprints(rng, QUERIES)]
+
+    print('Fingerprint bits: %d' % (FINGERPRINT_BYTES * 8))
+    for size in SIZES:
+        fps = random_fingerprints(rng, size)
+        index = FingerprintIndex(FINGERPRINT_BYTES)
+
+        start = timeit.default_timer()
+        index.add_many(range(size), (x.tobytes() for x in fps))
+        load = timeit.default_timer() - start
+
+        top_k = bench(lambda fp: index.search(fp, k=25), queries)
+        threshold = bench(lambda fp: index.search(fp, threshold=0.3),
+                          queries)
+
+        start = timeit.default_timer()
+        for i in range(1000):
+            index.remove(i)
+            index.add(i, fps[i].tobytes())
+        update = (timeit.default_timer() - start) / 2000 * 1e6
+
+        print('Molecules: %d' % size)
+        print('  Load:                  %8.1f s' % load)
+        print('  Top 25 query:          %8.1f ms' % top_k)
+        print('  Threshold 0.3 query:   %8.1f ms' % threshold)
+        print('  Add or remove:         %8.1f us' % update)
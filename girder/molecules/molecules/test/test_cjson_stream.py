@@ -0,0 +1,77 @@
+import io
+import json
+import math
+import unittest
+
+from utilities import cjson_stream
+
+#
+# unit tests for the streaming cjson parser
+#
+def cjson():
+    return {
+        'chemicalJson': 1,
+        'name': 'ethane "C2H6" é',
+        'atoms': {
+            'elements': {'number': [6, 6, 1, 1, 1, 1, 1, 1]},
+            'coords': {'3d': [0.5 * x - 3.25 for x in range(24)]}
+        },
+        'bonds': {
+            'connections': {'index': [0, 1, 0, 2]},
+            'order': [1, 1]
+        },
+        'vibrations': {
+            'eigenVectors': [[1e-20 * x, -2.5e+30, 0, 7] for x in range(5)],
+            'modes': []
+        },
+        'properties': {
+            'totalEnergy': -79.8,
+            'converged': True,
+            'comment': None,
+            'empty': {}
+        }
+    }
+
+
+def load(data, chunk_size):
+    return cjson_stream.load(io.BytesIO(data), chunk_size)
+
+
+class TestCjsonStream(unittest.TestCase):
+
+    def test_load(self):
+        doc = cjson()
+        for indent in (None, 2):
+            data = json.dumps(doc, indent=indent, ensure_ascii=False).encode()
+            # Small chunks cut every token at some point
+            for chunk_size in (1, 2, 3, 5, 64, cjson_stream.CHUNK_SIZE):
+                self.assertEqual(load(data, chunk_size), doc)
+
+    def test_types(self):
+        data = b'[1, 1.0, -0, 1e3, "1", true, false, null]'
+        value = load(data, 4)
+        self.assertEqual(value, json.loads(data))
+        self.assertEqual([type(x) for x in value],
+                         [type(x) for x in json.loads(data)])
+
+    def test_constants(self):
+        value = load(b'[NaN, Infinity, -Infinity]', 2)
+        self.assertTrue(math.isnan(value[0]))
+        self.assertEqual(value[1:], [float('inf'), float('-inf')])
+
+    def test_long_string(self):
+        value = 'x' * 100000 + '\\"'
+        data = json.dumps({'value': value}).encode()
+        self.assertEqual(load(data, 16), {'value': value})
+
+    def test_invalid(self):
+        invalid = [b'', b'[1,]', b'{"a": 1,}', b'[1 2]', b'{"a" 1}',
+                   b'[01]', b'[1]]', b'{"a": [1}', b'"abc', b'[tru]', b'1e']
+        for data in invalid:
+            for chunk_size in (1, 3, cjson_stream.CHUNK_SIZE):
+                with self.assertRaises(ValueError):
+                    load(data, chunk_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
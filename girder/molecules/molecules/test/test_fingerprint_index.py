@@ -0,0 +1,83 @@
+import unittest
+
+import numpy as np
+
+from utilities import fingerprint_index
+from utilities.fingerprint_index import FingerprintIndex, popcount
+
+#
+# unit tests for the similarity search index
+#
+def fp(*bits):
+    data = np.zeros(16, dtype=np.uint8)
+    for bit in bits:
+        data[bit // 8] |= 1 << (bit % 8)
+
+    return data.tobytes()
+
+
+class TestFingerprintIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = FingerprintIndex(16, capacity=2)
+        self.index.add('a', fp(1, 2, 3, 4))
+        self.index.add('b', fp(1, 2))
+        self.index.add('c', fp(100, 101))
+
+    def test_popcount(self):
+        fps = np.frombuffer(fp(0, 7, 8, 127) + fp(), dtype=np.uint8)
+        self.assertEqual(list(popcount(fps.reshape(2, 16))), [4, 0])
+
+    def test_search(self):
+        num_matches, results = self.index.search(fp(1, 2, 3))
+        self.assertEqual(num_matches, 3)
+        self.assertEqual(results, [('a', 0.75), ('b', 2 / 3), ('c', 0.0)])
+
+    def test_top_k(self):
+        num_matches, results = self.index.search(fp(1, 2, 3), k=1)
+        self.assertEqual(num_matches, 3)
+        self.assertEqual(results, [('a', 0.75)])
+
+        num_matches, results = self.index.search(fp(1, 2, 3), k=1, offset=1)
+        self.assertEqual(results, [('b', 2 / 3)])
+
+    def test_threshold(self):
+        num_matches, results = self.index.search(fp(1, 2, 3), threshold=0.7)
+        self.assertEqual(num_matches, 1)
+        self.assertEqual(results, [('a', 0.75)])
+
+    def test_update(self):
+        self.index.remove('a')
+        self.index.add('b', fp(100))
+        # c is already in the index, so add_many leaves it as it is
+        self.index.add_many(['c', 'd'], [fp(1), fp(1, 2, 3)])
+
+        self.assertEqual(len(self.index), 3)
+        self.assertNotIn('a', self.index)
+        num_matches, results = self.index.search(fp(1, 2, 3), threshold=0.1)
+        self.assertEqual(results, [('d', 1.0)])
+        num_matches, results = self.index.search(fp(100))
+        self.assertEqual(results, [('b', 1.0), ('c', 0.5), ('d', 0.0)])
+
+    def test_screen(self):
+        self.assertEqual(list(self.index.screen(fp(1, 2))), ['a', 'b'])
+        self.assertEqual(list(self.index.screen(fp(3))), ['a'])
+        self.assertEqual(list(self.index.screen(fp(1, 100))), [])
+        self.assertEqual(list(self.index.screen(fp())), ['a', 'b', 'c'])
+
+    def test_screen_chunks(self):
+        chunk_size = fingerprint_index.CHUNK_SIZE
+        fingerprint_index.CHUNK_SIZE = 2
+        try:
+            self.index.add_many(['d', 'e'], [fp(1), fp(1, 2, 5)])
+            self.assertEqual(list(self.index.screen(fp(1, 2))),
+                             ['a', 'b', 'e'])
+        finally:
+            fingerprint_index.CHUNK_SIZE = chunk_size
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.index.add, 'd', b'\0' * 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+
+import bson
+
+from utilities import packed_arrays
+from utilities.packed_arrays import (
+    bson_array, has_packed, is_packed, pack_array, pack_cjson, unpack_array,
+    unpack_cjson, unpack_rows
+)
+
+#
+# unit tests for the packing of cjson arrays
+#
+def cjson():
+    return {
+        'atoms': {
+            'elements': {'number': [1, 8] * 50},
+            'coords': {'3d': [float(x) for x in range(300)]}
+        },
+        'vibrations': {
+            'modes': list(range(10)),
+            'eigenVectors': [[float(x * y) for x in range(10)]
+                             for y in range(10)]
+        }
+    }
+
+
+class TestPackedArrays(unittest.TestCase):
+
+    def test_pack_array(self):
+        value = [0.5 * x for x in range(100)]
+        packed = pack_array(value)
+        self.assertTrue(is_packed(packed))
+        self.assertEqual(packed['shape'], [100])
+        self.assertEqual(len(packed['data']), 800)
+        self.assertEqual(unpack_array(packed).tolist(), value)
+
+        packed = pack_array(value, 'float32')
+        self.assertEqual(len(packed['data']), 400)
+        self.assertEqual(unpack_array(packed).tolist(), value)
+
+    def test_not_packed(self):
+        # Too small, ragged, or not numbers
+        for value in ([1.0] * 10, [[1.0] * 40, [1.0] * 41], ['a'] * 100):
+            self.assertIs(pack_array(value), value)
+
+    def test_cjson(self):
+        original = cjson()
+        packed = pack_cjson(original)
+
+        # The original isn't modified
+        self.assertEqual(original, cjson())
+        self.assertTrue(has_packed(packed))
+        self.assertFalse(has_packed(original))
+        self.assertTrue(is_packed(packed['atoms']['coords']['3d']))
+        self.assertTrue(is_packed(packed['vibrations']['eigenVectors']))
+        # Only the listed arrays are packed
+        self.assertIs(packed['atoms']['elements'],
+                      original['atoms']['elements'])
+        self.assertEqual(packed['vibrations']['eigenVectors']['shape'],
+                         [10, 10])
+
+        self.assertEqual(unpack_cjson(packed), original)
+        self.assertIs(pack_cjson(packed), packed)
+
+    def test_unpack_rows(self):
+        original = cjson()
+        packed = pack_cjson(original)['vibrations']['eigenVectors']
+
+        eigen_vectors = original['vibrations']['eigenVectors']
+        self.assertEqual(unpack_rows(packed, 3, 1), eigen_vectors[3:4])
+        self.assertEqual(unpack_rows(packed, 8, 5), eigen_vectors[8:])
+        self.assertEqual(unpack_rows(packed, 20, 1), [])
+
+    def test_bson_array(self):
+        def encode(value):
+            # The encoded array, without the document around it
+            return bson.encode({'a': value})[7:-1]
+
+        for n in (0, 1, 10, 11, 100, 1234):
+            values = [x / 7.0 for x in range(n)]
+            self.assertEqual(bson_array(encode(values)).tolist(), values)
+
+        self.assertIsNone(bson_array(encode([1.0, 2, 3.0])))
+        self.assertIsNone(bson_array(encode([1.0, 'a'])))
+
+    def test_min_length(self):
+        min_length = packed_arrays.MIN_LENGTH
+        packed_arrays.MIN_LENGTH = 1000
+        try:
+            self.assertFalse(has_packed(pack_cjson(cjson())))
+        finally:
+            packed_arrays.MIN_LENGTH = min_length
+
+
+if __name__ == '__main__':
+    unittest.main()
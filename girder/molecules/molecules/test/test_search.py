@@ -24,11 +24,15 @@ class TestQueryParser(unittest.TestCase):
                 'mass~eq~3.14159': {'properties.mass': 3.14159},
                 'atomCount~eq~3.14159': {'properties.atomCount': 3.14159},
                 'inchi~eq~CH': {'inchi': 'CH'},
-                'inchi~eq~CH*': {'inchi': re.compile('^CH.*$')},
+                'inchi~eq~CH*': {'inchi': re.compile('^CH')},
+                'inchi~eq~C*H': {'inchi': re.compile('^C.*H$')},
+                'inchikey~eq~otmsdbzupaueddd-uhfffaoysa-n': {'inchikey': 'OTMSDBZUPAUEDDD-UHFFFAOYSA-N'},
+                'formula~eq~C2H6': {'properties.formulaLower': 'c2h6'},
+                'name~eq~Acetic*': {'nameLower': re.compile('^acetic')},
                 'inchi~ne~CH': {'inchi': {'$ne': 'CH'}},
                 'inchi~ne~CH*': {'inchi': {'$ne': 'CH*'}},
-                'name~eq~test test~and~mass~gt~1': {'$and': [{'name': 'test test'}, {'properties.mass': {'$gt': 1}}]},
-                'name~eq~3-hydroxymyristic acid [2-[[[5-(2,4-diketopyrimidin-1-yl)-3,4-dihydroxy-tetrahydrofuran-2-yl]methoxy-hydroxy-phosphoryl]oxy-hydroxy-phosphoryl]oxy-5-hydroxy-3-(3-hydroxytetradecanoylamino)-6-methylol-tetrahydropyran-4-yl] ester': {'name': '3-hydroxymyristic acid [2-[[[5-(2,4-diketopyrimidin-1-yl)-3,4-dihydroxy-tetrahydrofuran-2-yl]methoxy-hydroxy-phosphoryl]oxy-hydroxy-phosphoryl]oxy-5-hydroxy-3-(3-hydroxytetradecanoylamino)-6-methylol-tetrahydropyran-4-yl] ester'},
+                'name~eq~test test~and~mass~gt~1': {'$and': [{'nameLower': 'test test'}, {'properties.mass': {'$gt': 1}}]},
+                'name~eq~3-hydroxymyristic acid [2-[[[5-(2,4-diketopyrimidin-1-yl)-3,4-dihydroxy-tetrahydrofuran-2-yl]methoxy-hydroxy-phosphoryl]oxy-hydroxy-phosphoryl]oxy-5-hydroxy-3-(3-hydroxytetradecanoylamino)-6-methylol-tetrahydropyran-4-yl] ester': {'nameLower': '3-hydroxymyristic acid [2-[[[5-(2,4-diketopyrimidin-1-yl)-3,4-dihydroxy-tetrahydrofuran-2-yl]methoxy-hydroxy-phosphoryl]oxy-hydroxy-phosphoryl]oxy-5-hydroxy-3-(3-hydroxytetradecanoylamino)-6-methylol-tetrahydropyran-4-yl] ester'},
                 'atomCount~lte~3.14159': {'properties.atomCount': {'$lte':  3.14159}},
                 'atomCount~gte~3.14159': {'properties.atomCount': {'$gte':  3.14159}},
                 'inchi~eq~InChI=1S/Na.H\n': {'inchi': 'InChI=1S/Na.H'}
@@ -40,6 +44,20 @@ class TestQueryParser(unittest.TestCase):
             print(test_query)
             self.assertEqual(mongo_query , expected)
 
+    def test_cached(self):
+        test_query = 'mass~gt~1~and~atomCount~lt~10'
+        query.to_mongo_query(test_query)
+        hits = query.parse.cache_info().hits
+
+        # The parsed query should be reused, and modifying the result must
+        # not affect later results
+        mongo_query = query.to_mongo_query(test_query)
+        mongo_query['$and'].append({'name': 'test'})
+        self.assertEqual(query.parse.cache_info().hits, hits + 1)
+        self.assertEqual(query.to_mongo_query(test_query),
+                         {'$and': [{'properties.mass': {'$gt': 1}},
+                                   {'properties.atomCount': {'$lt': 10}}]})
+
     def test_invalid(self):
         queries = ['mass~eq~asdfa',
                    'mass~eq~2342gh,mass~eq~~eq~3',
@@ -48,6 +66,28 @@ class TestQueryParser(unittest.TestCase):
         for test_query in queries:
             self.assertRaises(query.InvalidQuery, query.to_mongo_query, test_query)
 
+    def test_similar(self):
+        queries = {'smiles~slr~CCO': 'CCO',
+                   'smiles~slr~C#N': 'C#N',
+                   'smiles~slr~C[C@@H](O)c1ccccc1': 'C[C@@H](O)c1ccccc1',
+                   'mass~gt~100': None,
+                   'smiles~eq~CCO': None}
+
+        for test_query, expected in queries.items():
+            self.assertEqual(query.to_similarity_query(test_query), expected)
+
+        # Similarity searches can't be combined with other queries, or
+        # converted to mongodb queries
+        invalid = ['smiles~slr~CCO~and~mass~gt~1',
+                   'name~slr~ethanol',
+                   'smiles~slr~']
+        for test_query in invalid:
+            self.assertRaises(query.InvalidQuery, query.to_similarity_query,
+                              test_query)
+
+        self.assertRaises(query.InvalidQuery, query.to_mongo_query,
+                          'smiles~slr~CCO')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,16 +1,19 @@
 import functools
 import json
-import requests
 import datetime
 
-from requests_futures.sessions import FuturesSession
+import requests
 
 from girder.constants import TerminalColor
 from girder.models.notification import Notification
-from girder.models.model_base import ValidationException
-from girder.utility.model_importer import ModelImporter
+from girder.models.user import User
 
+from . import conversion_cache
+from . import sessions
+from .sessions import futures_post, Lanes, Services
 from .whitelist_cjson import whitelist_cjson
+from . import cube_cache
+from . import work_queue
 
 from molecules.avogadro import avogadro_base_url
 from molecules.openbabel import openbabel_base_url
@@ -21,18 +24,20 @@ from .. import semantic
 from ..models.molecule import Molecule as MoleculeModel
 
 
+# The types of the jobs in the work queue
+SVG_JOB = 'svg'
+COORDS_3D_JOB = '3d_coords'
+
+
 def schedule_svg_gen(mol, user):
-    query = {
-        '_id': mol['_id']
-    }
+    work_queue.enqueue(SVG_JOB, mol['_id'], user=user)
 
-    updates = {
-        '$set': {
-            'generating_svg': True
-        }
-    }
 
-    super(MoleculeModel, MoleculeModel()).update(query, updates)
+@work_queue.handler(SVG_JOB)
+def _generate_svg(job):
+    mol = MoleculeModel().load(job['key'], force=True)
+    if mol is None or 'svg' in mol:
+        return
 
     base_url = openbabel_base_url()
     path = 'convert'
@@ -45,52 +50,37 @@ def schedule_svg_gen(mol, user):
         'data': mol['smiles']
     }
 
-    session = FuturesSession()
-    future = session.post(url, json=data)
-
-    inchikey = mol['inchikey']
-    future.add_done_callback(functools.partial(_finish_svg_gen,
-                                               inchikey, user))
-
+    resp = sessions.post(Services.OPENBABEL, url, lane=Lanes.INTERACTIVE,
+                         json=data)
+    resp.raise_for_status()
 
-def _finish_svg_gen(inchikey, user, future):
-
-    resp = future.result()
-
-    query = {
-        'inchikey': inchikey
+    updates = {
+        '$set': {
+            'svg': resp.text
+        }
     }
 
-    updates = {}
-    updates.setdefault('$unset', {})['generating_svg'] = ''
+    super(MoleculeModel, MoleculeModel()).update({'_id': mol['_id']},
+                                                 updates)
 
-    if resp.status_code == 200:
-        updates.setdefault('$set', {})['svg'] = resp.text
-    else:
-        print('Generating SVG failed!')
-        print('Status code was:', resp.status_code)
-        print('Reason was:', resp.reason)
 
-    update_result = super(MoleculeModel,
-                          MoleculeModel()).update(query, updates)
-
-    if update_result.matched_count == 0:
-        raise ValidationException('Invalid inchikey (%s)' % inchikey)
-
-
-def schedule_3d_coords_gen(mol, user, on_complete=None,
+def schedule_3d_coords_gen(mol, user, upload_semantic=False,
                            gen3d_forcefield='mmff94', gen3d_steps=100):
-    query = {
-        '_id': mol['_id']
+    payload = {
+        'gen3dForcefield': gen3d_forcefield,
+        'gen3dSteps': gen3d_steps,
+        # Upload the molecule to Jena once it has 3D coordinates
+        'uploadSemantic': upload_semantic
     }
 
-    updates = {
-        '$set': {
-            'generating_3d_coords': True
-        }
-    }
+    work_queue.enqueue(COORDS_3D_JOB, mol['_id'], payload, user)
 
-    super(MoleculeModel, MoleculeModel()).update(query, updates)
+
+@work_queue.handler(COORDS_3D_JOB)
+def _generate_3d_coords(job):
+    mol = MoleculeModel().load(job['key'], force=True)
+    if mol is None or MoleculeModel().has_3d_coords(mol):
+        return
 
     base_url = openbabel_base_url()
     path = 'convert'
@@ -102,53 +92,54 @@ def schedule_3d_coords_gen(mol, user, on_complete=None,
         'format': 'smi',
         'data': mol['smiles'],
         'gen3d': True,
-        'gen3dForcefield': gen3d_forcefield,
-        'gen3dSteps': gen3d_steps
+        'gen3dForcefield': job['payload']['gen3dForcefield'],
+        'gen3dSteps': job['payload']['gen3dSteps']
     }
 
-    session = FuturesSession()
-    future = session.post(url, json=data)
-
-    inchikey = mol['inchikey']
-    future.add_done_callback(functools.partial(_finish_3d_coords_gen,
-                                               inchikey, user, on_complete))
+    # Force field optimizations can take minutes, so they are in the bulk
+    # lane to keep them from holding up interactive requests
+    resp = sessions.post(Services.OPENBABEL, url, lane=Lanes.BULK, json=data)
+    resp.raise_for_status()
 
-
-def _finish_3d_coords_gen(inchikey, user, on_complete, future):
-
-    resp = future.result()
-
-    query = {
-        'inchikey': inchikey
+    cjson = json.loads(avogadro.convert_str(resp.text, 'sdf', 'cjson',
+                                            lane=Lanes.BULK))
+    # This skips the save events, so the updated time that the conversions
+    # of the cjson are keyed by is set here, and the conversions of the
+    # cjson without 3D coordinates are dropped
+    updates = {
+        '$set': {
+            'cjson': whitelist_cjson(cjson),
+            'updated': datetime.datetime.utcnow()
+        }
     }
 
-    updates = {}
-    updates.setdefault('$unset', {})['generating_3d_coords'] = ''
-
-    if resp.status_code == 200:
-        sdf_data = resp.text
-        cjson = json.loads(avogadro.convert_str(sdf_data, 'sdf',
-                                                'cjson'))
-        cjson = whitelist_cjson(cjson)
-        updates.setdefault('$set', {})['cjson'] = cjson
-    else:
-        print('Generating SDF failed!')
-        print('Status code was:', resp.status_code)
-        print('Reason was:', resp.reason)
-
-    update_result = super(MoleculeModel,
-                          MoleculeModel()).update(query, updates)
-
-    if update_result.matched_count == 0:
-        raise ValidationException('Invalid inchikey (%s)' % inchikey)
-
-    # Call the on_complete callback is we have one.
-    if on_complete is not None:
-        mol = MoleculeModel().findOne(query)
-        on_complete(mol)
+    super(MoleculeModel, MoleculeModel()).update({'_id': mol['_id']},
+                                                 updates)
+    conversion_cache.invalidate(mol['_id'])
+
+    if job['payload'].get('uploadSemantic'):
+        mol = MoleculeModel().load(mol['_id'], force=True)
+        try:
+            semantic.upload_molecule(mol)
+        except requests.ConnectionError:
+            print(TerminalColor.warning('WARNING: Couldn\'t connect to Jena.'))
+
+
+def generating_flags(mol):
+    """Get whether the SVG and 3D coordinates of mol are being generated.
+
+    These are derived from the jobs in the work queue.
+    """
+    return {
+        'generating_svg': ('svg' not in mol and
+                           work_queue.is_active(SVG_JOB, mol['_id'])),
+        'generating_3d_coords': (
+            not MoleculeModel().has_3d_coords(mol) and
+            work_queue.is_active(COORDS_3D_JOB, mol['_id']))
+    }
 
 
-def schedule_orbital_gen(cjson, mo, id, orig_mo, user):
+def schedule_orbital_gen(cjson, mo, id, orig_mo, user, resolution=None):
     cjson['generating_orbital'] = True
 
     base_url = avogadro_base_url()
@@ -159,17 +150,24 @@ def schedule_orbital_gen(cjson, mo, id, orig_mo, user):
         'cjson': cjson,
         'mo': mo,
     }
+    if resolution:
+        data['resolution'] = resolution
 
-    session = FuturesSession()
-    future = session.post(url, json=data)
+    future = futures_post(Services.AVOGADRO, url, lane=Lanes.INTERACTIVE,
+                          json=data)
 
     future.add_done_callback(functools.partial(
-        _finish_orbital_gen, mo, id, user, orig_mo))
+        _finish_orbital_gen, mo, id, user, orig_mo, resolution))
+
 
+def _finish_orbital_gen(mo, id, user, orig_mo, resolution, future):
+    try:
+        resp = future.result()
+    except Exception as e:
+        resp = None
+        error = str(e)
 
-def _finish_orbital_gen(mo, id, user, orig_mo, future):
-    resp = future.result()
-    if resp.status_code == 200:
+    if resp is not None and resp.status_code == 200:
         cjson = json.loads(resp.text)
         cjson['generating_orbital'] = False
 
@@ -177,18 +175,36 @@ def _finish_orbital_gen(mo, id, user, orig_mo, future):
             del cjson['vibrations']
 
         # Add cube to cache
-        ModelImporter.model('cubecache', 'molecules').create(id, mo, cjson)
+        waiters = cube_cache.complete(id, mo, cjson, resolution)
 
         # Create notification to indicate cube can be retrieved now
-        data = {'id': id, 'mo': orig_mo}
+        data = {'id': id, 'mo': orig_mo, 'resolution': resolution}
     else:
+        waiters = cube_cache.fail(id, mo, resolution)
+        if resp is not None:
+            error = 'Status code ' + str(resp.status_code)
+
         data = {
             'id': id,
             'mo': orig_mo,
-            'error': 'Status code ' + str(resp.status_code) + ': Orbital could not be calculated.'}
-
-    Notification().createNotification(
-        type='cube.status',
-        data=data,
-        user=user,
-        expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=30))
+            'resolution': resolution,
+            'error': error + ': Orbital could not be calculated.'}
+
+    notify_cube_status(data, waiters, user)
+
+
+def notify_cube_status(data, user_ids, user=None):
+    """Notify user, and the users with user_ids, that a cube is ready."""
+    users = [user] if user else []
+    for user_id in user_ids:
+        if not user or user_id != user['_id']:
+            waiter = User().load(user_id, force=True)
+            if waiter:
+                users.append(waiter)
+
+    for u in users:
+        Notification().createNotification(
+            type='cube.status',
+            data=data,
+            user=u,
+            expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=30))
@@ -0,0 +1,194 @@
+import codecs
+import json
+import re
+
+# Parses cjson from a file object as it is read, CHUNK_SIZE bytes at a time,
+# rather than reading the whole file into memory first. The output of a
+# calculation can be hundreds of MB, so that the file is only ever held in
+# memory a chunk at a time, alongside the cjson that is parsed from it.
+#
+# Most of a large cjson file is arrays of numbers (coordinates, eigenvectors,
+# MO coefficients, cubes). The numbers that are followed by a comma in the
+# buffer are decoded a run at a time by json.loads, the rest of the document
+# token by token.
+
+CHUNK_SIZE = 1024 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER = r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?'
+# The first character that can't be part of a run of numbers
+_NOT_NUMBERS = re.compile(r'[^0-9eE.+\- \t\n\r,]')
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_SCALAR = re.compile(r'%s|true|false|null|NaN|-?Infinity' % _NUMBER)
+# A number that ends this close to the end of the buffer may go on after it,
+# such as 1 followed by e+ and the next chunk
+_LOOKAHEAD = 2
+
+# Accepted by json.load, so they are accepted here too
+_CONSTANTS = {
+    'true': True,
+    'false': False,
+    'null': None,
+    'NaN': float('nan'),
+    'Infinity': float('inf'),
+    '-Infinity': float('-inf')
+}
+
+
+class _Buffer(object):
+    # The part of the file that has been read but not parsed yet
+
+    def __init__(self, f, chunk_size):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        # The number of characters before text, for errors
+        self.offset = 0
+        self.eof = False
+
+    def fill(self):
+        # A token that doesn't fit in the buffer at least doubles what is
+        # read next, so that long strings take a linear time to read.
+        size = max(self._chunk_size, len(self.text) - self.pos)
+        data = self._file.read(size)
+        self.eof = not data
+        self.offset += self.pos
+        self.text = self.text[self.pos:] + self._decoder.decode(
+            data, final=self.eof)
+        self.pos = 0
+
+    def peek(self):
+        # The next character that isn't whitespace, or '' at the end
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text) or self.eof:
+                return self.text[self.pos:self.pos + 1]
+
+            self.fill()
+
+    def match(self, pattern):
+        # Read until the match can't be cut short by the end of the buffer
+        while True:
+            m = pattern.match(self.text, self.pos)
+            if self.eof or (m is not None and
+                            m.end() + _LOOKAHEAD < len(self.text)):
+                return m
+
+            self.fill()
+
+    def error(self, message):
+        return ValueError('Invalid cjson at character %d: %s' %
+                          (self.offset + self.pos, message))
+
+
+def _read_token(buf, pattern, what):
+    m = buf.match(pattern)
+    if m is None:
+        raise buf.error('expected %s' % what)
+
+    buf.pos = m.end()
+    token = m.group()
+    if token in _CONSTANTS:
+        return _CONSTANTS[token]
+
+    return json.loads(token)
+
+
+def _read_key(buf):
+    if buf.peek() != '"':
+        raise buf.error('expected a key')
+
+    key = _read_token(buf, _STRING, 'a key')
+    if buf.peek() != ':':
+        raise buf.error("expected ':'")
+    buf.pos += 1
+
+    return key
+
+
+def _read_numbers(buf, array):
+    # Append the numbers up to the last comma before the end of the run, or
+    # of the buffer, to array. json.loads checks that they are numbers.
+    while buf.peek():
+        m = _NOT_NUMBERS.search(buf.text, buf.pos)
+        end = m.start() if m is not None else len(buf.text)
+        comma = buf.text.rfind(',', buf.pos, end)
+        if comma < 0 or not buf.text[buf.pos:comma].strip():
+            return
+
+        try:
+            array.extend(json.loads('[%s]' % buf.text[buf.pos:comma]))
+        except ValueError:
+            raise buf.error('expected numbers')
+        buf.pos = comma + 1
+        if end < len(buf.text):
+            return
+
+
+def load(f, chunk_size=CHUNK_SIZE):
+    """Parse the cjson of the binary file object f, as it is read."""
+    buf = _Buffer(f, chunk_size)
+    # The arrays and objects that are being parsed, and the key of the value
+    # that is being parsed for each object
+    stack = []
+    keys = []
+    while True:
+        c = buf.peek()
+        if c == '{':
+            buf.pos += 1
+            if buf.peek() != '}':
+                stack.append({})
+                keys.append(_read_key(buf))
+                continue
+
+            buf.pos += 1
+            value = {}
+        elif c == '[':
+            buf.pos += 1
+            if buf.peek() != ']':
+                stack.append([])
+                keys.append(None)
+                _read_numbers(buf, stack[-1])
+                continue
+
+            buf.pos += 1
+            value = []
+        elif c == '"':
+            value = _read_token(buf, _STRING, 'a string')
+        elif c:
+            value = _read_token(buf, _SCALAR, 'a value')
+        else:
+            raise buf.error('unexpected end of file')
+
+        # Add the value to its container, and close the containers that end
+        # with it
+        while stack:
+            container = stack[-1]
+            if isinstance(container, list):
+                container.append(value)
+                end = ']'
+            else:
+                container[keys[-1]] = value
+                end = '}'
+
+            c = buf.peek()
+            buf.pos += 1
+            if c == ',':
+                if end == ']':
+                    _read_numbers(buf, container)
+                else:
+                    keys[-1] = _read_key(buf)
+                break
+            elif c != end:
+                buf.pos -= 1
+                raise buf.error("expected ',' or '%s'" % end)
+
+            value = stack.pop()
+            keys.pop()
+        else:
+            if buf.peek():
+                raise buf.error('extra data')
+
+            return value
@@ -0,0 +1,165 @@
+import datetime
+import hashlib
+import json
+
+from girder.models.setting import Setting
+
+from molecules import avogadro
+from molecules.constants import PluginSettings
+from molecules.models.conversioncache import Conversioncache
+from molecules.utilities.lru_cache import LRUCache
+
+# Cache conversion outputs, such as xyz or sdf, generated from stored cjson.
+# The cjson of a document is keyed by the id of the document, the time it
+# was last saved and the output format, so that it doesn't need to be
+# encoded and hashed to be looked up. Other conversions, and documents saved
+# before they had an updated time, are keyed by a hash of their input and
+# formats. Either way an entry can never be stale, but entries are still
+# invalidated when the cjson of a document changes, so that they don't take
+# up space in the cache.
+
+DEFAULT_SIZE = 1024
+
+_cache = LRUCache(DEFAULT_SIZE)
+_mongo_stats = {
+    'hits': 0,
+    'misses': 0
+}
+
+
+def cache_key(str_data, in_format, out_format):
+    h = hashlib.sha256()
+    for part in (in_format, out_format, str_data):
+        h.update(part.encode())
+        # Separate the parts so that they can't run into each other
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+
+def source_key(source_id, updated, out_format):
+    return cache_key('%s %s' % (source_id, updated.isoformat()), 'source',
+                     out_format)
+
+
+def _mongo_enabled():
+    return Setting().get(PluginSettings.CONVERSION_CACHE_MONGO) is True
+
+
+def _update_size():
+    size = Setting().get(PluginSettings.CONVERSION_CACHE_SIZE)
+    if size is None:
+        size = DEFAULT_SIZE
+
+    size = int(size)
+    if size != _cache.max_size:
+        _cache.resize(size)
+
+
+def _sources(source_ids, source_id):
+    if source_id is None or source_id in source_ids:
+        return source_ids
+
+    return source_ids | {source_id}
+
+
+def _get(key, convert, source_id):
+    # Get the output cached under key, or cache the output of convert(). The
+    # same output can be generated from several documents, the ids of all
+    # of them are kept so that invalidating any of them removes it.
+    _update_size()
+
+    cached = _cache.get(key)
+    if cached is not None:
+        output, source_ids = cached
+        sources = _sources(source_ids, source_id)
+        if sources is not source_ids:
+            _cache.put(key, (output, sources))
+        return output
+
+    output = None
+    mongo = _mongo_enabled()
+    if mongo:
+        output = Conversioncache().find_key(key)
+        if output is not None:
+            _mongo_stats['hits'] += 1
+        else:
+            _mongo_stats['misses'] += 1
+
+    if output is None:
+        output = convert()
+        if mongo:
+            Conversioncache().create(key, output, source_id)
+    elif source_id is not None:
+        Conversioncache().create(key, output, source_id)
+
+    _cache.put(key, (output, _sources(frozenset(), source_id)))
+
+    return output
+
+
+def convert_str(str_data, in_format, out_format, source_id=None):
+    """Convert using avogadro, with the result cached.
+
+    source_id is the id of the document that str_data came from, if any.
+    It is used to invalidate the cached outputs when that document changes.
+    """
+    key = cache_key(str_data, in_format, out_format)
+    return _get(key, lambda: avogadro.convert_str(str_data, in_format,
+                                                  out_format), source_id)
+
+
+def convert_cjson(cjson, out_format, source_id=None, updated=None):
+    """Convert cjson using avogadro, with the result cached.
+
+    source_id is the id of the document that cjson came from, and updated
+    is the time that document was last saved, if known. With both, the
+    cjson is only encoded if its output isn't cached.
+    """
+    if source_id is None or updated is None:
+        return convert_str(json.dumps(cjson), 'cjson', out_format, source_id)
+
+    key = source_key(source_id, updated, out_format)
+    return _get(key, lambda: avogadro.convert_str(json.dumps(cjson), 'cjson',
+                                                  out_format), source_id)
+
+
+def invalidate(source_id):
+    """Remove the outputs generated from the document with this id"""
+    _cache.remove_if(lambda key, value: source_id in value[1])
+
+    if _mongo_enabled():
+        Conversioncache().remove_source(source_id)
+
+
+def on_cjson_saving(event):
+    # Bound to the save events of the models that store cjson, so that the
+    # time is part of the keys of their outputs
+    event.info['updated'] = datetime.datetime.utcnow()
+
+
+def on_cjson_changed(event):
+    # Bound to the save and remove events of the models that store cjson
+    doc = event.info
+    if doc.get('_id') is not None:
+        invalidate(doc['_id'])
+
+
+def stats():
+    memory = _cache.stats()
+    return {
+        'memory': memory,
+        'mongo': {
+            'enabled': _mongo_enabled(),
+            'hits': _mongo_stats['hits'],
+            'misses': _mongo_stats['misses']
+        },
+        'hits': memory['hits'],
+        'misses': memory['misses'] - _mongo_stats['hits']
+    }
+
+
+def clear():
+    _cache.clear()
+    _mongo_stats['hits'] = 0
+    _mongo_stats['misses'] = 0
@@ -0,0 +1,242 @@
+import threading
+import time
+
+from girder.api.rest import RestException
+from girder.models.setting import Setting
+
+from molecules.constants import PluginSettings
+from molecules.models.cubecache import Cubecache
+
+# Cubes are expensive to calculate, so they are cached in the cubecache
+# collection. Only one request calculates a given cube at a time: it holds a
+# pending marker for the cube, and the other requests for the cube wait for
+# it to be ready. The cache is bounded by the total size of the cubes, and
+# the least recently (or frequently) used cubes are evicted.
+
+# In megabytes
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_EVICTION = 'lru'
+
+# The resolutions of the cubes, see the calculate-mo endpoint of the
+# Avogadro service. Progressive requests get a coarse cube straight away,
+# while the cube at the resolution they asked for is calculated.
+RESOLUTIONS = ['coarse', 'medium', 'fine']
+DEFAULT_RESOLUTION = 'medium'
+PROGRESSIVE_RESOLUTION = 'coarse'
+
+# The number of times to try to get a cube whose calculation by another
+# request failed
+ATTEMPTS = 2
+
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'waits': 0,
+    'evictions': 0
+}
+_stats_lock = threading.Lock()
+
+# The size of the cache is added up at most every SIZE_INTERVAL seconds, or
+# when it looks like it is full. In between, the sizes of the cubes that this
+# process caches are added to the last total.
+SIZE_INTERVAL = 60
+_size = {
+    'bytes': None,
+    'time': 0
+}
+_size_lock = threading.Lock()
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+def max_size():
+    size = Setting().get(PluginSettings.CUBE_CACHE_MAX_SIZE)
+    if size is None:
+        size = DEFAULT_MAX_SIZE
+
+    return int(float(size) * 1024 * 1024)
+
+
+def eviction_policy():
+    return Setting().get(PluginSettings.CUBE_CACHE_EVICTION) or DEFAULT_EVICTION
+
+
+def default_resolution():
+    return (Setting().get(PluginSettings.CUBE_RESOLUTION) or
+            DEFAULT_RESOLUTION)
+
+
+def evict(added=0):
+    """Evict cubes if the cache is full, after added bytes were cached."""
+    limit = max_size()
+    if limit <= 0:
+        return
+
+    with _size_lock:
+        if (_size['bytes'] is not None and
+                time.time() - _size['time'] < SIZE_INTERVAL):
+            _size['bytes'] += added
+            if _size['bytes'] <= limit:
+                return
+
+    model = Cubecache()
+    size = model.size()
+    if size > limit:
+        _count('evictions', model.evict(limit, eviction_policy(), size))
+        size = limit
+
+    with _size_lock:
+        _size['bytes'] = size
+        _size['time'] = time.time()
+
+
+def find(calc_id, mo, resolution=None, projection=None):
+    """Get the cached cube of orbital mo, or None"""
+    cached = Cubecache().find_mo(calc_id, mo, resolution, projection)
+    _count('hits' if cached else 'misses')
+
+    return cached
+
+
+def get(calc_id, mo, calculate, resolution=None, notify=None,
+        projection=None):
+    """Get the cached cube of orbital mo, calculating it if needed.
+
+    calculate() returns the cjson of the cube. If another request is already
+    calculating the cube, this waits for it instead. Users may ask for the
+    cube asynchronously while this calculates it, notify(waiters, error) is
+    then called with their ids once it is cached (error is None), or has
+    failed. projection applies to a cube that was already cached, a cube
+    that is calculated here is returned whole.
+    """
+    model = Cubecache()
+    for _ in range(ATTEMPTS):
+        cached = find(calc_id, mo, resolution, projection)
+        if cached:
+            return cached
+
+        if model.claim(calc_id, mo, resolution=resolution):
+            try:
+                cjson = calculate()
+            except Exception:
+                waiters = fail(calc_id, mo, resolution)
+                if waiters and notify:
+                    notify(waiters, 'Orbital could not be calculated.')
+                raise
+
+            cached, waiters = model.complete(calc_id, mo, cjson, resolution)
+            evict(cached.get('size', 0))
+            if waiters and notify:
+                notify(waiters, None)
+
+            return cached
+
+        _count('waits')
+        cached = model.wait(calc_id, mo, resolution, projection=projection)
+        if cached:
+            return cached
+
+    raise RestException('The cube could not be calculated.', 503)
+
+
+def claim(calc_id, mo, user, resolution=None):
+    """Claim the calculation of a cube that is calculated asynchronously.
+
+    Returns True if the caller should schedule the calculation, or False if
+    it is already being calculated, in which case user will be notified when
+    it is ready along with the user that claimed it.
+    """
+    model = Cubecache()
+    if model.claim(calc_id, mo, user, resolution):
+        return True
+
+    if user and not model.add_waiter(calc_id, mo, user, resolution):
+        # It finished in the meantime, or failed and was released
+        return model.claim(calc_id, mo, user, resolution)
+
+    return False
+
+
+def complete(calc_id, mo, cjson, resolution=None):
+    """Cache a cube calculated asynchronously.
+
+    Returns the ids of the users waiting for it.
+    """
+    cached, waiters = Cubecache().complete(calc_id, mo, cjson, resolution)
+    evict(cached.get('size', 0))
+
+    return waiters
+
+
+def fill(calc_id, mos, calculate, resolution=None):
+    """Calculate and cache the cubes of several orbitals at once.
+
+    calculate(mos) generates (mo, cjson) tuples for the orbitals mos, so
+    that they can be calculated with one call. Orbitals that are cached, or
+    being calculated, are skipped. Returns a tuple of dicts, of the orbitals
+    that were cached and of those that failed, to the ids of the users
+    waiting for them.
+    """
+    model = Cubecache()
+    claimed = [mo for mo in mos
+               if model.claim(calc_id, mo, resolution=resolution)]
+    _count('misses', len(claimed))
+
+    cached = {}
+    failed = {}
+    added = 0
+    try:
+        if claimed:
+            for mo, cjson in calculate(claimed):
+                if mo in claimed and mo not in cached:
+                    cube, cached[mo] = model.complete(calc_id, mo, cjson,
+                                                      resolution)
+                    added += cube.get('size', 0)
+    finally:
+        for mo in claimed:
+            if mo not in cached:
+                failed[mo] = fail(calc_id, mo, resolution)
+
+        if cached:
+            evict(added)
+
+    return cached, failed
+
+
+def fail(calc_id, mo, resolution=None):
+    """Give up on a cube calculated asynchronously.
+
+    Returns the ids of the users waiting for it.
+    """
+    marker = Cubecache().release(calc_id, mo, resolution)
+
+    return (marker or {}).get('waiters', [])
+
+
+def stats():
+    cached = Cubecache().stats()
+    with _stats_lock:
+        stats = dict(_stats)
+
+    requests = stats['hits'] + stats['misses']
+    stats.update({
+        'hitRate': stats['hits'] / requests if requests else None,
+        'entries': cached['entries'],
+        'pending': cached['pending'],
+        'size': cached['size'],
+        'maxSize': max_size(),
+        'eviction': eviction_policy(),
+        'resolution': default_resolution(),
+        'storedHits': cached['hits']
+    })
+
+    return stats
+
+
+def clear_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
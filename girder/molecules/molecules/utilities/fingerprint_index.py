@@ -0,0 +1,191 @@
+import threading
+
+import numpy as np
+
+# The number of bits set in each possible byte
+_POPCOUNT_TABLE = np.array([bin(x).count('1') for x in range(256)],
+                           dtype=np.uint8)
+
+# Rows are compared in chunks of this size to bound the temporary memory
+CHUNK_SIZE = 65536
+
+
+def popcount(fps):
+    """Count the set bits in each row of a 2D uint8 array of fingerprints"""
+    if hasattr(np, 'bitwise_count') and fps.shape[1] % 8 == 0:
+        # numpy >= 2.0, count 64 bits at a time
+        words = fps.view(np.uint64)
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int32)
+
+    return _POPCOUNT_TABLE[fps].sum(axis=1, dtype=np.int32)
+
+
+class FingerprintIndex(object):
+    """An in memory index of bit packed fingerprints for Tanimoto searches.
+
+    The fingerprints are stored as the rows of a single uint8 array, so that
+    a search compares the query with every fingerprint using vectorized
+    operations. Fingerprints can be added and removed incrementally.
+    """
+
+    def __init__(self, n_bytes, capacity=1024):
+        self.n_bytes = n_bytes
+        self._fps = np.zeros((capacity, n_bytes), dtype=np.uint8)
+        self._counts = np.zeros(capacity, dtype=np.int32)
+        self._ids = [None] * capacity
+        self._rows = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    def _as_row(self, fp):
+        row = np.frombuffer(bytes(fp), dtype=np.uint8)
+        if row.shape[0] != self.n_bytes:
+            raise ValueError('Expected a fingerprint of %d bytes, got %d' %
+                             (self.n_bytes, row.shape[0]))
+        return row
+
+    def _reserve(self, capacity):
+        if capacity <= self._fps.shape[0]:
+            return
+
+        capacity = max(capacity, 2 * self._fps.shape[0])
+        fps = np.zeros((capacity, self.n_bytes), dtype=np.uint8)
+        fps[:self._size] = self._fps[:self._size]
+        counts = np.zeros(capacity, dtype=np.int32)
+        counts[:self._size] = self._counts[:self._size]
+
+        self._fps = fps
+        self._counts = counts
+        self._ids.extend([None] * (capacity - len(self._ids)))
+
+    def add(self, id, fp):
+        """Add or replace the fingerprint of id"""
+        row = self._as_row(fp)
+        with self._lock:
+            i = self._rows.get(id)
+            if i is None:
+                self._reserve(self._size + 1)
+                i = self._size
+                self._size += 1
+                self._rows[id] = i
+                self._ids[i] = id
+
+            self._fps[i] = row
+            self._counts[i] = popcount(row[np.newaxis, :])[0]
+
+    def add_many(self, ids, fps):
+        """Add the fingerprints of ids that are not in the index yet"""
+        new = [(id, fp) for id, fp in zip(ids, fps) if id not in self._rows]
+        if not new:
+            return
+
+        rows = np.frombuffer(b''.join(bytes(x[1]) for x in new),
+                             dtype=np.uint8).reshape(len(new), self.n_bytes)
+        with self._lock:
+            start = self._size
+            self._reserve(start + len(new))
+            self._fps[start:start + len(new)] = rows
+            self._counts[start:start + len(new)] = popcount(rows)
+            for offset, (id, _) in enumerate(new):
+                self._rows[id] = start + offset
+                self._ids[start + offset] = id
+
+            self._size += len(new)
+
+    def remove(self, id):
+        with self._lock:
+            i = self._rows.pop(id, None)
+            if i is None:
+                return
+
+            # Move the last row into the hole
+            last = self._size - 1
+            if i != last:
+                self._fps[i] = self._fps[last]
+                self._counts[i] = self._counts[last]
+                self._ids[i] = self._ids[last]
+                self._rows[self._ids[i]] = i
+
+            self._ids[last] = None
+            self._size -= 1
+
+    def _scores(self, query):
+        query_count = popcount(query[np.newaxis, :])[0]
+        scores = np.empty(self._size)
+        for start in range(0, self._size, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, self._size)
+            common = popcount(np.bitwise_and(self._fps[start:end], query))
+            union = self._counts[start:end] + query_count - common
+            # Two empty fingerprints are considered identical
+            scores[start:end] = np.where(union > 0,
+                                         common / np.maximum(union, 1), 1.0)
+
+        return scores
+
+    def screen(self, fp):
+        """Find the fingerprints that have all of the bits of fp set.
+
+        This is a generator of ids, in the order of the index, that screens
+        one chunk of the index at a time. When fp is the fingerprint of a
+        substructure, the ids include all of the molecules that contain it.
+        """
+        query = self._as_row(fp)
+        start = 0
+        while True:
+            with self._lock:
+                if start >= self._size:
+                    return
+
+                end = min(start + CHUNK_SIZE, self._size)
+                chunk = self._fps[start:end]
+                hits = np.nonzero(
+                    np.all(np.bitwise_and(chunk, query) == query, axis=1))[0]
+                ids = [self._ids[start + i] for i in hits]
+
+            # Don't hold the lock while the caller consumes the ids
+            for id in ids:
+                yield id
+
+            start = end
+
+    def search(self, fp, k=None, threshold=None, offset=0):
+        """Find the fingerprints most similar to fp.
+
+        Returns a tuple of the number of matches, and a list of (id, score)
+        tuples ordered by decreasing Tanimoto similarity. If threshold is
+        set, only fingerprints with a score of at least threshold match.
+        Otherwise, every fingerprint matches. At most k results are
+        returned, after skipping the first offset results.
+        """
+        query = self._as_row(fp)
+        with self._lock:
+            if self._size == 0:
+                return 0, []
+
+            scores = self._scores(query)
+            candidates = np.arange(self._size)
+            if threshold is not None:
+                candidates = np.nonzero(scores >= threshold)[0]
+
+            num_matches = len(candidates)
+            end = num_matches if k is None else min(offset + k, num_matches)
+            if end <= offset:
+                return num_matches, []
+
+            if end < num_matches:
+                # Only fully sort the candidates that can be returned
+                top = np.argpartition(-scores[candidates], end - 1)[:end]
+                candidates = candidates[top]
+
+            order = np.argsort(-scores[candidates], kind='stable')
+            selected = candidates[order][offset:end]
+
+            results = [(self._ids[i], float(scores[i])) for i in selected]
+
+        return num_matches, results
@@ -1,15 +1,15 @@
+import base64
 import json
-import requests
+
+from bson.binary import Binary
 
 from jsonpath_rw import parse
 
 from .. import avogadro
 from .. import openbabel
 from .. import chemspider
-from .. import semantic
 from .. import constants
 from molecules.models.molecule import Molecule as MoleculeModel
-from girder.constants import TerminalColor
 from girder.api.rest import RestException
 
 from .async_requests import schedule_3d_coords_gen, schedule_svg_gen
@@ -35,10 +35,9 @@ def create_molecule(data_str, input_format, user, public, gen3d=True,
                     gen3d_steps=100, parameters={}):
 
     using_2d_format = (input_format in openbabel_2d_formats)
-    inchi_format = 'inchi'
 
     if using_2d_format:
-        inchi, inchikey = openbabel.to_inchi(data_str, input_format)
+        ingested = openbabel.ingest(data_str, input_format)
     else:
         # Let's make sure the bonds look reasonable
         cjson = convert_3d_format_to_cjson(data_str, input_format)
@@ -48,7 +47,10 @@ def create_molecule(data_str, input_format, user, public, gen3d=True,
 
         # Use this cjson for generating the inchi
         sdf_data = avogadro.convert_str(json.dumps(cjson), 'cjson', 'sdf')
-        inchi, inchikey = openbabel.to_inchi(sdf_data, 'sdf')
+        ingested = openbabel.ingest(sdf_data, 'sdf')
+
+    inchi = ingested.get('inchi')
+    inchikey = ingested.get('inchikey')
 
     if not inchi:
         raise RestException('Unable to extract InChI', code=400)
@@ -59,12 +61,10 @@ def create_molecule(data_str, input_format, user, public, gen3d=True,
     if molExists:
         mol = molExists
     else:
-        # Get some basic molecular properties we want to add to the
-        # database.
-        # Use sdf without 3d generation for avogadro's molecule properties
-        sdf_no_3d = openbabel.gen_sdf_no_3d(inchi, inchi_format)[0]
-        props = avogadro.molecule_properties(sdf_no_3d, 'sdf')
-        smiles = openbabel.to_smiles(inchi, inchi_format)
+        # The basic molecular properties we want to add to the database
+        # were computed along with the inchi.
+        props = ingested['properties']
+        smiles = ingested['smiles']
 
         pieces = props['spacedFormula'].strip().split(' ')
         atomCounts = {}
@@ -77,7 +77,10 @@ def create_molecule(data_str, input_format, user, public, gen3d=True,
             'smiles': smiles,
             'properties': props,
             'atomCounts': atomCounts,
-            'provenance': provenance
+            'provenance': provenance,
+            # Used for similarity searches
+            'fingerprint': Binary(base64.b64decode(ingested['fingerprint'])),
+            'fingerprintType': ingested['fingerprintType']
         }
 
         # Set a name if we find one or one is provided
@@ -99,14 +102,8 @@ def create_molecule(data_str, input_format, user, public, gen3d=True,
         mol = MoleculeModel().create(user, mol_dict, public)
 
         if using_2d_format and gen3d:
-            def _on_complete(mol):
-                # Upload the molecule to Jen
-                try:
-                    semantic.upload_molecule(mol)
-                except requests.ConnectionError:
-                    print(TerminalColor.warning('WARNING: Couldn\'t connect to Jena.'))
-
-            schedule_3d_coords_gen(mol_dict, user, on_complete=_on_complete,
+            # Upload the molecule to Jena once it has 3D coordinates
+            schedule_3d_coords_gen(mol_dict, user, upload_semantic=True,
                                    gen3d_forcefield=gen3d_forcefield,
                                    gen3d_steps=gen3d_steps)
 
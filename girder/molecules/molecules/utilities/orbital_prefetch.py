@@ -0,0 +1,169 @@
+import queue
+import threading
+
+from girder import logger
+from girder.models.setting import Setting
+
+from molecules import avogadro
+from molecules.constants import PluginSettings
+from molecules.models.calculation import Calculation
+from molecules.utilities import async_requests
+from molecules.utilities import cube_cache
+from molecules.utilities import orbitals
+
+# When a calculation with orbitals is created or ingested, the cubes of the
+# orbitals around the HOMO and LUMO are calculated in the background, so
+# that they are already cached when a user first opens them. The work goes
+# through a bounded queue served by a few worker threads, so that it never
+# holds up the request that ingested the calculation, and doesn't take all
+# of the Avogadro service from interactive requests.
+
+# The number of orbitals either side of the HOMO and LUMO to prefetch, so
+# HOMO-2 to LUMO+2 by default
+DEFAULT_WINDOW = 2
+# The number of calculations waiting to be prefetched. Calculations ingested
+# while the queue is full are not prefetched.
+QUEUE_SIZE = 100
+WORKERS = 2
+
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+_workers = []
+_lock = threading.Lock()
+
+
+def _setting(key, default):
+    value = Setting().get(key)
+    if value is None or value == '':
+        return default
+
+    return value
+
+
+def enabled():
+    return _setting(PluginSettings.ORBITAL_PREFETCH, True) is True
+
+
+def window():
+    return int(float(_setting(PluginSettings.ORBITAL_PREFETCH_WINDOW,
+                              DEFAULT_WINDOW)))
+
+
+def orbital_range(calc, window):
+    """Get the indices of the orbitals from HOMO-window to LUMO+window"""
+    indices = orbitals.homo_lumo(calc)
+    if indices is None:
+        return []
+
+    homo, lumo = indices
+    first = max(0, homo - window)
+    last = lumo + window
+
+    # Don't go past the last orbital, if the number of orbitals is known
+    energies = calc['cjson'].get('orbitals', {}).get('energies')
+    if isinstance(energies, list) and energies:
+        last = min(last, len(energies) - 1)
+
+    return list(range(first, last + 1))
+
+
+def _label(mo, homo_lumo):
+    # Name the HOMO and LUMO the way the viewer asks for them
+    if homo_lumo is not None and mo in homo_lumo:
+        return 'homo' if mo == homo_lumo[0] else 'lumo'
+
+    return mo
+
+
+def prefetch(calc_id):
+    """Calculate and cache the cubes of the orbitals around the HOMO/LUMO.
+
+    Cubes that are already cached, or being calculated, are skipped. Returns
+    the number of cubes that were calculated.
+    """
+    calc = Calculation().load(calc_id, force=True)
+    if calc is None or not orbitals.has_orbitals(calc.get('cjson')):
+        return 0
+
+    Calculation().expand_cjson(calc)
+    homo_lumo = orbitals.homo_lumo(calc)
+    # The resolution that viewers ask for by default
+    resolution = cube_cache.default_resolution()
+
+    def calculate(mos):
+        # All of the cubes are calculated with one request. The cubes that
+        # it didn't return by the time it failed are released by fill().
+        try:
+            for mo, cjson in avogadro.calculate_mos(calc['cjson'], mos,
+                                                    resolution):
+                # Remove the vibrational mode data from the cube - big, not
+                # needed here.
+                cjson.pop('vibrations', None)
+                yield mo, cjson
+        except Exception:
+            logger.exception('Prefetching the orbitals of calculation %s '
+                             'failed' % calc_id)
+
+    cached, failed = cube_cache.fill(calc_id, orbital_range(calc, window()),
+                                     calculate, resolution)
+
+    # Users may have asked for the cubes asynchronously in the meantime
+    for mo, waiters in cached.items():
+        if waiters:
+            data = {
+                'id': str(calc_id),
+                'mo': _label(mo, homo_lumo),
+                'resolution': resolution
+            }
+            async_requests.notify_cube_status(data, waiters)
+
+    for mo, waiters in failed.items():
+        if waiters:
+            data = {
+                'id': str(calc_id),
+                'mo': _label(mo, homo_lumo),
+                'resolution': resolution,
+                'error': 'Orbital could not be calculated.'
+            }
+            async_requests.notify_cube_status(data, waiters)
+
+    return len(cached)
+
+
+def _work():
+    while True:
+        calc_id = _queue.get()
+        try:
+            prefetch(calc_id)
+        except Exception:
+            logger.exception('Prefetching orbitals of calculation %s failed'
+                             % calc_id)
+        finally:
+            _queue.task_done()
+
+
+def _start_workers():
+    with _lock:
+        while len(_workers) < WORKERS:
+            worker = threading.Thread(target=_work, daemon=True,
+                                      name='orbital-prefetch')
+            worker.start()
+            _workers.append(worker)
+
+
+def schedule(calc):
+    """Queue the prefetch of the orbitals of calc, if it has any.
+
+    Returns False if it wasn't queued.
+    """
+    if not enabled() or not orbitals.has_orbitals(calc.get('cjson')):
+        return False
+
+    _start_workers()
+    try:
+        _queue.put_nowait(calc['_id'])
+    except queue.Full:
+        logger.warning('Orbital prefetch queue is full, not prefetching '
+                       'calculation %s' % calc['_id'])
+        return False
+
+    return True
@@ -0,0 +1,34 @@
+from jsonpath_rw import parse
+
+# Electron count might be saved in several places...
+ELECTRON_COUNT_PATHS = [
+    'cjson.orbitals.electronCount',
+    'cjson.basisSet.electronCount',
+    'properties.electronCount'
+]
+
+
+def electron_count(calc):
+    for expr in ELECTRON_COUNT_PATHS:
+        matches = parse(expr).find(calc)
+        if matches:
+            return matches[0].value
+
+    return None
+
+
+def homo_lumo(calc):
+    """Get the indices of the HOMO and LUMO of a calculation, or None"""
+    count = electron_count(calc)
+    if count is None:
+        return None
+
+    # The index of the first orbital is 0, so homo needs to be
+    # electron_count // 2 - 1
+    homo = int(count / 2) - 1
+    return homo, homo + 1
+
+
+def has_orbitals(cjson):
+    return (isinstance(cjson, dict) and 'basisSet' in cjson and
+            'orbitals' in cjson)
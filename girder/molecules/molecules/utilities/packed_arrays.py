@@ -0,0 +1,269 @@
+import io
+
+import gridfs
+import numpy as np
+
+from bson.binary import Binary
+
+# The large numeric arrays of cjson can be stored packed, as little endian
+# float32 or float64 binary data, rather than as BSON arrays of doubles.
+# That halves (float64) or quarters (float32) their size, and they can be
+# loaded without decoding every number. Arrays that would still be too large
+# for a document are stored in GridFS.
+#
+# A packed array replaces the array in the cjson with:
+#
+#   {
+#     '_packedArray': 1,
+#     'dtype': '<f8',
+#     'shape': [<dimensions>],
+#     'data': <binary>   # or 'gridfsId': <id of the GridFS file>
+#   }
+
+# The arrays that are packed, as paths into the cjson
+PACKED_PATHS = [
+    ('atoms', 'coords', '3d'),
+    ('vibrations', 'eigenVectors'),
+    ('orbitals', 'moCoefficients'),
+    ('orbitals', 'alphaCoefficients'),
+    ('orbitals', 'betaCoefficients'),
+    ('cube', 'scalars')
+]
+
+DTYPES = {
+    'float32': '<f4',
+    'float64': '<f8'
+}
+
+PACKED_KEY = '_packedArray'
+
+# Smaller arrays are not worth packing
+MIN_LENGTH = 64
+
+# Arrays with more bytes than this are stored in GridFS
+GRIDFS_THRESHOLD = 4 * 1024 * 1024
+GRIDFS_COLLECTION = 'packed_arrays'
+
+
+def is_packed(value):
+    return isinstance(value, dict) and PACKED_KEY in value
+
+
+def _gridfs(database):
+    return gridfs.GridFS(database, collection=GRIDFS_COLLECTION)
+
+
+def pack_array(value, dtype='float64', database=None, owner=None):
+    """Pack an array of numbers, or an array of arrays of the same length.
+
+    Returns value unchanged if it can't, or shouldn't, be packed. Large
+    arrays are stored in GridFS if database is set, with owner (the id of
+    the document that the array belongs to) in the metadata of the file.
+    """
+    if not isinstance(value, list) or is_packed(value):
+        return value
+
+    try:
+        array = np.asarray(value, dtype=DTYPES[dtype])
+    except (TypeError, ValueError):
+        # Not numbers, or ragged
+        return value
+
+    if array.size < MIN_LENGTH:
+        return value
+
+    data = array.tobytes()
+    packed = {
+        PACKED_KEY: 1,
+        'dtype': array.dtype.str,
+        'shape': list(array.shape)
+    }
+
+    if database is not None and len(data) > GRIDFS_THRESHOLD:
+        metadata = {'owner': owner}
+        packed['gridfsId'] = _gridfs(database).put(data, metadata=metadata)
+    else:
+        packed['data'] = Binary(data)
+
+    return packed
+
+
+def unpack_array(value, database=None):
+    """Get a packed array as a numpy array"""
+    if 'gridfsId' in value:
+        data = _gridfs(database).get(value['gridfsId']).read()
+    else:
+        data = value['data']
+
+    return np.frombuffer(data, dtype=value['dtype']).reshape(value['shape'])
+
+
+def unpack_rows(value, start, count, database=None):
+    """Get rows [start, start + count) of a packed 2D array as lists.
+
+    Only the bytes of the rows are read if the array is in the document.
+    """
+    if 'gridfsId' in value:
+        return unpack_array(value, database)[start:start + count].tolist()
+
+    dtype = np.dtype(value['dtype'])
+    rows, columns = value['shape']
+    start = max(0, min(start, rows))
+    count = max(0, min(count, rows - start))
+
+    row_size = columns * dtype.itemsize
+    data = value['data'][start * row_size:(start + count) * row_size]
+
+    return np.frombuffer(data, dtype=dtype).reshape(count, columns).tolist()
+
+
+def bson_array(data):
+    """Get the encoded BSON array data, of doubles, as a float64 array.
+
+    The numbers are read with numpy rather than decoded one by one. Returns
+    None if the array holds anything but doubles.
+    """
+    # Each element is the type (1 for a double), the index as a C string and
+    # the 8 bytes of the double. The elements whose indices have the same
+    # number of digits have the same size, so they are read together.
+    values = []
+    pos = 4
+    end = len(data) - 1
+    digits = 1
+    count = 0
+    while pos < end:
+        size = digits + 10
+        n = min(10 ** digits - count, (end - pos) // size)
+        if n == 0:
+            return None
+
+        dtype = np.dtype([('type', 'u1'), ('key', 'S%d' % (digits + 1)),
+                          ('value', '<f8')])
+        elements = np.frombuffer(data, dtype=dtype, count=n, offset=pos)
+        if not (elements['type'] == 1).all():
+            return None
+
+        values.append(elements['value'])
+        pos += n * size
+        count += n
+        digits += 1
+
+    if pos != end:
+        return None
+
+    return np.concatenate(values) if values else np.empty(0)
+
+
+def array_file(value, dtype='float32', database=None):
+    """Get the data of an array as little endian dtype, as a file object.
+
+    Returns a tuple of the file object and its size in bytes. Packed arrays
+    that already have the type are read straight from storage, without being
+    converted to lists.
+    """
+    dtype = np.dtype(DTYPES[dtype])
+    if is_packed(value) and np.dtype(value['dtype']) == dtype:
+        if 'gridfsId' in value:
+            f = _gridfs(database).get(value['gridfsId'])
+            return f, f.length
+
+        data = value['data']
+    elif is_packed(value):
+        data = unpack_array(value, database).astype(dtype).tobytes()
+    else:
+        data = np.asarray(value, dtype=dtype).tobytes()
+
+    return io.BytesIO(data), len(data)
+
+
+def _map_paths(cjson, func):
+    # Apply func to each of the arrays at PACKED_PATHS, copying only the
+    # dicts that lead to an array that changed.
+    if not isinstance(cjson, dict):
+        return cjson
+
+    result = cjson
+    for path in PACKED_PATHS:
+        parents = [result]
+        for key in path[:-1]:
+            child = parents[-1].get(key)
+            if not isinstance(child, dict):
+                break
+            parents.append(child)
+        else:
+            value = parents[-1].get(path[-1])
+            if value is None:
+                continue
+
+            new_value = func(value)
+            if new_value is value:
+                continue
+
+            # Copy the dicts along the path, so that cjson isn't modified
+            copies = [dict(x) for x in parents]
+            for parent, key, child in zip(copies, path, copies[1:]):
+                parent[key] = child
+            copies[-1][path[-1]] = new_value
+            result = copies[0]
+
+    return result
+
+
+def pack_cjson(cjson, dtype='float64', database=None, owner=None):
+    """Get a copy of cjson with its large arrays packed"""
+    return _map_paths(
+        cjson, lambda x: pack_array(x, dtype, database, owner))
+
+
+def unpack_cjson(cjson, database=None):
+    """Get a copy of cjson with its packed arrays expanded to lists"""
+    def unpack(value):
+        if not is_packed(value):
+            return value
+
+        return unpack_array(value, database).tolist()
+
+    return _map_paths(cjson, unpack)
+
+
+def _arrays(cjson):
+    # Generate the values at PACKED_PATHS
+    for path in PACKED_PATHS:
+        value = cjson
+        for key in path:
+            if not isinstance(value, dict):
+                value = None
+                break
+            value = value.get(key)
+
+        if value is not None:
+            yield value
+
+
+def has_packed(cjson):
+    return any(is_packed(x) for x in _arrays(cjson))
+
+
+def gridfs_ids(cjson):
+    """Get the ids of the GridFS files of the packed arrays of cjson"""
+    return [x['gridfsId'] for x in _arrays(cjson)
+            if is_packed(x) and 'gridfsId' in x]
+
+
+def gridfs_size(cjson):
+    """Get the number of bytes of the packed arrays of cjson in GridFS"""
+    return sum(int(np.prod(x['shape'])) * np.dtype(x['dtype']).itemsize
+               for x in _arrays(cjson) if is_packed(x) and 'gridfsId' in x)
+
+
+def remove_gridfs(database, owner, keep=()):
+    """Remove the GridFS files of owner, except for those in keep"""
+    fs = _gridfs(database)
+    for f in fs.find({'metadata.owner': owner}):
+        if f._id not in keep:
+            fs.delete(f._id)
+
+
+def set_gridfs_owner(database, ids, owner):
+    database[GRIDFS_COLLECTION + '.files'].update_many(
+        {'_id': {'$in': ids}}, {'$set': {'metadata.owner': owner}})
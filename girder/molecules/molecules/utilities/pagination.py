@@ -1,5 +1,40 @@
+import json
+import time
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+from girder.api.rest import RestException
 from girder.constants import SortDir
 
+from molecules.utilities.lru_cache import LRUCache
+
+# How the number of matches of a query is counted:
+#
+#   exact     - count every match, the default.
+#   cached    - count every match, but cache the count for COUNT_CACHE_TTL
+#               seconds, so that paging through results only counts once.
+#               The count may miss changes made within that time.
+#   capped    - count at most COUNT_CAP matches past the offset, which bounds
+#               the cost of counting broad or regex queries.
+#   estimated - use the collection metadata if there is no filter, which is
+#               instant, otherwise the same as capped.
+#   none      - don't count, "matches" is None.
+#
+# Counts that are not exact are reported with "matchesExact": false.
+COUNT_EXACT = 'exact'
+COUNT_CACHED = 'cached'
+COUNT_CAPPED = 'capped'
+COUNT_ESTIMATED = 'estimated'
+COUNT_NONE = 'none'
+COUNT_MODES = [COUNT_EXACT, COUNT_CACHED, COUNT_CAPPED, COUNT_ESTIMATED,
+               COUNT_NONE]
+
+COUNT_CAP = 1000
+COUNT_CACHE_TTL = 10
+
+_count_cache = LRUCache(1024)
+
 def default_pagination_params(limit=None, offset=None, sort=None):
     """Returns default params unless they are set"""
     if limit is None:
@@ -28,7 +63,117 @@ def parse_pagination_params(params):
     return limit, offset, sort
 
 
-def search_results_dict(results, num_matches, limit, offset, sort):
+def parse_count_params(params):
+    """Parse params and get (count, cursor)
+
+    count is one of COUNT_MODES, exact by default. cursor is the id after
+    which keyset pagination continues, or None to use the offset.
+    """
+    count = COUNT_EXACT
+    cursor = None
+    if params:
+        count = params.get('count') or COUNT_EXACT
+        if count not in COUNT_MODES:
+            raise RestException('Invalid count: %s, must be one of: %s' %
+                                (count, ', '.join(COUNT_MODES)))
+
+        if params.get('cursor'):
+            try:
+                cursor = ObjectId(params['cursor'])
+            except (InvalidId, TypeError):
+                raise RestException('Invalid cursor: %s' % params['cursor'])
+
+    return count, cursor
+
+
+def keyset_query(query, cursor, sort):
+    """Restrict query to the documents after cursor, in the order of sort
+
+    Keyset pagination only works when sorting by _id.
+    """
+    if cursor is None:
+        return query
+
+    if len(sort) != 1 or sort[0][0] != '_id':
+        raise RestException('A cursor can only be used when sorting by _id')
+
+    op = '$lt' if sort[0][1] == SortDir.DESCENDING else '$gt'
+    after = {'_id': {op: cursor}}
+    if not query:
+        return after
+
+    return {'$and': [query, after]}
+
+
+def next_cursor(results, limit, sort):
+    """The cursor of the next page, or None if this is the last page
+
+    Cursors are ids, so there is only one when the results are sorted by _id.
+    """
+    if len(sort) != 1 or sort[0][0] != '_id':
+        return None
+
+    if not results or limit <= 0 or len(results) < limit:
+        return None
+
+    return str(results[-1]['_id'])
+
+
+def _count_cache_key(collection, query):
+    # Normalize the query so that equal queries share their count
+    return collection.name + json.dumps(query, sort_keys=True, default=repr)
+
+
+def _count_documents(collection, query, limit=None):
+    if isinstance(query, list):
+        # An aggregation pipeline, count the documents that it outputs
+        pipeline = list(query)
+        if limit:
+            pipeline.append({'$limit': limit})
+        pipeline.append({'$count': 'count'})
+
+        result = list(collection.aggregate(pipeline))
+        return result[0]['count'] if result else 0
+
+    if limit:
+        return collection.count_documents(query, limit=limit)
+
+    return collection.count_documents(query)
+
+
+def count_matches(collection, query, count=COUNT_EXACT, offset=0):
+    """Count the matches of query, returns (num_matches, exact)
+
+    query may also be an aggregation pipeline, in which case the documents
+    that it outputs are counted.
+    """
+    if count == COUNT_NONE:
+        return None, False
+
+    if count == COUNT_ESTIMATED and not query:
+        return collection.estimated_document_count(), False
+
+    if count in (COUNT_CAPPED, COUNT_ESTIMATED):
+        cap = offset + COUNT_CAP
+        num_matches = _count_documents(collection, query, cap)
+        return num_matches, num_matches < cap
+
+    if count == COUNT_EXACT:
+        return _count_documents(collection, query), True
+
+    key = _count_cache_key(collection, query)
+    cached = _count_cache.get(key)
+    now = time.time()
+    if cached is not None and cached[1] > now:
+        return cached[0], True
+
+    num_matches = _count_documents(collection, query)
+    _count_cache.put(key, (num_matches, now + COUNT_CACHE_TTL))
+    return num_matches, True
+
+
+def search_results_dict(results, num_matches, limit, offset, sort,
+                        exact=True, next=None):
     """This is for consistent search results"""
     ret = {
         'matches': num_matches,
@@ -36,4 +181,9 @@ def search_results_dict(results, num_matches, limit, offset, sort):
         'offset': offset,
         'results': results
     }
+    if not exact:
+        ret['matchesExact'] = False
+    if next is not None:
+        ret['next'] = next
+
     return ret
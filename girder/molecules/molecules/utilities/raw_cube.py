@@ -0,0 +1,136 @@
+import json
+import zlib
+
+import cherrypy
+from cherrypy.lib import httputil
+
+from girder.api.rest import RestException
+
+from molecules.utilities import packed_arrays
+
+# The raw format of a cube is a JSON header, padded with spaces and ended by
+# a newline so that its length is a multiple of 4, followed by the scalars
+# of the cube as contiguous little endian float32:
+#
+#   {"dimensions": [nx, ny, nz], "origin": [...], "spacing": [...],
+#    "dtype": "<f4", "count": n, "dataOffset": <length of the header>}\n
+#   <n * 4 bytes>
+#
+# So a client can view the data as a Float32Array without copying it.
+
+HEADER_ALIGNMENT = 4
+
+# The number of bytes to read from storage at a time
+CHUNK_SIZE = 256 * 1024
+
+MIME_TYPE = 'application/octet-stream'
+
+
+def _encode_header(cube, count, resolution=None):
+    header = {
+        'dimensions': cube.get('dimensions'),
+        'origin': cube.get('origin'),
+        'spacing': cube.get('spacing'),
+        'resolution': resolution,
+        'dtype': '<f4',
+        'count': count
+    }
+
+    # The offset is part of the header, so its length could change the
+    # length of the header. Digits are only added if the length grows, so
+    # this converges in a couple of iterations.
+    offset = 0
+    while True:
+        header['dataOffset'] = offset
+        data = json.dumps(header).encode('utf8')
+        length = len(data) + 1
+        length += -length % HEADER_ALIGNMENT
+        if length == offset:
+            break
+        offset = length
+
+    return data + b' ' * (length - len(data) - 1) + b'\n'
+
+
+def _read(f, size):
+    # Read size bytes from f, in chunks
+    while size > 0:
+        chunk = f.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            break
+        size -= len(chunk)
+        yield chunk
+
+
+def _body(header, data, start, end):
+    # Generate the bytes [start, end) of the header followed by the data
+    if start < len(header):
+        yield header[start:end]
+
+    start = max(0, start - len(header))
+    end -= len(header)
+    if end > start:
+        data.seek(start)
+        for chunk in _read(data, end - start):
+            yield chunk
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def stream_cube(cube, database, gzip=False, resolution=None):
+    """Respond with the raw format of cube, a cube from a cjson.
+
+    Supports a single HTTP Range of the response, or gzip compression of the
+    whole response. Returns the stream function for the endpoint.
+    """
+    if not cube or 'scalars' not in cube:
+        raise RestException('The cube has no scalars.', 404)
+
+    data, data_size = packed_arrays.array_file(cube['scalars'], 'float32',
+                                               database)
+    header = _encode_header(cube, data_size // 4, resolution)
+    size = len(header) + data_size
+
+    start, end = 0, size
+    ranges = None
+    range_header = cherrypy.request.headers.get('Range')
+    if range_header:
+        ranges = httputil.get_ranges(range_header, size)
+        if ranges == []:
+            cherrypy.response.headers['Content-Range'] = 'bytes */%d' % size
+            raise cherrypy.HTTPError(416)
+
+    cherrypy.response.headers['Content-Type'] = MIME_TYPE
+    cherrypy.response.headers['Accept-Ranges'] = 'bytes'
+    cherrypy.response.headers['X-Cube-Data-Offset'] = str(len(header))
+
+    # Only single ranges are supported, the whole cube is sent otherwise
+    if ranges and len(ranges) == 1:
+        start, end = ranges[0]
+        cherrypy.response.status = 206
+        cherrypy.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, end - 1, size)
+        gzip = False
+
+    if gzip:
+        cherrypy.response.headers['Content-Encoding'] = 'gzip'
+    else:
+        cherrypy.response.headers['Content-Length'] = str(end - start)
+
+    def stream():
+        chunks = _body(header, data, start, end)
+        if gzip:
+            chunks = _gzip(chunks)
+
+        for chunk in chunks:
+            yield chunk
+
+    return stream
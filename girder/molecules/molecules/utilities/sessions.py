@@ -0,0 +1,172 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests_futures.sessions import FuturesSession
+from urllib3.util.retry import Retry
+
+from girder.models.setting import Setting
+
+from molecules.constants import PluginSettings
+
+
+class Services:
+    AVOGADRO = 'avogadro'
+    OPENBABEL = 'openbabel'
+
+
+class Lanes:
+    # Requests that a user is waiting for, such as the conversions for the
+    # viewer
+    INTERACTIVE = 'interactive'
+    # Background work, such as 3D coordinate generation and orbital
+    # prefetching. The services only let bulk requests take some of their
+    # workers, and answer the others with 503 and Retry-After.
+    BULK = 'bulk'
+
+
+# The header that tells the services the lane of a request
+LANE_HEADER = 'X-Request-Lane'
+
+
+# Defaults used when the plugin settings are not set
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_CONNECT_TIMEOUT = 5
+# Some conversions (such as 3D coordinate generation) and MO calculations
+# can take a long time. This matches the timeout of the gunicorn workers.
+DEFAULT_TIMEOUT = 600
+# Bulk requests are turned away while their lane is full, so they are
+# retried for longer than interactive ones, honoring Retry-After.
+BULK_RETRIES = 30
+
+_timeout_settings = {
+    Services.AVOGADRO: PluginSettings.AVOGADRO_TIMEOUT,
+    Services.OPENBABEL: PluginSettings.OPENBABEL_TIMEOUT
+}
+
+# Only retry when the service could not handle the request, not when the
+# request itself was bad.
+_retry_status_codes = [502, 503, 504]
+
+_lock = threading.Lock()
+_sessions = {}
+_executors = {}
+
+
+def _setting(key, default):
+    value = Setting().get(key)
+    if value is None:
+        return default
+
+    return value
+
+
+def _make_retry(retries, backoff_factor):
+    kwargs = {
+        'total': retries,
+        'connect': retries,
+        'read': 0,
+        'status': retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': _retry_status_codes,
+        'raise_on_status': False
+    }
+    # The conversions are pure functions of their input, so it is safe
+    # to retry POST requests.
+    try:
+        return Retry(allowed_methods=None, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=False, **kwargs)
+
+
+def get_session(service, lane=Lanes.INTERACTIVE):
+    """Get the shared keep-alive session for a service and lane.
+
+    Sessions are cached per service, lane and configuration, so connections
+    are reused across calls, and changing the plugin settings results in a
+    new session.
+    """
+    pool_size = int(_setting(PluginSettings.SERVICES_POOL_SIZE,
+                             DEFAULT_POOL_SIZE))
+    retries = int(_setting(PluginSettings.SERVICES_RETRIES, DEFAULT_RETRIES))
+    if lane == Lanes.BULK:
+        retries = max(retries, BULK_RETRIES)
+    backoff_factor = float(_setting(PluginSettings.SERVICES_BACKOFF_FACTOR,
+                                    DEFAULT_BACKOFF_FACTOR))
+
+    key = (service, lane, pool_size, retries, backoff_factor)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size,
+                                  max_retries=_make_retry(retries,
+                                                          backoff_factor))
+            session = requests.Session()
+            session.headers[LANE_HEADER] = lane
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            # Drop the sessions of an outdated configuration. They are not
+            # closed, since another thread could still be using them.
+            for old_key in [x for x in _sessions
+                            if x[:2] == (service, lane)]:
+                del _sessions[old_key]
+
+            _sessions[key] = session
+
+    return session
+
+
+def get_timeout(service):
+    """Get the (connect, read) timeout tuple for a service."""
+    timeout = float(_setting(_timeout_settings[service], DEFAULT_TIMEOUT))
+    return (min(DEFAULT_CONNECT_TIMEOUT, timeout), timeout)
+
+
+def get_executor(lane=Lanes.INTERACTIVE):
+    """Get the bounded executor shared by the asynchronous requests of a lane.
+
+    Bulk requests get half of the threads, in an executor of their own, so
+    that while they wait to be let in by the services they don't hold up
+    interactive requests.
+    """
+    executor = _executors.get(lane)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(lane)
+            if executor is None:
+                max_workers = int(_setting(PluginSettings.SERVICES_MAX_WORKERS,
+                                           DEFAULT_MAX_WORKERS))
+                if lane == Lanes.BULK:
+                    max_workers = max(1, max_workers // 2)
+
+                executor = ThreadPoolExecutor(max_workers=max_workers)
+                _executors[lane] = executor
+
+    return executor
+
+
+def post(service, url, lane=Lanes.INTERACTIVE, **kwargs):
+    kwargs.setdefault('timeout', get_timeout(service))
+    return get_session(service, lane).post(url, **kwargs)
+
+
+def futures_session(service, lane=Lanes.INTERACTIVE):
+    """Get a FuturesSession that uses the shared session and executor."""
+    return FuturesSession(executor=get_executor(lane),
+                          session=get_session(service, lane))
+
+
+def futures_post(service, url, lane=Lanes.INTERACTIVE, **kwargs):
+    kwargs.setdefault('timeout', get_timeout(service))
+    return futures_session(service, lane).post(url, **kwargs)
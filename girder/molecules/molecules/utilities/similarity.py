@@ -0,0 +1,150 @@
+import datetime
+import threading
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from molecules import openbabel
+from molecules.models.molecule import Molecule
+from molecules.utilities.fingerprint_index import FingerprintIndex
+
+# Similarity searches compare the FP2 fingerprint of the query with the
+# fingerprints of all of the molecules, which are kept in memory. The index
+# is loaded from mongodb on the first search, and then kept up to date with
+# the save and remove events of the molecules.
+
+FINGERPRINT_TYPE = 'FP2'
+# FP2 fingerprints have 1024 bits
+FINGERPRINT_BYTES = 128
+
+# The number of fingerprints to add to the index at a time while loading
+LOAD_BATCH_SIZE = 10000
+
+# Ids generated by different processes are not strictly ordered, so when
+# looking for new molecules, also look at the ones created this long before
+# the last one that was loaded. The index ignores those it already has.
+LOAD_OVERLAP = datetime.timedelta(minutes=1)
+
+_index = None
+_last_id = None
+_lock = threading.Lock()
+
+
+def _load_new(index, last_id):
+    # Add the molecules created after last_id, which includes the ones that
+    # were created by other girder processes. Returns the new last id.
+    query = {
+        'fingerprint': {'$exists': True},
+        'fingerprintType': FINGERPRINT_TYPE
+    }
+    if last_id is not None:
+        since = last_id.generation_time - LOAD_OVERLAP
+        query['_id'] = {'$gt': ObjectId.from_datetime(since)}
+
+    cursor = Molecule().collection.find(query, projection=['fingerprint'],
+                                        sort=[('_id', 1)])
+
+    ids = []
+    fps = []
+    for mol in cursor:
+        ids.append(mol['_id'])
+        fps.append(mol['fingerprint'])
+        if len(ids) >= LOAD_BATCH_SIZE:
+            index.add_many(ids, fps)
+            last_id = max(last_id, ids[-1]) if last_id else ids[-1]
+            ids = []
+            fps = []
+
+    if ids:
+        index.add_many(ids, fps)
+        last_id = max(last_id, ids[-1]) if last_id else ids[-1]
+
+    return last_id
+
+
+def get_index():
+    global _index, _last_id
+
+    with _lock:
+        if _index is None:
+            index = FingerprintIndex(FINGERPRINT_BYTES)
+            _last_id = _load_new(index, None)
+            _index = index
+        else:
+            _last_id = _load_new(_index, _last_id)
+
+        return _index
+
+
+def on_molecule_saved(event):
+    mol = event.info
+    if _index is None or mol.get('fingerprintType') != FINGERPRINT_TYPE:
+        return
+
+    if mol.get('fingerprint') is not None:
+        _index.add(mol['_id'], mol['fingerprint'])
+
+
+def on_molecule_removed(event):
+    if _index is not None:
+        _index.remove(event.info['_id'])
+
+
+def search(smiles, limit=None, offset=0, threshold=None):
+    """Find the molecules that are most similar to smiles.
+
+    Returns a tuple of the number of matches, and a list of (id, similarity)
+    tuples in order of decreasing similarity.
+    """
+    fp = openbabel.fingerprint(smiles, 'smi', FINGERPRINT_TYPE)
+    return get_index().search(fp, k=limit, threshold=threshold,
+                              offset=offset)
+
+
+def forget(ids):
+    # Remove ids that no longer exist, such as molecules that were removed
+    # by another girder process
+    if _index is not None:
+        for id in ids:
+            _index.remove(id)
+
+
+def backfill_fingerprints(batch_size=1000):
+    """Compute the fingerprints of the molecules created without them.
+
+    Returns the number of molecules that were updated.
+    """
+    query = {
+        'smiles': {'$exists': True},
+        'fingerprint': {'$exists': False}
+    }
+    collection = Molecule().collection
+
+    count = 0
+    batch = []
+
+    def write(batch):
+        records = [(mol['smiles'], 'smi') for mol in batch]
+        fps = openbabel.fingerprint_batch(records, FINGERPRINT_TYPE)
+        operations = [
+            UpdateOne({'_id': mol['_id']}, {'$set': {
+                'fingerprint': fp,
+                'fingerprintType': FINGERPRINT_TYPE
+            }})
+            for mol, fp in zip(batch, fps) if fp is not None
+        ]
+        if not operations:
+            return 0
+
+        return collection.bulk_write(operations).modified_count
+
+    for mol in collection.find(query, projection=['smiles']):
+        batch.append(mol)
+        if len(batch) >= batch_size:
+            count += write(batch)
+            batch = []
+
+    if batch:
+        count += write(batch)
+
+    return count
@@ -0,0 +1,75 @@
+import collections
+import itertools
+
+from molecules import openbabel
+from molecules.models.molecule import Molecule
+from molecules.utilities import sessions
+from molecules.utilities import similarity
+
+# Substructure searches first screen the molecules with the fingerprint
+# index: a molecule can only contain the substructure if its fingerprint has
+# all of the bits of the fingerprint of the substructure set. The candidates
+# that pass are then checked exactly by the Open Babel service, in batches
+# that are sent concurrently.
+
+# The number of candidates to check per request to Open Babel
+BATCH_SIZE = 200
+# The number of batches to check at the same time
+BATCHES_IN_FLIGHT = 4
+
+
+def _check_batch(pattern, ids):
+    # Returns the ids of the molecules that contain pattern, in order
+    cursor = Molecule().collection.find({'_id': {'$in': ids}},
+                                        projection=['smiles'])
+    smiles = {x['_id']: x.get('smiles') for x in cursor}
+
+    # Molecules removed since they were screened are skipped
+    ids = [id for id in ids if smiles.get(id)]
+    matches = openbabel.substructure_match(pattern, [smiles[x] for x in ids])
+
+    return [id for id, match in zip(ids, matches) if match]
+
+
+def matches(smiles):
+    """Generate the ids of the molecules that contain smiles.
+
+    The candidates are checked lazily, a few batches ahead of what has been
+    consumed, so that only as many molecules are checked as are needed.
+    """
+    fp = openbabel.fingerprint(smiles, 'smi', similarity.FINGERPRINT_TYPE)
+    candidates = similarity.get_index().screen(fp)
+    executor = sessions.get_executor()
+
+    def submit():
+        batch = list(itertools.islice(candidates, BATCH_SIZE))
+        if not batch:
+            return False
+
+        futures.append(executor.submit(_check_batch, smiles, batch))
+        return True
+
+    futures = collections.deque()
+    try:
+        while len(futures) < BATCHES_IN_FLIGHT and submit():
+            pass
+
+        while futures:
+            hits = futures.popleft().result()
+            submit()
+            for id in hits:
+                yield id
+    finally:
+        # The consumer stopped early, don't check the remaining batches
+        for future in futures:
+            future.cancel()
+
+
+def search(smiles, limit, offset):
+    """Get a page of the molecules that contain smiles.
+
+    Returns a tuple of the ids of the molecules in the page, and whether
+    there are more molecules after the page.
+    """
+    ids = list(itertools.islice(matches(smiles), offset, offset + limit + 1))
+    return ids[:limit], len(ids) > limit
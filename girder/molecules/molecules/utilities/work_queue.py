@@ -0,0 +1,184 @@
+import os
+import socket
+import threading
+import time
+
+import requests
+
+from girder import logger
+from girder.models.setting import Setting
+
+from molecules.constants import PluginSettings
+from molecules.models.workqueue import DEFAULT_LEASE, Workqueue
+
+# Background jobs, such as the generation of 3D coordinates and SVGs, are
+# queued in the workqueue collection, so that they survive a restart of
+# girder. Each girder process runs a bounded number of worker threads that
+# lease jobs from the queue, and acknowledge them once they are done. Jobs
+# that fail are retried with a backoff, and jobs whose worker went away are
+# queued again by the reaper once their lease expires.
+
+DEFAULT_WORKERS = 2
+# How often idle workers check for jobs queued by other girder processes
+POLL_INTERVAL = 1.0
+# How often the leases of the queue are checked
+REAP_INTERVAL = 60
+# How often the lease of a running job is renewed, well within the lease so
+# that a slow renewal doesn't let it expire
+RENEW_INTERVAL = DEFAULT_LEASE.total_seconds() / 3
+
+_handlers = {}
+_workers = []
+_lock = threading.Lock()
+_wake = threading.Event()
+_stop = threading.Event()
+_last_reap = 0
+
+
+def handler(job_type):
+    """Register the decorated function as the handler of job_type.
+
+    The function is called with the job. It should be idempotent, since a
+    job can be attempted more than once.
+    """
+    def register(func):
+        _handlers[job_type] = func
+        return func
+
+    return register
+
+
+def workers():
+    value = Setting().get(PluginSettings.WORK_QUEUE_WORKERS)
+    if value is None or value == '':
+        return DEFAULT_WORKERS
+
+    return int(float(value))
+
+
+def enqueue(job_type, key, payload=None, user=None):
+    """Queue a job, unless one of job_type is already active for key."""
+    job = Workqueue().enqueue(job_type, key, payload, user)
+    _wake.set()
+
+    return job
+
+
+def is_active(job_type, key):
+    return Workqueue().is_active(job_type, key)
+
+
+def _retry(e):
+    # Don't retry requests that the services rejected as bad
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500
+
+    return True
+
+
+def reap(force=False):
+    """Queue the jobs with expired leases again, at most every REAP_INTERVAL
+    seconds unless force is True. Returns the number of jobs queued again.
+    """
+    global _last_reap
+
+    with _lock:
+        if not force and time.time() - _last_reap < REAP_INTERVAL:
+            return 0
+        _last_reap = time.time()
+
+    count = Workqueue().reap()
+    if count:
+        logger.warning('Queued %d jobs with expired leases again' % count)
+
+    return count
+
+
+def _renew(job, owner, done):
+    # Keep the lease of job while it runs, which can be longer than the lease
+    # with the retries of the bulk lane, so that it isn't queued again
+    while not done.wait(RENEW_INTERVAL):
+        try:
+            if not Workqueue().renew(job, owner):
+                logger.warning('Lost the lease of job %s (%s)' %
+                               (job['_id'], job['type']))
+                return
+        except Exception:
+            logger.exception('Failed to renew the lease of job %s' %
+                             job['_id'])
+
+
+def run_one(owner):
+    """Claim and run one job. Returns False if there were no jobs available.
+    """
+    model = Workqueue()
+    job = model.claim(owner)
+    if job is None:
+        return False
+
+    done = threading.Event()
+    renewer = threading.Thread(target=_renew, args=(job, owner, done),
+                               daemon=True, name='work-queue-lease')
+    renewer.start()
+
+    func = _handlers.get(job['type'])
+    try:
+        if func is None:
+            raise ValueError('No handler for jobs of type %s' % job['type'])
+
+        func(job)
+    except Exception as e:
+        logger.exception('Job %s (%s) failed' % (job['_id'], job['type']))
+        model.fail(job, owner, str(e), retry=func is not None and _retry(e))
+    else:
+        model.ack(job, owner)
+    finally:
+        done.set()
+        renewer.join()
+
+    return True
+
+
+def _work(owner):
+    while not _stop.is_set():
+        try:
+            reap()
+            if run_one(owner):
+                continue
+        except Exception:
+            logger.exception('The work queue worker %s failed' % owner)
+
+        _wake.wait(POLL_INTERVAL)
+        _wake.clear()
+
+
+def start():
+    """Start the worker threads of this process."""
+    _stop.clear()
+    with _lock:
+        count = workers()
+        while len(_workers) < count:
+            owner = '%s:%d:%d' % (socket.gethostname(), os.getpid(),
+                                  len(_workers))
+            worker = threading.Thread(target=_work, args=(owner,),
+                                      daemon=True, name='work-queue')
+            worker.start()
+            _workers.append(worker)
+
+
+def stop():
+    """Stop the worker threads once they finish their current jobs.
+
+    Jobs that are interrupted are queued again when their leases expire.
+    """
+    _stop.set()
+    _wake.set()
+    with _lock:
+        del _workers[:]
+
+
+def stats():
+    return {
+        'workers': workers(),
+        'jobs': Workqueue().stats()
+    }
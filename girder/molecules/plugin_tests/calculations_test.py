@@ -20,8 +20,10 @@
 import json
 import pytest
 import os
+import time
 
 from pytest_girder.assertions import assertStatusOk, assertStatus
+from pytest_girder.utils import getResponseBody
 
 
 @pytest.mark.plugin('molecules')
@@ -120,6 +122,53 @@ def test_get_calc(server, molecule, calculation, user):
     assert str(calc['_id']) == calc_id
 
 
+@pytest.mark.plugin('molecules')
+def test_get_calc_by_molecule(server, molecule, calculation, user):
+    molecule = molecule(user)
+    calculation = calculation(user, molecule)
+    calc_id = str(calculation['_id'])
+
+    # Find it through the name and formula of its molecule
+    for params in [{'name': 'Eth'}, {'formula': 'c2h6'},
+                   {'name': 'ethane', 'formula': 'C2H6'}]:
+        r = server.request('/calculations', method='GET', params=params,
+                           user=user)
+        assertStatusOk(r)
+
+        assert r.json['matches'] == 1
+        assert len(r.json['results']) == 1
+        assert str(r.json['results'][0]['_id']) == calc_id
+
+    # No molecule matches
+    params = {'name': 'methane'}
+    r = server.request('/calculations', method='GET', params=params, user=user)
+    assertStatusOk(r)
+
+    assert r.json['matches'] == 0
+    assert r.json['results'] == []
+
+
+@pytest.mark.plugin('molecules')
+def test_get_calc_permissions(server, molecule, calculation, user):
+    molecule = molecule(user)
+    calculation(user, molecule)
+
+    # The calculation is private, so it should not be counted either
+    for params in [{}, {'formula': 'C2H6'}]:
+        r = server.request('/calculations', method='GET', params=params)
+        assertStatusOk(r)
+
+        assert r.json['matches'] == 0
+        assert r.json['results'] == []
+
+        r = server.request('/calculations', method='GET', params=params,
+                           user=user)
+        assertStatusOk(r)
+
+        assert r.json['matches'] == 1
+        assert 'access' not in r.json['results'][0]
+
+
 @pytest.mark.plugin('molecules')
 def test_put_properties(server, molecule, calculation, user):
     from molecules.models.calculation import Calculation
@@ -265,6 +314,99 @@ def test_ingest_pending(server, molecule, user, make_girder_file, fsAssetstore):
 
     assert 'pending' not in calculation['properties']
 
+@pytest.mark.plugin('molecules')
+def test_identical_calc(server, molecule, user, make_girder_file, fsAssetstore):
+    molecule = molecule(user)
+    body = {
+        'moleculeId': molecule['_id'],
+        'cjson': None,
+        'public': True,
+        'image': {
+            'repository': 'openchemistry/psi4',
+            'tag': 'latest',
+            'digest': 'sha256:0123456789abcdef'
+        },
+        'input': {
+            'parameters': {
+                'theory': 'b3lyp',
+                'basis': '3-21g'
+            },
+            'geometryHash': 'f1e2d3c4'
+        },
+        'properties': {
+            'pending': True
+        },
+        'reuse': True
+    }
+
+    # Identical submissions with reuse are coalesced onto one pending
+    # calculation
+    r = server.request('/calculations', method='POST', type='application/json',
+                       body=json.dumps(body), user=user)
+    assertStatus(r, 201)
+    calculation = r.json
+
+    r = server.request('/calculations', method='POST', type='application/json',
+                       body=json.dumps(body), user=user)
+    assertStatusOk(r)
+    assert r.json['_id'] == calculation['_id']
+
+    # Others always get a calculation of their own
+    r = server.request('/calculations', method='POST', type='application/json',
+                       body=json.dumps(dict(body, reuse=False)), user=user)
+    assertStatus(r, 201)
+    assert r.json['_id'] != calculation['_id']
+    own_id = r.json['_id']
+
+    # A pending calculation that has timed out is not reused
+    from girder.models.setting import Setting
+    from molecules.constants import PluginSettings
+    Setting().set(PluginSettings.PENDING_CALCULATION_TIMEOUT, 0)
+    try:
+        time.sleep(1.1)
+        stale = dict(body, input=dict(body['input'], geometryHash='e5f6a7b8'))
+        r = server.request('/calculations', method='POST', type='application/json',
+                           body=json.dumps(stale), user=user)
+        assertStatus(r, 201)
+        stale_id = r.json['_id']
+
+        time.sleep(1.1)
+        r = server.request('/calculations', method='POST', type='application/json',
+                           body=json.dumps(stale), user=user)
+        assertStatus(r, 201)
+        assert r.json['_id'] != stale_id
+    finally:
+        Setting().unset(PluginSettings.PENDING_CALCULATION_TIMEOUT)
+
+    # A different geometry is a different calculation
+    other = dict(body, input=dict(body['input'], geometryHash='a1b2c3d4'))
+    r = server.request('/calculations', method='POST', type='application/json',
+                       body=json.dumps(other), user=user)
+    assertStatus(r, 201)
+    assert r.json['_id'] != calculation['_id']
+
+    # Once it completes, a pending submission isn't coalesced onto it, as
+    # its results would be ingested into the completed calculation, but onto
+    # the identical one that is still pending
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(dir_path, 'data', 'ethane.cjson')) as f:
+        file = make_girder_file(fsAssetstore, user, 'ethane.cjson', contents=f.read().encode())
+
+    ingest = {
+        'fileId': str(file['_id']),
+        'format': 'cjson',
+        'public': True
+    }
+    r = server.request('/calculations/%s' % calculation['_id'], method='PUT', type='application/json',
+                       body=json.dumps(ingest), user=user)
+    assertStatusOk(r)
+
+    r = server.request('/calculations', method='POST', type='application/json',
+                       body=json.dumps(body), user=user)
+    assertStatusOk(r)
+    assert r.json['_id'] == own_id
+    assert r.json['properties']['pending']
+
 @pytest.mark.plugin('molecules')
 def test_ingest_with_molecule(server, molecule, user, make_girder_file, fsAssetstore):
     molecule = molecule(user)
@@ -354,3 +496,225 @@ def test_get_cube(server, molecule, calculation, user):
     calc_dims_prod = calc_dims[0] * calc_dims[1] * calc_dims[2]
     calc_scalars_len = len(cjson['cube']['scalars'])
     assert calc_dims_prod == calc_scalars_len
+
+
+@pytest.mark.plugin('molecules')
+def test_get_cube_raw(server, molecule, calculation, user):
+    import numpy as np
+    from molecules.models.cubecache import Cubecache
+
+    molecule = molecule(user, 'water')
+    calculation_water = calculation(user, molecule, 'water')
+    calc_id = str(calculation_water['_id'])
+
+    r = server.request('/calculations/%s/cube/%s' % (calc_id, 'homo'),
+                       method='GET', user=user)
+    assertStatusOk(r)
+    cube = r.json['cube']
+
+    path = '/calculations/%s/cube/%s/raw' % (calc_id, 'homo')
+    r = server.request(path, method='GET', user=user, isJson=False)
+    assertStatusOk(r)
+    body = getResponseBody(r, text=False)
+
+    offset = int(r.headers['X-Cube-Data-Offset'])
+    assert offset % 4 == 0
+    header = json.loads(body[:offset].decode('utf8'))
+    assert header['dimensions'] == cube['dimensions']
+    assert header['dataOffset'] == offset
+    assert header['count'] == len(cube['scalars'])
+
+    scalars = np.frombuffer(body[offset:], dtype='<f4')
+    assert np.allclose(scalars, cube['scalars'], rtol=1e-6)
+
+    # The cached scalars are read from the BSON, not decoded into a list
+    cached = Cubecache().findOne({'calculationId': calculation_water['_id']},
+                                 fields=['_id'])
+    assert isinstance(Cubecache().scalars(cached['_id']), np.ndarray)
+
+    # A range of the scalars
+    start = offset + 4 * 10
+    r = server.request(path, method='GET', user=user, isJson=False,
+                       additionalHeaders=[
+                           ('Range', 'bytes=%d-%d' % (start, start + 7))])
+    assertStatus(r, 206)
+    assert getResponseBody(r, text=False) == body[start:start + 8]
+
+
+
+@pytest.mark.plugin('molecules')
+def test_cube_cache(server, molecule, calculation, user, admin):
+    from molecules.models.cubecache import Cubecache
+
+    molecule = molecule(user, 'water')
+    calculation_water = calculation(user, molecule, 'water')
+    calc_id = str(calculation_water['_id'])
+
+    for _ in range(2):
+        r = server.request('/calculations/%s/cube/%s' % (calc_id, 'homo'),
+                           method='GET', user=user)
+        assertStatusOk(r)
+
+    # Only one cube is cached for the orbital
+    query = {'calculationId': calculation_water['_id']}
+    assert Cubecache().collection.count_documents(query) == 1
+    cached = Cubecache().findOne(query)
+    assert cached['hits'] == 1
+    assert cached['size'] > 0
+
+    # The cube is being calculated, so another request can't claim it
+    assert Cubecache().claim(calc_id, 1000)
+    assert not Cubecache().claim(calc_id, 1000)
+    assert Cubecache().release(calc_id, 1000) is not None
+    assert Cubecache().claim(calc_id, 1000)
+    Cubecache().release(calc_id, 1000)
+
+    r = server.request('/calculations/cubes/cache', method='GET', user=user)
+    assertStatus(r, 403)
+
+    r = server.request('/calculations/cubes/cache', method='GET', user=admin)
+    assertStatusOk(r)
+    assert r.json['entries'] == 1
+    assert r.json['pending'] == 0
+    assert r.json['size'] == cached['size']
+    assert r.json['hits'] >= 1
+
+    # Evicting down to no space removes the cube
+    assert Cubecache().evict(0) == 1
+    assert Cubecache().findOne(query) is None
+
+    # The waiters are taken in the same step as the marker is replaced
+    assert Cubecache().claim(calc_id, 1000, resolution='medium')
+    assert Cubecache().add_waiter(calc_id, 1000, user, 'medium')
+    cube, waiters = Cubecache().complete(calc_id, 1000, {}, 'medium')
+    assert waiters == [user['_id']]
+    assert not Cubecache().add_waiter(calc_id, 1000, user, 'medium')
+    cached = Cubecache().find_mo(calc_id, 1000, 'medium')
+    assert cached['_id'] == cube['_id']
+    assert 'waiters' not in cached
+
+
+@pytest.mark.plugin('molecules')
+def test_cube_cache_migrate(server, molecule, calculation, user):
+    from molecules.models import cubecache
+    from molecules.models.cubecache import Cubecache
+
+    molecule = molecule(user, 'water')
+    calculation_water = calculation(user, molecule, 'water')
+    calc_id = calculation_water['_id']
+
+    # Cubes cached before the index was unique, one of them twice along
+    # with a pending marker for it
+    collection = Cubecache().collection
+    collection.drop_indexes()
+    collection.insert_many([
+        {'calculationId': calc_id, 'mo': 4, 'resolution': 'medium',
+         'pending': True},
+        {'calculationId': calc_id, 'mo': 4, 'resolution': 'medium',
+         'cjson': {}},
+        {'calculationId': calc_id, 'mo': 4, 'resolution': 'medium',
+         'cjson': {}},
+        {'calculationId': calc_id, 'mo': 5, 'resolution': 'medium',
+         'cjson': {}}
+    ])
+
+    assert cubecache.migrate() == 2
+    query = {'calculationId': calc_id}
+    assert collection.count_documents(query) == 2
+    assert not collection.find_one(dict(query, mo=4)).get('pending')
+
+    # Which lets the index be built, and only runs once
+    Cubecache().reconnect()
+    assert cubecache.migrate() == 0
+    assert Cubecache().find_mo(calc_id, 4, 'medium') is not None
+
+
+@pytest.mark.plugin('molecules')
+def test_cube_cache_migrate_resolutions(server, molecule, calculation, user):
+    from molecules.models import cubecache
+    from molecules.models.cubecache import Cubecache
+
+    molecule = molecule(user, 'water')
+    calculation_water = calculation(user, molecule, 'water')
+    calc_id = calculation_water['_id']
+
+    # Cubes cached before they had resolutions, under the old unique index
+    collection = Cubecache().collection
+    collection.drop_indexes()
+    collection.create_index(cubecache.OLD_CUBE_INDEX, unique=True)
+    collection.insert_many([
+        {'calculationId': calc_id, 'mo': 4, 'cjson': {}},
+        {'calculationId': calc_id, 'mo': 5, 'cjson': {}}
+    ])
+
+    assert cubecache.migrate() == 0
+    Cubecache().reconnect()
+
+    # They are medium cubes now, and other resolutions can be cached too
+    assert collection.count_documents({'resolution': 'medium'}) == 2
+    assert Cubecache().find_mo(calc_id, 4, 'medium') is not None
+    Cubecache().create(calc_id, 4, {}, 'fine')
+    assert Cubecache().find_mo(calc_id, 4, 'fine') is not None
+
+
+@pytest.mark.plugin('molecules')
+def test_orbital_prefetch(server, molecule, calculation, user):
+    from molecules.models.cubecache import Cubecache
+    from molecules.utilities import orbital_prefetch
+
+    molecule = molecule(user, 'water')
+    calculation_water = calculation(user, molecule, 'water')
+    calc_id = calculation_water['_id']
+
+    # Water has 10 electrons, so HOMO-2 to LUMO+2 is orbitals 2 to 7
+    assert orbital_prefetch.prefetch(calc_id) == 6
+    mos = Cubecache().collection.distinct('mo', {'calculationId': calc_id})
+    assert sorted(mos) == [2, 3, 4, 5, 6, 7]
+
+    # Cached cubes are not calculated again
+    assert orbital_prefetch.prefetch(calc_id) == 0
+
+    r = server.request('/calculations/%s/cube/%s' % (calc_id, 'lumo'),
+                       method='GET', user=user)
+    assertStatusOk(r)
+    assert Cubecache().find_mo(calc_id, 5, 'medium')['hits'] == 2
+
+
+@pytest.mark.plugin('molecules')
+def test_get_cube_progressive(server, molecule, calculation, user):
+    from molecules.models.cubecache import Cubecache
+
+    molecule = molecule(user, 'water')
+    calculation_water = calculation(user, molecule, 'water')
+    calc_id = str(calculation_water['_id'])
+
+    r = server.request('/calculations/%s/cube/%s' % (calc_id, 'homo'),
+                       method='GET', user=user,
+                       params={'resolution': 'fine', 'progressive': 'true'})
+    assertStatusOk(r)
+    coarse = r.json['cube']
+    assert coarse['resolution'] == 'coarse'
+    assert r.json['generating_orbital']
+
+    # Both resolutions are cached for the orbital, once the fine one is done
+    fine = Cubecache().wait(calc_id, 4, 'fine')
+    assert fine is not None
+    assert Cubecache().find_mo(calc_id, 4, 'coarse') is not None
+
+    r = server.request('/calculations/%s/cube/%s' % (calc_id, 'homo'),
+                       method='GET', user=user,
+                       params={'resolution': 'fine', 'progressive': 'true'})
+    assertStatusOk(r)
+    assert r.json['cube']['resolution'] == 'fine'
+    assert not r.json['generating_orbital']
+
+    dims = r.json['cube']['dimensions']
+    assert dims[0] * dims[1] * dims[2] > (
+        coarse['dimensions'][0] * coarse['dimensions'][1] *
+        coarse['dimensions'][2])
+
+    r = server.request('/calculations/%s/cube/%s' % (calc_id, 'homo'),
+                       method='GET', user=user,
+                       params={'resolution': 'huge'})
+    assertStatus(r, 400)
+
@@ -22,6 +22,7 @@ import os
 import pytest
 
 from pytest_girder.assertions import assertStatusOk
+from pytest_girder.utils import getResponseBody
 
 
 @pytest.mark.plugin('molecules')
@@ -106,3 +107,46 @@ def test_get_geometry(server, geometry, molecule, user):
     assert geometry.get('moleculeId') == str(molecule_id)
     assert geometry.get('provenanceType') == provenance_type
     assert geometry.get('provenanceId') == str(provenance_id)
+
+
+@pytest.mark.plugin('molecules')
+def test_get_geometry_xyz_cached(server, geometry, molecule, user, admin):
+    from molecules.utilities import conversion_cache
+
+    molecule = molecule(user)
+    geometry = geometry(user, molecule)
+
+    conversion_cache.clear()
+
+    path = '/molecules/%s/geometries/%s/xyz' % (molecule['_id'],
+                                                geometry['_id'])
+    r = server.request(path, method='GET', user=user, isJson=False)
+    assertStatusOk(r)
+    xyz = getResponseBody(r)
+
+    # The second request should be served from the cache
+    r = server.request(path, method='GET', user=user, isJson=False)
+    assertStatusOk(r)
+    assert getResponseBody(r) == xyz
+
+    r = server.request('/molecules/conversions/cache', method='GET',
+                       user=admin)
+    assertStatusOk(r)
+    assert r.json['hits'] == 1
+    assert r.json['misses'] == 1
+
+    # Saving the geometry drops its outputs, and changes their key
+    from molecules.models.geometry import Geometry as GeometryModel
+    doc = GeometryModel().load(geometry['_id'], force=True)
+    assert doc.get('updated') is not None
+    GeometryModel().save(doc)
+
+    r = server.request(path, method='GET', user=user, isJson=False)
+    assertStatusOk(r)
+    assert getResponseBody(r) == xyz
+
+    r = server.request('/molecules/conversions/cache', method='GET',
+                       user=admin)
+    assertStatusOk(r)
+    assert r.json['hits'] == 1
+    assert r.json['misses'] == 2
@@ -240,6 +240,34 @@ def test_create_molecule_smiles(server, user):
     assertStatusOk(r)
 
 
+@pytest.mark.plugin('molecules')
+def test_create_molecule_atom_counts(server, user):
+    from molecules.models.molecule import Molecule
+
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+
+    # Methanol has elements with a count of 1
+    with open(dir_path + '/data/methanol.smi', 'r') as rf:
+        smi_data = rf.read()
+
+    body = {
+        'name': 'methanol',
+        'smi': smi_data,
+        'generate3D': False
+    }
+
+    r = server.request('/molecules', method='POST', type='application/json',
+                       body=json.dumps(body), user=user)
+    assertStatusOk(r)
+
+    mol = Molecule().load(r.json['_id'], force=True)
+    assert mol['atomCounts'] == {'C': 1, 'H': 4, 'O': 1}
+
+    r = server.request('/molecules/%s' % mol['_id'], method='DELETE',
+                       user=user)
+    assertStatusOk(r)
+
+
 @pytest.mark.plugin('molecules')
 def test_get_molecule(server, molecule, user):
     molecule = molecule(user)
@@ -438,3 +466,125 @@ def test_search_molecule_formula(server, molecule, user):
     assert mol.get('smiles') == smiles
     assert mol.get('name') == name
     assert mol.get('properties').get('formula') == ethane_formula
+
+
+@pytest.mark.plugin('molecules')
+def test_find_molecules_cursor(server, molecule, user):
+    molecule = molecule(user)
+
+    # A full page has a cursor for the next one
+    params = {'limit': 1, 'count': 'capped'}
+    r = server.request('/molecules', method='GET', user=user, params=params)
+    assertStatusOk(r)
+
+    assert r.json['matches'] == 1
+    assert 'matchesExact' not in r.json
+    assert r.json['results'][0]['_id'] == molecule['_id']
+    assert r.json['next'] == molecule['_id']
+
+    # Which is empty, and the last one
+    params = {'limit': 1, 'count': 'none', 'cursor': r.json['next']}
+    r = server.request('/molecules', method='GET', user=user, params=params)
+    assertStatusOk(r)
+
+    assert r.json['matches'] is None
+    assert r.json['matchesExact'] is False
+    assert r.json['results'] == []
+    assert 'next' not in r.json
+
+    # Cursors are ids, so there is none when sorting by anything else
+    params = {'limit': 1, 'sort': 'name', 'sortdir': 1}
+    r = server.request('/molecules', method='GET', user=user, params=params)
+    assertStatusOk(r)
+
+    assert len(r.json['results']) == 1
+    assert 'next' not in r.json
+
+
+@pytest.mark.plugin('molecules')
+def test_work_queue(server, molecule, user, admin):
+    import datetime
+    import time
+    from molecules.models.molecule import Molecule
+    from molecules.models.workqueue import Workqueue
+    from molecules.utilities import async_requests
+    from molecules.utilities import work_queue
+
+    molecule = molecule(user)
+    _id = molecule['_id']
+
+    # Run the jobs in the test, rather than in the workers
+    work_queue.stop()
+    try:
+        async_requests.schedule_svg_gen(molecule, user)
+        job = Workqueue().find_active(async_requests.SVG_JOB, _id)
+        assert job['state'] == 'queued'
+
+        # Only one job at a time for a molecule
+        async_requests.schedule_svg_gen(molecule, user)
+        query = {'key': job['key']}
+        assert Workqueue().collection.count_documents(query) == 1
+
+        # The flag is derived from the job
+        r = server.request('/molecules/%s' % _id, method='GET', user=user)
+        assertStatusOk(r)
+        assert r.json['generating_svg']
+
+        # A failed attempt is retried after a backoff
+        job = Workqueue().claim('test')
+        assert job['attempts'] == 1
+        assert Workqueue().fail(job, 'test', 'Failed')
+        assert Workqueue().claim('test') is None
+
+        # A lost lease is reaped
+        query = {'_id': job['_id']}
+        Workqueue().update(query, {'$set': {
+            'available': datetime.datetime.utcnow()
+        }})
+        job = Workqueue().claim('test')
+        assert job['attempts'] == 2
+        Workqueue().update(query, {'$set': {
+            'leaseExpires': datetime.datetime.utcnow() - datetime.timedelta(1)
+        }})
+        assert work_queue.reap(force=True) == 1
+
+        # The acknowledgment, or renewal, of a lost lease is ignored
+        assert not Workqueue().ack(job, 'test')
+        assert not Workqueue().renew(job, 'test')
+
+        # The lease of a job is renewed while it runs
+        renew_interval = work_queue.RENEW_INTERVAL
+        work_queue.RENEW_INTERVAL = 0.1
+        generate_svg = work_queue._handlers[async_requests.SVG_JOB]
+        leases = []
+
+        def handler(job):
+            expires = Workqueue().load(job['_id'], force=True)['leaseExpires']
+            time.sleep(0.5)
+            leases.append((expires, Workqueue().load(
+                job['_id'], force=True)['leaseExpires']))
+            generate_svg(job)
+
+        work_queue._handlers[async_requests.SVG_JOB] = handler
+        try:
+            assert work_queue.run_one('test')
+        finally:
+            work_queue._handlers[async_requests.SVG_JOB] = generate_svg
+            work_queue.RENEW_INTERVAL = renew_interval
+        assert leases[0][1] > leases[0][0]
+
+        assert not work_queue.run_one('test')
+        assert Workqueue().load(job['_id'], force=True)['state'] == 'done'
+        assert 'svg' in Molecule().load(_id, force=True)
+
+        r = server.request('/molecules/%s' % _id, method='GET', user=user)
+        assertStatusOk(r)
+        assert not r.json['generating_svg']
+
+        r = server.request('/molecules/queue', method='GET', user=admin)
+        assertStatusOk(r)
+        svg = r.json['jobs']['svg']
+        assert svg['done'] >= 1
+        assert svg['latency']['count'] >= 1
+    finally:
+        work_queue.start()
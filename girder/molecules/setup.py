@@ -17,11 +17,17 @@ setup(
       'beautifulsoup4',
       'jcamp',
       'requests',
-      'requests-futures'
+      'requests-futures',
+      'click',
+      'numpy',
+      'pymongo'
     ],
     entry_points={
       'girder.plugin': [
           'molecules = molecules:MoleculesPlugin'
+      ],
+      'girder.cli_plugins': [
+          'molecules = molecules.cli:main'
       ]
     }
 )
@@ -0,0 +1,31 @@
+import pytest
+
+
+@pytest.fixture
+def queue():
+    """Our method for creating a queue within girder."""
+    from queues.models.queue import Queue, QueueType
+    queues = []
+    def _queue(user, name='queue', type_=QueueType.FIFO, max_running=0):
+        _queue = Queue().create(name, type_=type_, max_running=max_running,
+                                user=user)
+        queues.append(_queue)
+
+        return _queue
+
+    yield _queue
+
+    for _queue in queues:
+        Queue().remove(_queue)
+
+@pytest.fixture
+def started(monkeypatch):
+    """Record the taskflows that the queues start, instead of starting them."""
+    from queues.models.queue import Queue
+    _started = []
+    def _start_taskflow(self, queue_id, taskflow_id, params, user):
+        _started.append(taskflow_id)
+
+    monkeypatch.setattr(Queue, '_start_taskflow', _start_taskflow)
+
+    return _started
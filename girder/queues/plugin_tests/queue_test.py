@@ -0,0 +1,246 @@
+import threading
+
+import pytest
+from bson.objectid import ObjectId
+
+
+def _add(model, queue, user, n, params=None):
+    taskflow_ids = [ObjectId() for _ in range(n)]
+    for taskflow_id in taskflow_ids:
+        model.add(queue, {'_id': taskflow_id}, params, user)
+
+    return taskflow_ids
+
+
+@pytest.mark.plugin('queues')
+def test_fifo(server, user, queue, started):
+    from queues.models.queue import Queue, QueueType
+
+    model = Queue()
+    fifo = queue(user, type_=QueueType.FIFO)
+    taskflow_ids = _add(model, fifo, user, 3)
+
+    fifo = model.pop(fifo, 2, user)
+    assert started == taskflow_ids[:2]
+    assert fifo['nRunning'] == 2
+
+    fifo = model.pop(fifo, 2, user)
+    assert started == taskflow_ids
+    assert fifo['nRunning'] == 3
+
+
+@pytest.mark.plugin('queues')
+def test_lifo(server, user, queue, started):
+    from queues.models.queue import Queue, QueueType
+
+    model = Queue()
+    lifo = queue(user, type_=QueueType.LIFO)
+    taskflow_ids = _add(model, lifo, user, 3)
+
+    model.pop(lifo, 2, user)
+    assert started == taskflow_ids[:0:-1]
+
+    # Taskflows added later still go first
+    taskflow_ids += _add(model, lifo, user, 1)
+    model.pop(lifo, 2, user)
+    assert started == [taskflow_ids[2], taskflow_ids[1], taskflow_ids[3],
+                       taskflow_ids[0]]
+
+
+@pytest.mark.plugin('queues')
+def test_max_running(server, user, queue, started):
+    from queues.models.queue import Queue
+    from queues.models.queue_task import QueueTask, TaskStatus
+
+    model = Queue()
+    capped = queue(user, max_running=2)
+    taskflow_ids = _add(model, capped, user, 5)
+
+    capped = model.pop(capped, 5, user)
+    assert started == taskflow_ids[:2]
+    assert capped['nRunning'] == 2
+    assert QueueTask().count(capped['_id'], TaskStatus.PENDING) == 3
+
+    # Nothing is started until a run slot is freed
+    capped = model.pop(capped, 5, user)
+    assert started == taskflow_ids[:2]
+
+    capped = model.finish(capped, {'_id': taskflow_ids[0]}, user)
+    assert capped['nRunning'] == 1
+    capped = model.pop(capped, 5, user)
+    assert started == taskflow_ids[:3]
+    assert capped['nRunning'] == 2
+
+
+@pytest.mark.plugin('queues')
+def test_concurrent_pops(server, user, queue):
+    from queues.models.queue import Queue
+    from queues.models.queue_task import QueueTask, TaskStatus
+
+    model = Queue()
+    capped = queue(user, max_running=3)
+    _add(model, capped, user, 10)
+
+    popped = []
+    barrier = threading.Barrier(2)
+    def pop():
+        barrier.wait()
+        popped.append(model._pop_many(capped, 10))
+
+    threads = [threading.Thread(target=pop) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The pops share the run slots, and no task is claimed twice
+    claimed = [x['_id'] for tasks in popped for x in tasks]
+    assert len(claimed) == 3
+    assert len(set(claimed)) == 3
+
+    capped = model.load(capped['_id'], force=True)
+    assert capped['nRunning'] == 3
+    assert QueueTask().count(capped['_id'], TaskStatus.RUNNING) == 3
+    assert QueueTask().count(capped['_id'], TaskStatus.PENDING) == 7
+
+
+@pytest.mark.plugin('queues')
+def test_migrate_embedded_tasks(server, user, queue, started):
+    from queues.models.queue import Queue, QueueType, migrate_embedded_tasks
+    from queues.models.queue_task import QueueTask, TaskStatus
+
+    model = Queue()
+    fifo = queue(user, name='fifo', type_=QueueType.FIFO)
+    lifo = queue(user, name='lifo', type_=QueueType.LIFO)
+
+    # Queues as they were stored before they had their own collection
+    running_id = ObjectId()
+    pending = {}
+    for q in (fifo, lifo):
+        pending[q['_id']] = [ObjectId() for _ in range(3)]
+        updates = {
+            '$set': {
+                'nRunning': 1,
+                'pending': [{
+                    'taskflowId': x,
+                    'startParams': {'cluster': {'_id': 'cluster'}}
+                } for x in pending[q['_id']]],
+                'taskflows': {
+                    str(running_id): TaskStatus.RUNNING
+                }
+            },
+            '$unset': {
+                'seq': ''
+            }
+        }
+        model.collection.update_one({'_id': q['_id']}, updates)
+
+    migrate_embedded_tasks()
+
+    for q in (fifo, lifo):
+        q = model.load(q['_id'], force=True)
+        assert 'pending' not in q
+        assert 'taskflows' not in q
+        assert q['seq'] == 3
+
+        tasks = list(QueueTask().find_tasks(q['_id'], TaskStatus.PENDING))
+        assert [x['taskflowId'] for x in tasks] == pending[q['_id']]
+        assert all(x['cluster'] == 'cluster' for x in tasks)
+
+        tasks = list(QueueTask().find_tasks(q['_id'], TaskStatus.RUNNING))
+        assert [x['taskflowId'] for x in tasks] == [running_id]
+
+    # The migrated tasks keep their order, after those added later
+    added = _add(model, fifo, user, 1)
+    model.pop(fifo, 4, user)
+    assert started == pending[fifo['_id']] + added
+
+    added = _add(model, lifo, user, 1)
+    model.pop(lifo, 4, user)
+    assert started[4:] == added + pending[lifo['_id']]
+
+    # Migrating again does nothing
+    migrate_embedded_tasks()
+    assert QueueTask().count(fifo['_id']) == 5
+
+
+def _cluster(name):
+    return {'cluster': {'_id': name}}
+
+
+@pytest.mark.plugin('queues')
+def test_allocate_weights(server, user, queue):
+    from girder.models.setting import Setting
+    from queues.constants import PluginSettings
+    from queues.models.queue import Queue
+
+    model = Queue()
+    light = queue(user, name='light')
+    heavy = queue(user, name='heavy')
+    heavy = model.apply_updates(heavy, {'weight': 3}, user)
+    for q in (light, heavy):
+        _add(model, q, user, 8, _cluster('a'))
+
+    Setting().set(PluginSettings.CLUSTER_MAX_RUNNING, {'a': 4})
+    allocations, queues = model._allocate([light['_id'], heavy['_id']], 100)
+
+    # The slots of the cluster are shared in proportion to the weights
+    assert dict(allocations) == {
+        (light['_id'], 'a'): 1,
+        (heavy['_id'], 'a'): 3
+    }
+    assert set(queues) == {light['_id'], heavy['_id']}
+
+
+@pytest.mark.plugin('queues')
+def test_allocate_cluster_max_running(server, user, queue, started):
+    from girder.models.setting import Setting
+    from queues.constants import PluginSettings
+    from queues.models.queue import Queue
+
+    model = Queue()
+    first = queue(user, name='first')
+    second = queue(user, name='second')
+    _add(model, first, user, 2, _cluster('a'))
+    model.pop(first, 2, user)
+    for q in (first, second):
+        _add(model, q, user, 4, _cluster('a'))
+        _add(model, q, user, 2, _cluster('b'))
+
+    # The taskflows already running on a cluster count towards its limit,
+    # and clusters without one are only limited by the queues
+    Setting().set(PluginSettings.CLUSTER_MAX_RUNNING, {'a': 3})
+    allocations, _ = model._allocate([first['_id'], second['_id']], 100)
+
+    assert dict(allocations) == {
+        (second['_id'], 'a'): 1,
+        (first['_id'], 'b'): 2,
+        (second['_id'], 'b'): 2
+    }
+
+
+@pytest.mark.plugin('queues')
+def test_allocate_max_running(server, user, queue):
+    from girder.models.setting import Setting
+    from queues.constants import PluginSettings
+    from queues.models.queue import Queue
+
+    model = Queue()
+    first = queue(user, name='first')
+    second = queue(user, name='second')
+    for q in (first, second):
+        _add(model, q, user, 5)
+
+    # Ties go to the queue that was created first
+    Setting().set(PluginSettings.MAX_RUNNING, 3)
+    allocations, _ = model._allocate([first['_id'], second['_id']], 100)
+    assert dict(allocations) == {
+        (first['_id'], None): 2,
+        (second['_id'], None): 1
+    }
+
+    # The limit of the call applies too
+    allocations, _ = model._allocate([first['_id'], second['_id']], 1)
+    assert dict(allocations) == {
+        (first['_id'], None): 1
+    }
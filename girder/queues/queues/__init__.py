@@ -1,8 +1,56 @@
 from .queue import Queue
 from .models.queue import on_taskflow_status_update, cleanup_failed_taskflows
+from .models.queue import migrate_embedded_tasks
+from . import cleanup
+
+import cherrypy
 
 from girder import events
+from girder.models.model_base import ValidationException
 from girder.plugin import getPlugin, GirderPlugin
+from girder.utility import setting_utilities
+
+from .constants import PluginSettings
+
+
+@setting_utilities.validator({
+    PluginSettings.MAX_RUNNING,
+    PluginSettings.DEFAULT_MAX_RUNNING
+})
+def validateMaxRunning(doc):
+    if doc['value'] in (None, ''):
+        return
+
+    if not isinstance(doc['value'], int) or doc['value'] < 0:
+        raise ValidationException(
+            '%s must be a non-negative integer' % doc['key'], 'value')
+
+
+@setting_utilities.validator(PluginSettings.CLUSTER_MAX_RUNNING)
+def validateClusterMaxRunning(doc):
+    if doc['value'] in (None, ''):
+        return
+
+    if not isinstance(doc['value'], dict) or not all(
+            isinstance(x, int) and x >= 0 for x in doc['value'].values()):
+        raise ValidationException(
+            '%s must map clusters to non-negative integers' % doc['key'],
+            'value')
+
+
+@setting_utilities.validator({
+    PluginSettings.CLEANUP_INTERVAL,
+    PluginSettings.CLEANUP_TIME_BUDGET
+})
+def validateCleanup(doc):
+    if doc['value'] in (None, ''):
+        return
+
+    if not isinstance(doc['value'], (int, float)) or doc['value'] < 0:
+        raise ValidationException(
+            '%s must be a non-negative number of seconds' % doc['key'],
+            'value')
+
 
 class QueuePlugin(GirderPlugin):
     DISPLAY_NAME = 'Taskflows Queue'
@@ -14,9 +62,16 @@ class QueuePlugin(GirderPlugin):
 
         info['apiRoot'].queues = Queue()
 
+        # Move the tasks of queues created before they had their own
+        # collection
+        migrate_embedded_tasks()
+
         # Remove taskflows that are not running anymore from the list of running
-        # taskflows stored in the Queue model
+        # taskflows stored in the Queue model, then keep doing so periodically
+        # if queues.cleanup_interval is set
         cleanup_failed_taskflows()
+        cherrypy.engine.subscribe('start', cleanup.start)
+        cherrypy.engine.subscribe('stop', cleanup.stop)
 
         # Listen to changes in the status of the taskflows, and update the Queues
         # if needed
@@ -0,0 +1,75 @@
+import threading
+
+from girder import logger
+from girder.models.setting import Setting
+
+from queues.constants import PluginSettings
+from queues.models.queue import cleanup_failed_taskflows
+
+# Taskflows whose status update was missed (for example, girder was down
+# when they failed) hold on to their run slot until they are removed from
+# their queue. They are removed at startup, and every CLEANUP_INTERVAL
+# seconds by a background thread, spending at most CLEANUP_TIME_BUDGET
+# seconds each time.
+
+DEFAULT_INTERVAL = 0
+DEFAULT_TIME_BUDGET = 10
+# How often a disabled cleanup checks whether it was enabled
+IDLE_INTERVAL = 60
+
+_thread = None
+_lock = threading.Lock()
+_stop = threading.Event()
+
+
+def _setting(key, default):
+    value = Setting().get(key)
+    if value is None or value == '':
+        return default
+
+    return value
+
+
+def interval():
+    return _setting(PluginSettings.CLEANUP_INTERVAL, DEFAULT_INTERVAL)
+
+
+def time_budget():
+    return _setting(PluginSettings.CLEANUP_TIME_BUDGET, DEFAULT_TIME_BUDGET)
+
+
+def _run():
+    while not _stop.is_set():
+        try:
+            seconds = interval()
+        except Exception:
+            logger.exception('Reading the queue cleanup settings failed')
+            seconds = 0
+
+        if not seconds:
+            _stop.wait(IDLE_INTERVAL)
+            continue
+
+        if _stop.wait(seconds):
+            break
+
+        try:
+            cleanup_failed_taskflows(time_budget())
+        except Exception:
+            logger.exception('The cleanup of the queues failed')
+
+
+def start():
+    """Start the periodic cleanup of this process."""
+    global _thread
+
+    _stop.clear()
+    with _lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, daemon=True,
+                                       name='queue-cleanup')
+            _thread.start()
+
+
+def stop():
+    _stop.set()
@@ -0,0 +1,14 @@
+class PluginSettings:
+    # The most taskflows running at once, across all queues (0 is no limit)
+    MAX_RUNNING = 'queues.max_running'
+    # The most taskflows running at once on each cluster, a dict of the id
+    # or name of the cluster to its limit
+    CLUSTER_MAX_RUNNING = 'queues.cluster_max_running'
+    # The maxRunning of the queues created for users by the app plugin
+    DEFAULT_MAX_RUNNING = 'queues.default_max_running'
+    # How often, in seconds, the taskflows that are not running anymore are
+    # removed from the queues (0 only removes them at startup)
+    CLEANUP_INTERVAL = 'queues.cleanup_interval'
+    # The most time, in seconds, spent on each cleanup. The next one carries
+    # on where it stopped.
+    CLEANUP_TIME_BUDGET = 'queues.cleanup_time_budget'
@@ -1,9 +1,18 @@
+import datetime
+import heapq
+import itertools
 import sys
+import threading
+import time
+from collections import defaultdict
+
 from bson.objectid import ObjectId, InvalidId
+from pymongo import ReturnDocument, UpdateOne
 from girder import logger
 from girder.constants import AccessType
 from girder.models.model_base import AccessControlledModel
 from girder.models.model_base import ValidationException
+from girder.models.setting import Setting
 from girder.models.user import User as UserModel
 from girder.utility.model_importer import ModelImporter
 
@@ -11,6 +20,10 @@ import cumulus
 from cumulus.taskflow import load_class, TaskFlowState
 from taskflow.models.taskflow import Taskflow as TaskflowModel
 
+from queues.constants import PluginSettings
+from queues.models.queue_task import QueueTask as QueueTaskModel
+from queues.models.queue_task import ANY_CLUSTER, TaskStatus, cluster_key
+
 TASKFLOW_NON_RUNNING_STATES = [
     TaskFlowState.CREATED,
     TaskFlowState.COMPLETE,
@@ -25,16 +38,45 @@ class QueueType(object):
     LIFO = 'lifo'
     TYPES = [FIFO, LIFO]
 
-class TaskStatus(object):
-    PENDING = 'pending'
-    RUNNING = 'running'
+# The most tasks claimed by one round trip of a pop
+POP_BATCH_SIZE = 1000
+# The number of times a pop retries after losing a race for its run slots
+POP_CONFLICTS = 5
+# The number of running taskflows whose status is checked at a time by
+# cleanup_failed_taskflows
+CLEANUP_BATCH_SIZE = 1000
+
+DEFAULT_MAX_RUNNING = 5
+DEFAULT_WEIGHT = 1
+
+# Scheduling in a girder process is serialized, so that the global and per
+# cluster limits hold. Several girder processes can overshoot them briefly.
+_schedule_lock = threading.Lock()
+
+# Where the last call to cleanup_failed_taskflows stopped
+_cleanup_state = {
+    'lastId': None
+}
+
+def global_max_running():
+    return int(Setting().get(PluginSettings.MAX_RUNNING) or 0)
+
+def cluster_max_running():
+    return Setting().get(PluginSettings.CLUSTER_MAX_RUNNING) or {}
+
+def default_max_running():
+    value = Setting().get(PluginSettings.DEFAULT_MAX_RUNNING)
+    if value is None or value == '':
+        return DEFAULT_MAX_RUNNING
+
+    return int(value)
 
 class Queue(AccessControlledModel):
 
     def initialize(self):
         self.name = 'queues'
         self.ensureIndices(['name'])
-        self.mutable_props = ['maxRunning']
+        self.mutable_props = ['maxRunning', 'weight']
 
     def validate(self, queue):
         name = queue['name']
@@ -73,13 +115,17 @@ class Queue(AccessControlledModel):
 
     def create(self, name, type_, max_running, user=None):
 
+        # The tasks of the queue are in the queue_tasks collection, seq is
+        # the last sequence number given to one of them.
         queue = {
             'name': name,
             'type': type_,
             'nRunning': 0,
             'maxRunning': max_running,
-            'pending': [],
-            'taskflows': {}
+            # The share of the clusters the queue gets, relative to the
+            # other queues with taskflows pending on them
+            'weight': DEFAULT_WEIGHT,
+            'seq': 0
         }
 
         userId = None
@@ -92,6 +138,10 @@ class Queue(AccessControlledModel):
 
         return self.save(queue)
 
+    def remove(self, queue, **kwargs):
+        QueueTaskModel().remove_queue(queue['_id'])
+        super(Queue, self).remove(queue, **kwargs)
+
     def apply_updates(self, queue, model_updates, user):
         query = {
             '_id': queue['_id']
@@ -109,132 +159,206 @@ class Queue(AccessControlledModel):
 
         return queue
 
-    def add(self, queue, taskflow, params, user):
-        query = {
-            '_id': queue['_id'],
-            'taskflows.%s' % taskflow['_id']: {
-                '$exists': False
-            }
-        }
-
-        payload = {
-            'taskflowId': taskflow['_id'],
-            'startParams': params
-        }
+    def add(self, queue, taskflow, params, user, priority=0):
+        # Pending tasks are popped in the order of their sequence numbers,
+        # so the numbers of a LIFO queue count down.
+        queue_ = self.collection.find_one_and_update(
+            {'_id': queue['_id']}, {'$inc': {'seq': 1}},
+            projection=['seq', 'type'], return_document=ReturnDocument.AFTER)
 
-        if queue['type'] == QueueType.FIFO:
-            push = {
-                'pending': payload
-            }
-        else:
-            push = {
-                'pending': {
-                    '$each': [ payload ],
-                    '$position': 0
-                }
-            }
+        seq = queue_['seq']
+        if queue_['type'] == QueueType.LIFO:
+            seq = -seq
 
-        updates = {
-            '$push': push,
-            '$set': {
-                'taskflows.%s' % taskflow['_id']: TaskStatus.PENDING
-            }
-        }
-        self.update(query, updates)
+        QueueTaskModel().add(queue['_id'], taskflow['_id'], params, seq,
+                             priority)
         queue = self.load(queue['_id'], user=user, level=AccessType.READ)
         return queue
 
     def pop(self, queue, limit, user):
-        queue, popped = self._pop_many(queue, limit, user)
-
-        for task in popped:
-            self._start_taskflow(queue['_id'], task['taskflowId'], task['start_params'], user)
-
+        self.schedule([queue['_id']], limit, user)
+        queue = self.load(queue['_id'], user=user, level=AccessType.READ)
         return queue
 
-    def finish(self, queue, taskflow, user):
+    def schedule(self, queue_ids=None, limit=sys.maxsize, user=None):
+        # Start pending taskflows of the queues (all of them by default),
+        # while they and their clusters have free run slots, up to limit.
+        # Slots are shared fairly between the queues with taskflows pending
+        # on a cluster: each goes to the queue with the fewest taskflows
+        # running on the cluster, relative to its weight. The taskflows are
+        # started as user, or as the owners of the queues.
+        # Only the allocation and the claims are serialized. The claimed
+        # tasks hold their run slots, so the taskflows can be started after
+        # the lock is released.
+        with _schedule_lock:
+            allocations, queues = self._allocate(queue_ids, limit)
+
+            claimed = []
+            for (queue_id, cluster), n in allocations.items():
+                queue = queues[queue_id]
+                claimed.extend((queue, x)
+                               for x in self._pop_many(queue, n, cluster))
+
+        started = 0
+        users = {}
+        for queue, task in claimed:
+            owner = user
+            if owner is None:
+                if queue['userId'] not in users:
+                    users[queue['userId']] = UserModel().load(
+                        queue['userId'], force=True)
+                owner = users[queue['userId']]
+
+            try:
+                self._start_taskflow(queue['_id'], task['taskflowId'], task['startParams'], owner)
+                started += 1
+            except Exception:
+                logger.exception('Starting taskflow %s of the queue %s failed' % (task['taskflowId'], queue['_id']))
+                self._finish(queue['_id'], task['taskflowId'])
+
+        return started
+
+    def _allocate(self, queue_ids, limit):
+        # Decide how many pending taskflows to start on each cluster, for
+        # each queue. Returns ({(queue id, cluster): n}, {queue id: queue}).
+        tasks = QueueTaskModel()
+        pending = tasks.counts(TaskStatus.PENDING, queue_ids)
+        if not pending:
+            return {}, {}
+
+        running = tasks.counts(TaskStatus.RUNNING)
         query = {
-            '_id': queue['_id'],
-            'taskflows.%s' % taskflow['_id']: TaskStatus.RUNNING
-        }
-
-        updates = {
-            '$inc': {
-                'nRunning': -1
-            },
-            '$unset': {
-                'taskflows.%s' % taskflow['_id']: ""
+            '_id': {
+                '$in': list({x[0] for x in pending})
             }
         }
+        queues = {x['_id']: x for x in self.collection.find(query)}
+
+        free = global_max_running() or sys.maxsize
+        free = min(free - sum(running.values()), limit)
+        cluster_limits = cluster_max_running()
+        cluster_running = defaultdict(int)
+        for (_, cluster), n in running.items():
+            cluster_running[cluster] += n
+
+        queue_free = {}
+        for queue in queues.values():
+            max_running = queue['maxRunning'] or sys.maxsize
+            queue_free[queue['_id']] = max_running - queue['nRunning']
+
+        def share(key):
+            weight = queues[key[0]].get('weight') or DEFAULT_WEIGHT
+            return running.get(key, 0) / float(weight)
+
+        # Ties go to the queue that was created first
+        order = itertools.count()
+        heap = [(share(key), key[0], next(order), key) for key in pending
+                if key[0] in queues]
+        heapq.heapify(heap)
+
+        allocations = defaultdict(int)
+        while free > 0 and heap:
+            _, _, _, key = heapq.heappop(heap)
+            queue_id, cluster = key
+            cluster_limit = cluster_limits.get(cluster)
+            if queue_free[queue_id] <= 0 or (
+                    cluster_limit and
+                    cluster_running[cluster] >= cluster_limit):
+                continue
+
+            allocations[key] += 1
+            pending[key] -= 1
+            running[key] = running.get(key, 0) + 1
+            cluster_running[cluster] += 1
+            queue_free[queue_id] -= 1
+            free -= 1
+
+            if pending[key] > 0:
+                heapq.heappush(heap, (share(key), queue_id, next(order), key))
+
+        return allocations, queues
 
-        self.update(query, updates)
+    def finish(self, queue, taskflow, user):
+        self._finish(queue['_id'], taskflow['_id'])
         queue = self.load(queue['_id'], user=user, level=AccessType.READ)
         return queue
 
-    def _pop_one(self, queue, user):
-        max_running = queue['maxRunning']
-
-        if max_running == 0:
-            max_running = sys.maxsize
+    def _finish(self, queue_id, taskflow_id):
+        # Returns whether a run slot of the queue was freed
+        if not QueueTaskModel().finish(queue_id, ObjectId(taskflow_id)):
+            return False
 
         query = {
-            '_id': queue['_id'],
-            'nRunning': {
-                '$lt': max_running
-            },
-            '$where': 'this.pending.length > 0'
+            '_id': queue_id
         }
 
         updates = {
             '$inc': {
-                'nRunning': 1
-            },
-            '$pop': {
-                'pending': -1
+                'nRunning': -1
             }
         }
 
-        # queue is the document BEFORE the updates
-        queue = self.collection.find_one_and_update(query, updates)
-        taskflow_id = None
-        start_params = None
-
-        if queue is None:
-            return queue, taskflow_id, start_params
+        self.collection.update_one(query, updates)
+        return True
 
-        n_running = queue['nRunning']
-        pending = queue['pending']
-        if (n_running >= max_running or len(pending) == 0):
-            return queue, taskflow_id, start_params
-
-        task = pending.pop(0)
-        taskflow_id = task['taskflowId']
-        start_params = task['startParams']
-
-        query = {
-            '_id': queue['_id']
-        }
-
-        updates = {
-            '$set': {
-                'taskflows.%s' % taskflow_id: TaskStatus.RUNNING
+    def _pop_many(self, queue, limit, cluster=ANY_CLUSTER):
+        # Claim up to limit pending tasks, as many as there are free run
+        # slots. Each round trip reserves the slots for a batch of tasks on
+        # the queue document, then claims the tasks, and gives back the
+        # slots of any that another pop claimed first.
+        popped = []
+        conflicts = 0
+        tasks = QueueTaskModel()
+        while len(popped) < limit and conflicts < POP_CONFLICTS:
+            queue = self.collection.find_one(
+                {'_id': queue['_id']}, projection=['nRunning', 'maxRunning'])
+            if queue is None:
+                break
+
+            max_running = queue['maxRunning']
+            if max_running == 0:
+                max_running = sys.maxsize
+
+            n = min(limit - len(popped), max_running - queue['nRunning'],
+                    POP_BATCH_SIZE)
+            if n <= 0:
+                break
+
+            ids = tasks.pending_ids(queue['_id'], n, cluster)
+            if not ids:
+                break
+
+            n = len(ids)
+            query = {
+                '_id': queue['_id'],
+                'nRunning': {
+                    '$lte': max_running - n
+                }
             }
-        }
 
-        self.update(query, updates)
-        queue = self.load(queue['_id'], user=user, level=AccessType.READ)
+            updates = {
+                '$inc': {
+                    'nRunning': n
+                }
+            }
 
-        return queue, taskflow_id, start_params
+            if self.collection.update_one(query, updates).modified_count == 0:
+                conflicts += 1
+                continue
+
+            claimed = tasks.claim(ids)
+            if len(claimed) < n:
+                conflicts += 1
+                updates = {
+                    '$inc': {
+                        'nRunning': len(claimed) - n
+                    }
+                }
+                self.collection.update_one({'_id': queue['_id']}, updates)
 
-    def _pop_many(self, queue, limit, user):
-        popped = []
-        queue_, taskflow_id, start_params = self._pop_one(queue, user)
-        while taskflow_id is not None and len(popped) < limit:
-            queue = queue_
-            popped.append({'taskflowId': taskflow_id, 'start_params': start_params})
-            queue_, taskflow_id, start_params = self._pop_one(queue, user)
+            popped.extend(claimed)
 
-        return queue, popped
+        return popped
 
     def _start_taskflow(self, queue_id, taskflow_id, params, user):
         taskflow = {"_id": taskflow_id}
@@ -257,19 +381,132 @@ class Queue(AccessControlledModel):
 
         return workflow
 
-def cleanup_failed_taskflows():
-    queues = list(Queue().find(limit=sys.maxsize, force=True))
-    for queue in queues:
-        user = UserModel().load(queue['userId'], force=True)
-        if user is None:
-            continue
-
-        for taskflow_id, status in queue['taskflows'].items():
+def migrate_embedded_tasks():
+    # Queues used to hold their pending tasks in a "pending" list, and the
+    # status of their taskflows in a "taskflows" dict. Move them to the
+    # queue_tasks collection.
+    query = {
+        '$or': [
+            {'pending': {'$exists': True}},
+            {'taskflows': {'$exists': True}}
+        ]
+    }
+    for queue in Queue().collection.find(query):
+        pending = queue.get('pending', [])
+        now = datetime.datetime.utcnow()
+        tasks = []
+        for i, payload in enumerate(pending):
+            # The list was in the order in which the tasks are popped
+            if queue['type'] == QueueType.LIFO:
+                seq = -(len(pending) - i)
+            else:
+                seq = i + 1
+
+            tasks.append({
+                'queueId': queue['_id'],
+                'taskflowId': payload['taskflowId'],
+                'startParams': payload['startParams'],
+                'cluster': cluster_key(payload['startParams']),
+                'priority': 0,
+                'status': TaskStatus.PENDING,
+                'seq': seq,
+                'created': now
+            })
+
+        for taskflow_id, status in queue.get('taskflows', {}).items():
             if status == TaskStatus.RUNNING:
-                taskflow = TaskflowModel().load(taskflow_id, force=True)
-                if taskflow['status'] in TASKFLOW_NON_RUNNING_STATES:
-                    logger.warning("Removing non-running taskflow {} from the queue {}".format(taskflow_id, queue["_id"]))
-                    Queue().finish(queue, taskflow, user)
+                tasks.append({
+                    'queueId': queue['_id'],
+                    'taskflowId': ObjectId(taskflow_id),
+                    'startParams': None,
+                    'cluster': None,
+                    'priority': 0,
+                    'status': TaskStatus.RUNNING,
+                    'seq': 0,
+                    'created': now
+                })
+
+        QueueTaskModel().add_many(tasks)
+
+        updates = {
+            '$set': {
+                'seq': len(pending)
+            },
+            '$unset': {
+                'pending': '',
+                'taskflows': ''
+            }
+        }
+        Queue().collection.update_one({'_id': queue['_id']}, updates)
+
+def _finish_many(task_ids):
+    # Remove running tasks, and free their run slots, in a fixed number of
+    # round trips. Returns the number of tasks removed.
+    tasks = QueueTaskModel()
+    claim_id, counts = tasks.claim_finished(task_ids)
+    if counts:
+        updates = [
+            UpdateOne({'_id': queue_id}, {'$inc': {'nRunning': -n}})
+            for queue_id, n in counts.items()
+        ]
+        Queue().collection.bulk_write(updates, ordered=False)
+
+    tasks.remove_claimed(claim_id)
+
+    return sum(counts.values())
+
+def cleanup_failed_taskflows(time_budget=None):
+    # Remove the taskflows that are not running anymore from the queues,
+    # in batches. If time_budget (in seconds) runs out, the next call
+    # carries on where this one stopped. Returns the number of taskflows
+    # that were removed.
+    deadline = None
+    if time_budget:
+        deadline = time.time() + time_budget
+
+    removed = 0
+    while True:
+        query = {
+            'status': TaskStatus.RUNNING
+        }
+        if _cleanup_state['lastId'] is not None:
+            query['_id'] = {'$gt': _cleanup_state['lastId']}
+
+        batch = list(QueueTaskModel().collection.find(
+            query, projection=['queueId', 'taskflowId'], sort=[('_id', 1)],
+            limit=CLEANUP_BATCH_SIZE))
+        if not batch:
+            # Start from the beginning next time
+            _cleanup_state['lastId'] = None
+            break
+
+        _cleanup_state['lastId'] = batch[-1]['_id']
+
+        query = {
+            '_id': {
+                '$in': [x['taskflowId'] for x in batch]
+            },
+            'status': {
+                '$nin': TASKFLOW_NON_RUNNING_STATES
+            }
+        }
+        running = {x['_id'] for x in TaskflowModel().collection.find(
+            query, projection=['_id'])}
+
+        stale = [x for x in batch if x['taskflowId'] not in running]
+        if stale:
+            queue_ids = {str(x['queueId']) for x in stale}
+            logger.warning('Removing %d non-running taskflows from the queues %s' % (len(stale), ', '.join(sorted(queue_ids))))
+            removed += _finish_many([x['_id'] for x in stale])
+
+        if deadline is not None and time.time() > deadline:
+            break
+
+    # The freed run slots can be used by pending taskflows
+    if removed:
+        Queue().schedule()
+
+    return removed
 
 def on_taskflow_status_update(event):
     taskflow = event.info['taskflow']
@@ -277,8 +514,10 @@ def on_taskflow_status_update(event):
     if queue_id is None:
         return
 
-    if taskflow['status'] in TASKFLOW_NON_RUNNING_STATES:
-        queue = Queue().load(queue_id, force=True)
-        user = UserModel().load(queue['userId'], force=True)
-        Queue().finish(queue, taskflow, user)
-        Queue().pop(queue, sys.maxsize, user)
+    if taskflow['status'] not in TASKFLOW_NON_RUNNING_STATES:
+        return
+
+    # Only schedule when a run slot was freed. The slot may go to another
+    # queue with taskflows pending on the same cluster.
+    if Queue()._finish(ObjectId(queue_id), taskflow['_id']):
+        Queue().schedule()
@@ -0,0 +1,285 @@
+import datetime
+import uuid
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from girder.models.model_base import Model
+
+
+class TaskStatus(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    # Running tasks that are being removed in bulk
+    FINISHING = 'finishing'
+
+
+# The order in which pending tasks are popped
+POP_ORDER = [('priority', -1), ('seq', 1)]
+
+# Matches the tasks of any cluster, including those without one
+ANY_CLUSTER = object()
+
+
+def cluster_key(params):
+    # The cluster of a task is in its start parameters, see
+    # app.launch_taskflow
+    cluster = (params or {}).get('cluster') or {}
+    if not isinstance(cluster, dict):
+        return None
+
+    key = cluster.get('_id') or cluster.get('name')
+    return str(key) if key else None
+
+
+class QueueTask(Model):
+    '''
+    A taskflow in a queue, pending or running. Pending tasks are popped
+    highest priority first, then in the order of their sequence number.
+
+    {
+        'queueId': <id of the queue>,
+        'taskflowId': <id of the taskflow>,
+        'startParams': {...},
+        'cluster': <id or name of the cluster it runs on, or None>,
+        'priority': <int, higher runs first>,
+        'status': <'pending', 'running' or 'finishing'>,
+        'seq': <sequence number within the queue>,
+        'claimId': <id of the pop that claimed the task>,
+        'created': <datetime>,
+        'started': <datetime>
+    }
+    '''
+
+    def initialize(self):
+        self.name = 'queue_tasks'
+        self.ensureIndices([
+            ([('queueId', 1), ('taskflowId', 1)], {'unique': True}),
+            ([('queueId', 1), ('status', 1), ('priority', -1),
+              ('seq', 1)], {}),
+            ([('queueId', 1), ('status', 1), ('cluster', 1),
+              ('priority', -1), ('seq', 1)], {}),
+            ([('status', 1), ('cluster', 1)], {}),
+            'claimId'
+        ])
+
+    def validate(self, doc):
+        return doc
+
+    def add(self, queue_id, taskflow_id, params, seq, priority=0):
+        '''
+        Add a pending task to a queue. Returns False if the taskflow is
+        already in the queue.
+        '''
+        task = {
+            'queueId': queue_id,
+            'taskflowId': taskflow_id,
+            'startParams': params,
+            'cluster': cluster_key(params),
+            'priority': priority,
+            'status': TaskStatus.PENDING,
+            'seq': seq,
+            'created': datetime.datetime.utcnow()
+        }
+
+        try:
+            self.collection.insert_one(task)
+        except DuplicateKeyError:
+            return False
+
+        return True
+
+    def add_many(self, tasks):
+        '''
+        Insert task documents, skipping those of taskflows that are already
+        in their queue.
+        '''
+        if not tasks:
+            return
+
+        try:
+            self.collection.insert_many(tasks, ordered=False)
+        except BulkWriteError as e:
+            # Only duplicates are expected
+            errors = e.details.get('writeErrors', [])
+            if any(x.get('code') != 11000 for x in errors):
+                raise
+
+    def pending_ids(self, queue_id, limit, cluster=ANY_CLUSTER):
+        '''
+        Get the ids of the next limit pending tasks of a queue, on cluster
+        if it is given.
+        '''
+        query = {
+            'queueId': queue_id,
+            'status': TaskStatus.PENDING
+        }
+        if cluster is not ANY_CLUSTER:
+            query['cluster'] = cluster
+
+        cursor = self.collection.find(query, projection=['_id'],
+                                      sort=POP_ORDER, limit=limit)
+
+        return [x['_id'] for x in cursor]
+
+    def counts(self, status, queue_ids=None):
+        '''
+        Get the number of tasks with status, by (queue id, cluster).
+        '''
+        match = {
+            'status': status
+        }
+        if queue_ids is not None:
+            match['queueId'] = {'$in': queue_ids}
+
+        pipeline = [
+            {'$match': match},
+            {'$group': {
+                '_id': {'queueId': '$queueId', 'cluster': '$cluster'},
+                'count': {'$sum': 1}
+            }}
+        ]
+
+        return {
+            (x['_id']['queueId'], x['_id'].get('cluster')): x['count']
+            for x in self.collection.aggregate(pipeline)
+        }
+
+    def summary(self, queue_ids):
+        '''
+        Get the number of pending tasks of queues, and how long their tasks
+        wait: the age of the oldest pending task, and the mean wait of the
+        running tasks before they started, in seconds.
+        '''
+        pipeline = [
+            {'$match': {
+                'queueId': {'$in': queue_ids},
+                'status': {'$in': [TaskStatus.PENDING, TaskStatus.RUNNING]}
+            }},
+            {'$group': {
+                '_id': {'queueId': '$queueId', 'status': '$status'},
+                'count': {'$sum': 1},
+                'oldest': {'$min': '$created'},
+                'wait': {'$avg': {'$subtract': ['$started', '$created']}}
+            }}
+        ]
+
+        now = datetime.datetime.utcnow()
+        summary = {
+            x: {
+                'nPending': 0,
+                'wait': {
+                    'oldestPending': None,
+                    'meanRunning': None
+                }
+            }
+            for x in queue_ids
+        }
+        for group in self.collection.aggregate(pipeline):
+            queue = summary[group['_id']['queueId']]
+            if group['_id']['status'] == TaskStatus.PENDING:
+                queue['nPending'] = group['count']
+                queue['wait']['oldestPending'] = (
+                    now - group['oldest']).total_seconds()
+            elif (group['_id']['status'] == TaskStatus.RUNNING and
+                  group['wait'] is not None):
+                queue['wait']['meanRunning'] = group['wait'] / 1000.0
+
+        return summary
+
+    def claim(self, ids):
+        '''
+        Mark the pending tasks with the given ids as running. Returns the
+        tasks that were claimed, which excludes those claimed by another pop
+        in the meantime.
+        '''
+        claim_id = uuid.uuid4().hex
+        query = {
+            '_id': {'$in': ids},
+            'status': TaskStatus.PENDING
+        }
+        update = {
+            '$set': {
+                'status': TaskStatus.RUNNING,
+                'claimId': claim_id,
+                'started': datetime.datetime.utcnow()
+            }
+        }
+        result = self.collection.update_many(query, update)
+        if result.modified_count == 0:
+            return []
+
+        query = {
+            '_id': {'$in': ids},
+            'claimId': claim_id
+        }
+
+        return list(self.collection.find(query, sort=POP_ORDER))
+
+    def finish(self, queue_id, taskflow_id):
+        '''
+        Remove a running task. Returns False if the taskflow wasn't running
+        in the queue.
+        '''
+        query = {
+            'queueId': queue_id,
+            'taskflowId': taskflow_id,
+            'status': TaskStatus.RUNNING
+        }
+
+        return self.collection.delete_one(query).deleted_count == 1
+
+    def claim_finished(self, ids):
+        '''
+        Mark the running tasks with the given ids as finishing, to remove
+        them in bulk. Returns the id of the claim, and the number of tasks
+        claimed in each queue.
+        '''
+        claim_id = uuid.uuid4().hex
+        query = {
+            '_id': {'$in': ids},
+            'status': TaskStatus.RUNNING
+        }
+        update = {
+            '$set': {
+                'status': TaskStatus.FINISHING,
+                'claimId': claim_id
+            }
+        }
+        if self.collection.update_many(query, update).modified_count == 0:
+            return claim_id, {}
+
+        pipeline = [
+            {'$match': {'claimId': claim_id}},
+            {'$group': {'_id': '$queueId', 'count': {'$sum': 1}}}
+        ]
+        counts = {x['_id']: x['count']
+                  for x in self.collection.aggregate(pipeline)}
+
+        return claim_id, counts
+
+    def remove_claimed(self, claim_id):
+        self.collection.delete_many({
+            'claimId': claim_id,
+            'status': TaskStatus.FINISHING
+        })
+
+    def count(self, queue_id, status=None):
+        query = {
+            'queueId': queue_id
+        }
+        if status is not None:
+            query['status'] = status
+
+        return self.collection.count_documents(query)
+
+    def find_tasks(self, queue_id, status=None):
+        query = {
+            'queueId': queue_id
+        }
+        if status is not None:
+            query['status'] = status
+
+        return self.collection.find(query, sort=POP_ORDER)
+
+    def remove_queue(self, queue_id):
+        self.collection.delete_many({'queueId': queue_id})
@@ -11,6 +11,7 @@ from girder.models.file import File
 
 from queues.models.queue import Queue as QueueModel
 from queues.models.queue import QueueType, TaskStatus
+from queues.models.queue_task import QueueTask as QueueTaskModel
 from taskflow.models.taskflow import Taskflow as TaskflowModel
 
 from cumulus.taskflow import load_class
@@ -37,7 +38,16 @@ class Queue(Resource):
         .pagingParams(defaultSort=None)
     )
     def find(self, name):
-        return list(QueueModel().find(name=name, user=self.getCurrentUser()))
+        queues = list(QueueModel().find(name=name, user=self.getCurrentUser()))
+        return self._add_summary(queues)
+
+    def _add_summary(self, queues):
+        # The number of pending taskflows, and how long they wait
+        summary = QueueTaskModel().summary([x['_id'] for x in queues])
+        for queue in queues:
+            queue.update(summary[queue['_id']])
+
+        return queues
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
@@ -65,7 +75,7 @@ class Queue(Resource):
                     level=AccessType.READ, paramType='path')
     )
     def find_id(self, queue):
-        return queue
+        return self._add_summary([queue])[0]
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
@@ -81,19 +91,28 @@ class Queue(Resource):
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
-        Description('Change the maximum number of running jobs in the queue')
+        Description('Change the maximum number of running jobs in the queue, or its weight')
         .modelParam('id', 'The queue id',
                     model=QueueModel, destName='queue',
                     level=AccessType.WRITE, paramType='path')
-        .param('maxRunning', 'The max number of taskflows that can be running at the same time', required=True, dataType='integer')
+        .param('maxRunning', 'The max number of taskflows that can be running at the same time', required=False, dataType='integer')
+        .param('weight', 'The share of the clusters the queue gets, relative to the other queues (admin only)', required=False, dataType='number')
     )
-    def set_max_running(self, queue, maxRunning):
-        if maxRunning < 0:
-            raise RestException('Invalid maxRunning parameter. maxRunning must be >= 0')
+    def set_max_running(self, queue, maxRunning, weight):
+        updates = {}
 
-        updates = {
-            'maxRunning': maxRunning
-        }
+        if maxRunning is not None:
+            if maxRunning < 0:
+                raise RestException('Invalid maxRunning parameter. maxRunning must be >= 0')
+
+            updates['maxRunning'] = maxRunning
+
+        if weight is not None:
+            self.requireAdmin(self.getCurrentUser())
+            if weight <= 0:
+                raise RestException('Invalid weight parameter. weight must be > 0')
+
+            updates['weight'] = weight
 
         queue = QueueModel().apply_updates(queue, updates, self.getCurrentUser())
         return queue
@@ -108,9 +127,10 @@ class Queue(Resource):
                     model=TaskflowModel, destName='taskflow',
                     level=AccessType.WRITE, paramType='path')
         .jsonParam('body', 'The taskflow start parameters', required=False, paramType='body')
+        .param('priority', 'Taskflows with a higher priority are started first', required=False, dataType='integer', default=0)
     )
-    def add_task(self, queue, taskflow, body):
-        queue = QueueModel().add(queue, taskflow, body, self.getCurrentUser())
+    def add_task(self, queue, taskflow, body, priority):
+        queue = QueueModel().add(queue, taskflow, body, self.getCurrentUser(), priority)
         return queue
 
     @access.user(scope=TokenScope.DATA_WRITE)
@@ -133,49 +153,22 @@ class Queue(Resource):
 
     @access.user(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
-        Description('Fetch the pending TaskFlows.')
+        Description('Fetch the TaskFlows in the queue.')
         .modelParam('id', 'The queue id',
                     model=QueueModel, destName='queue',
                     level=AccessType.READ, paramType='path')
+        .param('status', 'Filter taskflows by status (%s|%s), or an empty string for all of them' % (TaskStatus.RUNNING, TaskStatus.PENDING),
+               required=False, default=TaskStatus.PENDING)
     )
-    def get_tasks(self, queue):
-        ids = queue['pending']
-        query = {
-            '_id': {
-                '$in': ids
-            }
-        }
-        taskflows = TaskflowModel().find(query)
-        return taskflows
-
-    @access.user(scope=TokenScope.DATA_READ)
-    @autoDescribeRoute(
-        Description('Fetch the pending TaskFlows.')
-        .modelParam('id', 'The queue id',
-                    model=QueueModel, destName='queue',
-                    level=AccessType.READ, paramType='path')
-        .param('status', 'Filter taskflows by status (%s|%s)' % (TaskStatus.RUNNING, TaskStatus.PENDING),
-               required=False, default='')
-    )
-    def running_tasks(self, queue, status):
-        if status not in [TaskStatus.RUNNING, TaskStatus.PENDING, '']:
-            status = ''
-
-        pending_ids = []
-        running_ids = []
-
-        include_pending = status in [TaskStatus.PENDING, '']
-        include_running = status in [TaskStatus.RUNNING, '']
-
-        for taskflow_id, taskflow_status in queue['taskflows'].items():
-            if taskflow_status == TaskStatus.PENDING and include_pending:
-                pending_ids.append(taskflow_id)
-            elif taskflow_status == TaskStatus.RUNNING and include_running:
-                running_ids.append(taskflow_id)
+    def get_tasks(self, queue, status):
+        if status not in [TaskStatus.RUNNING, TaskStatus.PENDING]:
+            status = None
 
+        tasks = QueueTaskModel().find_tasks(queue['_id'], status)
+        ids = [task['taskflowId'] for task in tasks]
         query = {
             '_id': {
-                '$in': running_ids + pending_ids
+                '$in': ids
             }
         }
         taskflows = TaskflowModel().find(query)
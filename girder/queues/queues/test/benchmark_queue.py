@@ -0,0 +1,77 @@
+import sys
+import time
+
+from bson.objectid import ObjectId
+
+from girder.models.user import User
+
+from queues.models.queue import Queue, QueueType
+
+#
+# Benchmark of the throughput of a queue: 10k taskflows are added to a queue,
+# then pushed through it, maxRunning at a time. Each time a taskflow
+# finishes, the queue is popped, as it is by on_taskflow_status_update.
+# Starting a taskflow is a no-op, so this measures the queue itself.
+#
+# It uses the database of the girder configuration, and removes the queue
+# and the user it creates. Run from this directory, in an environment with
+# girder and the queues plugin installed, with:
+#
+#   python benchmark_queue.py [number of taskflows]
+#
+
+TASKFLOWS = 10000
+MAX_RUNNING = [5, 100, 0]
+
+
+class BenchmarkQueue(Queue):
+    # Records the taskflows that were started, instead of starting them
+
+    def _start_taskflow(self, queue_id, taskflow_id, params, user):
+        self.started.append(taskflow_id)
+
+
+def benchmark(user, n, max_running):
+    model = BenchmarkQueue()
+    model.started = []
+    name = 'benchmark-%s' % ObjectId()
+    queue = model.create(name, type_=QueueType.FIFO,
+                         max_running=max_running, user=user)
+
+    try:
+        start = time.time()
+        for _ in range(n):
+            model.add(queue, {'_id': ObjectId()}, None, user)
+        add_time = time.time() - start
+
+        start = time.time()
+        model.pop(queue, sys.maxsize, user)
+        finished = 0
+        while finished < len(model.started):
+            model._finish(queue['_id'], model.started[finished])
+            finished += 1
+            model.pop(queue, sys.maxsize, user)
+        run_time = time.time() - start
+
+        assert finished == n
+    finally:
+        model.remove(queue)
+
+    return n / add_time, n / run_time
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else TASKFLOWS
+
+    user = User().createUser('queue-benchmark-%s' % ObjectId(), 'password',
+                             'Queue', 'Benchmark',
+                             'queue-benchmark-%s@example.com' % ObjectId())
+    try:
+        print('%d taskflows' % n)
+        print('%12s %14s %14s' % ('maxRunning', 'Adds/s', 'Taskflows/s'))
+        for max_running in MAX_RUNNING:
+            adds, taskflows = benchmark(user, n, max_running)
+            print('%12s %14.0f %14.0f' % (max_running or 'unlimited', adds,
+                                          taskflows))
+    finally:
+        User().remove(user)